@@ -4,6 +4,7 @@ from datetime import datetime
 
 import model.engine.trainer
 import model.engine.dynamics_model_trainer
+import model.engine.imagined_trainer
 from model.config import get_cfg_defaults
 import utils.logger as lg
 import model.engine.landscape_plot
@@ -42,6 +43,7 @@ def train(cfg, iter):
             i
         )
         model.engine.landscape_plot.visualise2d(agent, output_results_dir, i)
+        agent.close()
 
 
 def train_dynamics_model(cfg, iter):
@@ -72,6 +74,41 @@ def train_dynamics_model(cfg, iter):
     )
 
 
+def train_imagined(cfg, iter):
+
+    # Create output directories
+    env_output_dir = os.path.join(cfg.OUTPUT.DIR, cfg.MUJOCO.ENV)
+    if cfg.OUTPUT.NAME == "timestamp":
+        output_dir_name = "{0:%Y-%m-%d %H:%M:%S}".format(datetime.now())
+    else:
+        output_dir_name = cfg.OUTPUT.NAME
+    output_dir = os.path.join(env_output_dir, output_dir_name)
+    output_rec_dir = os.path.join(output_dir, 'recordings')
+    output_weights_dir = os.path.join(output_dir, 'weights')
+    output_results_dir = os.path.join(output_dir, 'results')
+    os.makedirs(output_dir)
+    os.mkdir(output_weights_dir)
+    os.mkdir(output_results_dir)
+    if cfg.LOG.TESTING.ENABLED:
+        os.mkdir(output_rec_dir)
+
+    # Create logger
+    logger = lg.setup_logger("model.engine.imagined_trainer", output_dir, 'logs')
+    logger.info("Running with config:\n{}".format(cfg))
+
+    # Repeat for required number of iterations
+    for i in range(iter):
+        agent = model.engine.imagined_trainer.do_training(
+            cfg,
+            logger,
+            output_results_dir,
+            output_rec_dir,
+            output_weights_dir,
+            i
+        )
+        agent.close()
+
+
 def inference(cfg):
     pass
 
@@ -89,7 +126,7 @@ def main():
         "--mode",
         default="train",
         metavar="mode",
-        help="'train' or 'test' or 'dynamics'",
+        help="'train' or 'test' or 'dynamics' or 'imagined'",
         type=str,
     )
     parser.add_argument(
@@ -118,6 +155,8 @@ def main():
         train(cfg, args.iter)
     elif args.mode == "dynamics":
         train_dynamics_model(cfg, args.iter)
+    elif args.mode == "imagined":
+        train_imagined(cfg, args.iter)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,11 @@
 import torch
 import torch.nn as nn
-from model.blocks import build_policy, mj_torch_block_factory
+from model.blocks import build_policy, mj_torch_fused_block_factory, mj_torch_trajectory_factory, \
+    mj_torch_batch_block_factory
+from mujoco import build_vector_agent
 from copy import deepcopy
 from solver import build_optimizer
+from utils.precision import policy_dtype, block_dtype
 import numpy as np
 from ..blocks.policy.strategies import *
 
@@ -22,9 +25,26 @@ class Basic(nn.Module):
         # Make sure unwrapped agent can call policy_net
         self.agent.unwrapped.policy_net = self.policy_net
 
-        # build forward dynamics block
-        self.dynamics_block = mj_torch_block_factory(agent, 'dynamics').apply
-        self.reward_block = mj_torch_block_factory(agent, 'reward').apply
+        # Dtypes of the policy net and of the blocks; unless precision is mixed the whole policy net (including action
+        # means and sds) is converted, so no conversions are needed between the policy and the blocks
+        self.policy_dtype = policy_dtype(cfg)
+        self.dtype = block_dtype(cfg)
+        if cfg.MODEL.PRECISION != "mixed":
+            self.policy_net.to(self.dtype)
+
+        # build forward dynamics and reward block
+        self.mj_block = mj_torch_fused_block_factory(agent).apply
+
+        # build a block for whole open-loop trajectories
+        if cfg.MODEL.TRAJECTORY_BLOCK:
+            assert not cfg.MODEL.POLICY.NETWORK, "Trajectory block can be used only with open-loop policies"
+            assert cfg.MODEL.TRUNCATED_BPTT == 0, "Trajectory block backpropagates whole episodes"
+            self.trajectory_block = mj_torch_trajectory_factory(agent).apply
+
+        # build a block that steps all episodes of a batch together
+        if cfg.MODEL.BATCH_BLOCK:
+            self.vector_agent = build_vector_agent(cfg, self.policy_net)
+            self.batch_block = mj_torch_batch_block_factory(agent, self.vector_agent).apply
 
     def forward(self, state):
         """Single pass.
@@ -34,13 +54,41 @@ class Basic(nn.Module):
 
         # We're generally using torch.float64 and numpy.float64 for precision, but the net can be trained with
         # torch.float32 -- not sure if this really makes a difference wrt speed or memory, but the default layers
-        # seem to be using torch.float32
-        action = self.policy_net(state.detach().float()).double()
+        # seem to be using torch.float32 (see MODEL.PRECISION; conversions are no-ops unless precision is mixed)
+        action = self.policy_net(state.detach().to(self.policy_dtype)).to(self.dtype)
 
-        # Forward block will drive the simulation forward
-        next_state = self.dynamics_block(state, action)
-
-        # The reward is actually calculated in the dynamics_block, here we'll just grab it from the agent
-        reward = self.reward_block(state, action)
+        # Forward block will drive the simulation forward and return the reward as well
+        next_state, reward = self.mj_block(state, action)
 
         return next_state, reward
+
+    def rollout(self, state):
+        """Roll out a whole episode with the trajectory block.
+        :param state: initial state
+        :return: next states [T, S] and rewards [T] (T is shorter than horizon if the episode ended early)
+        """
+
+        # Open-loop actions don't depend on the state, so we can get all of them before simulating
+        actions = []
+        for step_idx in range(self.cfg.MODEL.POLICY.MAX_HORIZON_STEPS):
+            self.agent.set_step_idx(step_idx)
+            actions.append(self.policy_net(state.detach().to(self.policy_dtype)).to(self.dtype))
+        self.agent.set_step_idx(0)
+
+        return self.trajectory_block(state, torch.stack(actions))
+
+    def forward_batch(self, states, active=None):
+        """Single pass for all episodes of a batch with the batch block.
+        :param states: torch.Tensor [B, S]
+        :param active: torch.Tensor [B] of episodes that are still running (default all)
+        :return: next states [B, S] and rewards [B]
+        """
+        if active is None:
+            active = torch.ones(states.shape[0], dtype=torch.bool)
+        actions = self.policy_net.batch_forward(states.detach().to(self.policy_dtype)).to(self.dtype)
+        return self.batch_block(states, actions, active)
+
+    def close(self):
+        """Shut down the simulations of the batch block (and their worker processes)"""
+        if self.cfg.MODEL.BATCH_BLOCK:
+            self.vector_agent.close()
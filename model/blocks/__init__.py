@@ -1,4 +1,4 @@
 from .policy import build_policy
-from .mujoco import mj_torch_block_factory
+from .mujoco import mj_torch_fused_block_factory, mj_torch_trajectory_factory, mj_torch_batch_block_factory
 
-__all__ = ["build_policy", "mj_torch_block_factory"]
+__all__ = ["build_policy", "mj_torch_fused_block_factory", "mj_torch_trajectory_factory", "mj_torch_batch_block_factory"]
@@ -1,107 +1,322 @@
 import torch
 from torch import autograd, nn
 import numpy as np
+from utils.precision import block_dtype, numpy_dtype
 
 
-def mj_torch_block_factory(agent, mode):
-    mj_forward = agent.forward_factory(mode)
-    mj_gradients = agent.gradient_factory(mode)
+def reset_running_sums(agent):
+    """GRAD_WEIGHTS "prioritise" accumulates a running sum for each episode of a batch; start them all from zero"""
+    agent.running_sum = np.zeros(agent.cfg.MODEL.BATCH_SIZE)
 
-    class MjBlock(autograd.Function):
+
+def episode_index(agent):
+    """Index of the current episode in its batch (IndexWrapper counts episodes from one)"""
+    return agent.get_episode_idx().value - 1
+
+
+def weighted_jacobian(agent, episode_idx, step_idx, dynamics_gradients, reward_gradients, jacobian):
+    """
+    Stack dynamics and reward jacobians into one [S+1, S+A] matrix, weighted with MODEL.POLICY.GRAD_WEIGHTS
+    :param episode_idx: index of the episode in its batch, whose running sum "prioritise" accumulates
+    :param step_idx: step index of the snapshot the jacobians were calculated at
+    :param jacobian: preallocated torch.Tensor [S+1, S+A] to fill, jacobians are converted to its dtype
+    :return: jacobian [[dsds, dsda], [drds, drda]]
+    """
+    horizon = agent.cfg.MODEL.POLICY.MAX_HORIZON_STEPS
+    grad_weights = agent.cfg.MODEL.POLICY.GRAD_WEIGHTS
+    state_size = dynamics_gradients["state"].shape[0]
+
+    blocks = jacobian.numpy()
+    blocks[:state_size, :state_size] = dynamics_gradients["state"]
+    blocks[:state_size, state_size:] = dynamics_gradients["action"]
+    blocks[state_size:, :state_size] = reward_gradients["state"]
+    blocks[state_size:, state_size:] = reward_gradients["action"]
+
+    if grad_weights == "prioritise":
+        weight = horizon - step_idx
+        agent.running_sum[episode_idx] += weight
+        running_sum = agent.running_sum[episode_idx]
+        jacobian[:state_size, state_size:] *= 1.0 / running_sum
+        jacobian[state_size:, :state_size] *= weight - 1
+        jacobian[state_size:, state_size:] *= weight / running_sum
+    elif grad_weights == "average":
+        weight = 1 / (horizon - step_idx)
+        jacobian[:, state_size:] *= weight
+
+    return jacobian
+
+
+def weight_jacobian_stack(agent, episodes, step_idx, dsda, drds, drda):
+    """
+    Weight stacks of jacobians in place like weighted_jacobian does, but for all of them at once
+    :param episodes: index of the episode in its batch if the stack holds consecutive steps of one episode (the
+                     trajectory block), or np.array [N] of distinct episode indices if it holds one step of different
+                     episodes (the batch block)
+    :param step_idx: np.array [N] of step indices the jacobians were calculated at
+    :param dsda: np.array [N, S, A]
+    :param drds: np.array [N, S]
+    :param drda: np.array [N, A]
+    """
+    horizon = agent.cfg.MODEL.POLICY.MAX_HORIZON_STEPS
+    grad_weights = agent.cfg.MODEL.POLICY.GRAD_WEIGHTS
+
+    if grad_weights == "prioritise":
+        weight = horizon - step_idx
+        if np.ndim(episodes) == 0:
+            # Backward visits the stack from the last jacobian to the first, accumulating the running sum on the way
+            running_sum = agent.running_sum[episodes] + np.cumsum(weight[::-1])[::-1]
+            agent.running_sum[episodes] = running_sum[0]
+        else:
+            agent.running_sum[episodes] += weight
+            running_sum = agent.running_sum[episodes]
+        dsda *= (1.0 / running_sum)[:, None, None]
+        drds *= (weight - 1)[:, None]
+        drda *= (weight / running_sum)[:, None]
+    elif grad_weights == "average":
+        weight = 1 / (horizon - step_idx)
+        dsda *= weight[:, None, None]
+        drda *= weight[:, None]
+
+
+def submit_gradients(agent, data_snapshot, next_state, reward):
+    """
+    Start calculating the jacobians of a step in the worker pool right away if they're speculative
+    :return: multiprocessing.pool.AsyncResult, or None if the jacobians are calculated in backward
+    """
+    if agent.cfg.MODEL.GRADIENTS.SPECULATIVE:
+        return agent.gradient_pool.submit(data_snapshot, next_state, reward, test=True)
+    return None
+
+
+def mj_torch_fused_block_factory(agent):
+    """
+    Dynamics and reward in one block: returns (next_state, reward), and calculates the jacobians once per backward.
+    Everything backward needs is kept in ctx, so multiple blocks can be in flight at the same time.
+    """
+    mj_forward = agent.forward_factory("dynamics")
+    mj_gradients = agent.gradient_factory("dynamics")
+    kernel = agent.kernel
+
+    # Jacobians and output gradients are converted into these buffers (backward calls don't overlap)
+    dtype = block_dtype(agent.cfg)
+    state_size = agent.observation_space.shape[0]
+    action_size = agent.action_space.shape[0]
+    jacobian = torch.empty(state_size + 1, state_size + action_size, dtype=dtype)
+    grad_output = torch.empty(state_size + 1, dtype=dtype)
+
+    class MjFusedBlock(autograd.Function):
 
         @staticmethod
         def forward(ctx, state, action):
 
-            # Advance simulation or return reward
-            if mode == "dynamics":
-                # We need to get a deep copy of simulation data so we can return to this "snapshot"
-                # (we can't deepcopy agent.sim.data because some variables are unpicklable)
-                # We'll calculate gradients in the backward phase of "reward"
-                agent.data.qpos[:] = state[:agent.model.nq].detach().numpy().copy()
-                agent.data.qvel[:] = state[agent.model.nq:].detach().numpy().copy()
-                agent.data.ctrl[:] = action.detach().numpy().copy()
-                agent.data_snapshot = agent.get_snapshot()
+            # Set state and action, and get a snapshot so we can return to this point in backward
+            kernel.data.qpos[:] = state[:kernel.model.nq].detach().numpy()
+            kernel.data.qvel[:] = state[kernel.model.nq:].detach().numpy()
+            kernel.data.ctrl[:] = action.detach().numpy()
+            if agent.snapshot_checkpoints is not None:
+                ctx.data_snapshot = None
+                ctx.segment = agent.snapshot_checkpoints.record()
+            else:
+                ctx.data_snapshot = kernel.snapshot()
 
-                next_state = mj_forward()
-                agent.next_state = next_state
+            # Advance simulation
+            ctx.next_state = mj_forward()
+            ctx.reward = agent.reward
+            ctx.gradients = submit_gradients(agent, ctx.data_snapshot, ctx.next_state, ctx.reward)
+            ctx.episode_idx = episode_index(agent)
+            ctx.jacobians = None
 
-                ctx.data_snapshot = agent.data_snapshot
-#                ctx.reward = agent.reward
-#                ctx.next_state = agent.next_state
+            # Next state is kept in float64 for finite differences, outputs are in the block's dtype. Outputs stay in
+            # the graph, so they can't be reused buffers; in double precision the next state shares memory with the
+            # simulation's array, otherwise it's converted with one copy
+            return torch.as_tensor(ctx.next_state, dtype=dtype), \
+                torch.full((1,), np.asarray(agent.reward).item(), dtype=dtype)
 
-                return torch.from_numpy(next_state)
+        @staticmethod
+        def backward(ctx, grad_next_state, grad_reward):
 
-            elif mode == "reward":
-                ctx.data_snapshot = agent.data_snapshot
-                ctx.reward = agent.reward
-                ctx.next_state = agent.next_state
-                return torch.Tensor([agent.reward]).double()
+            # Jacobians are calculated once per graph, so repeated backward passes through it (retain_graph) reuse them
+            if ctx.jacobians is None:
+
+                # Rebuild the snapshot if only checkpoints were kept
+                data_snapshot = ctx.data_snapshot
+                if data_snapshot is None:
+                    data_snapshot = agent.snapshot_checkpoints.snapshot(*ctx.segment)
+
+                # Calculate dynamics and reward gradients in one go, or collect them if they were calculated
+                # speculatively
+                if ctx.gradients is not None:
+                    dynamics_gradients, reward_gradients = ctx.gradients.get()
+                else:
+                    dynamics_gradients, reward_gradients = \
+                        mj_gradients(data_snapshot, ctx.next_state, ctx.reward, test=True)
+                ctx.jacobians = data_snapshot.step_idx.value, dynamics_gradients, reward_gradients
+
+            weighted_jacobian(agent, ctx.episode_idx, *ctx.jacobians, jacobian)
+
+            # One vector-jacobian product for both outputs
+            grad_output[:state_size] = grad_next_state.reshape(-1)
+            grad_output[state_size:] = grad_reward.reshape(-1)
+            grad_input = torch.matmul(grad_output, jacobian)
+
+            return grad_input[:state_size], grad_input[state_size:]
+
+    return MjFusedBlock
 
-            else:
-                raise TypeError("mode has to be 'dynamics' or 'gradient'")
+
+def mj_torch_trajectory_factory(agent):
+    """
+    A whole open-loop trajectory as one block: takes the initial state and actions [T, A], and returns next states
+    [T, S] and rewards [T]. Backward calculates the jacobians of every step into preallocated [T, S, S] / [T, S, A]
+    stacks, and propagates the gradients with one reverse adjoint sweep.
+    """
+    mj_forward = agent.forward_factory("dynamics")
+    mj_gradients = agent.gradient_factory("dynamics")
+
+    kernel = agent.kernel
+    nq = kernel.model.nq
+    state_size = agent.observation_space.shape[0]
+    action_size = agent.action_space.shape[0]
+
+    # Jacobian stacks and adjoints are in the block's dtype, next states and rewards are kept in float64 for finite
+    # differences
+    dtype = block_dtype(agent.cfg)
+    np_dtype = numpy_dtype(dtype)
+
+    class MjTrajectoryBlock(autograd.Function):
 
         @staticmethod
-        def backward(ctx, grad_output):
+        def forward(ctx, state, actions):
+            horizon = actions.shape[0]
+            next_states = np.empty((horizon, state_size))
+            rewards = np.empty(horizon)
+            snapshots = []
+            gradients = []
 
-            if agent.cfg.MODEL.POLICY.GRAD_WEIGHTS == "prioritise":
-                weight = agent.cfg.MODEL.POLICY.MAX_HORIZON_STEPS - ctx.data_snapshot.step_idx.value
-            else:
-                weight = 1 / (agent.cfg.MODEL.POLICY.MAX_HORIZON_STEPS - ctx.data_snapshot.step_idx.value)
+            # Set initial state
+            kernel.data.qpos[:] = state[:nq].detach().numpy()
+            kernel.data.qvel[:] = state[nq:].detach().numpy()
+            actions = actions.detach().numpy()
+
+            # Roll out the whole horizon (or until the episode is done), keeping snapshots for backward
+            for step_idx in range(horizon):
+                kernel.data.ctrl[:] = actions[step_idx]
+                snapshots.append(kernel.snapshot())
+                next_states[step_idx] = mj_forward()
+                rewards[step_idx] = np.asarray(agent.reward).item()
+                gradients.append(submit_gradients(agent, snapshots[-1], next_states[step_idx], agent.reward))
+                if agent.is_done:
+                    break
 
-            # We should need to calculate gradients only once per dynamics/reward cycle
-            if mode == "dynamics":
+            ctx.snapshots = snapshots
+            ctx.gradients = gradients
+            ctx.next_states = next_states[:len(snapshots)]
+            ctx.rewards = rewards[:len(snapshots)]
+            ctx.horizon = horizon
+            ctx.episode_idx = episode_index(agent)
+            ctx.jacobians = None
 
-                state_jacobian = torch.from_numpy(agent.dynamics_gradients["state"])
-                action_jacobian = torch.from_numpy(agent.dynamics_gradients["action"])
+            return torch.as_tensor(ctx.next_states, dtype=dtype), torch.as_tensor(ctx.rewards, dtype=dtype)
 
-                if agent.cfg.MODEL.POLICY.GRAD_WEIGHTS == "prioritise":
-                    action_jacobian = (1.0 / agent.running_sum) * action_jacobian
-                elif agent.cfg.MODEL.POLICY.GRAD_WEIGHTS == "average":
-                    action_jacobian = weight * action_jacobian
+        @staticmethod
+        def backward(ctx, grad_next_states, grad_rewards):
+            steps = len(ctx.snapshots)
 
-            elif mode == "reward":
+            # Jacobians are calculated once per graph, so repeated backward passes through it (retain_graph) reuse them
+            if ctx.jacobians is None:
 
-                if agent.cfg.MODEL.POLICY.GRAD_WEIGHTS == "prioritise":
-                    agent.running_sum += weight
+                # Calculate jacobians of every step into preallocated stacks
+                dsds = np.empty((steps, state_size, state_size), dtype=np_dtype)
+                dsda = np.empty((steps, state_size, action_size), dtype=np_dtype)
+                drds = np.empty((steps, state_size), dtype=np_dtype)
+                drda = np.empty((steps, action_size), dtype=np_dtype)
+                for step_idx, snapshot in enumerate(ctx.snapshots):
+                    if ctx.gradients[step_idx] is not None:
+                        dynamics_gradients, reward_gradients = ctx.gradients[step_idx].get()
+                    else:
+                        dynamics_gradients, reward_gradients = \
+                            mj_gradients(snapshot, ctx.next_states[step_idx], ctx.rewards[step_idx], test=True)
+                    dsds[step_idx] = dynamics_gradients["state"]
+                    dsda[step_idx] = dynamics_gradients["action"]
+                    drds[step_idx] = reward_gradients["state"]
+                    drda[step_idx] = reward_gradients["action"]
+                ctx.jacobians = dsds, dsda, drds, drda
 
-                # Calculate gradients, "reward" is always called first
-                mj_gradients(ctx.data_snapshot, ctx.next_state, ctx.reward, test=True)
-                state_jacobian = torch.from_numpy(agent.reward_gradients["state"])
-                action_jacobian = torch.from_numpy(agent.reward_gradients["action"])
+            # Weight copies of the jacobians like the fused block does, but for all steps at once
+            dsds, dsda, drds, drda = ctx.jacobians
+            dsda, drds, drda = dsda.copy(), drds.copy(), drda.copy()
+            snapshot_step_idx = np.array([snapshot.step_idx.value for snapshot in ctx.snapshots])
+            weight_jacobian_stack(agent, ctx.episode_idx, snapshot_step_idx, dsda, drds, drda)
 
-                if agent.cfg.MODEL.POLICY.GRAD_WEIGHTS == "prioritise":
-                    state_jacobian = (weight - 1) * state_jacobian
-                    action_jacobian = (weight / agent.running_sum) * action_jacobian
-                elif agent.cfg.MODEL.POLICY.GRAD_WEIGHTS == "average":
-                    action_jacobian = weight * action_jacobian
+            # Adjoint sweep: gradient of the loss wrt each next state, including what flows back from later steps
+            grad_next_states = grad_next_states.detach().numpy().copy()
+            grad_rewards = grad_rewards.detach().numpy()
+            grad_state = np.zeros(state_size, dtype=np_dtype)
+            for step_idx in reversed(range(steps)):
+                grad_next_states[step_idx] += grad_state
+                grad_state = np.matmul(grad_next_states[step_idx], dsds[step_idx]) + \
+                    grad_rewards[step_idx] * drds[step_idx]
 
-            else:
-                raise TypeError("mode has to be 'dynamics' or 'reward'")
-
-            if False:
-                torch.set_printoptions(precision=5, sci_mode=False)
-                print("{} {}".format(ctx.data_snapshot.time, mode))
-                print("grad_output")
-                print(grad_output)
-                print("state_jacobian")
-                print(state_jacobian)
-                print("action_jacobian")
-                print(action_jacobian)
-                print("grad_output*state_jacobian")
-                print(torch.matmul(grad_output, state_jacobian))
-                print("grad_output*action_jacobian")
-                print(torch.matmul(grad_output, action_jacobian))
-                print('weight: {} ---- 1/({} - {})'.format(weight, agent.cfg.MODEL.POLICY.MAX_HORIZON_STEPS, ctx.data_snapshot.step_idx))
-                print("")
-
-            ds = torch.matmul(grad_output, state_jacobian)
-            da = torch.matmul(grad_output, action_jacobian)
-
-            #threshold = 5
-            #ds.clamp_(-threshold, threshold)
-            #da.clamp_(-threshold, threshold)
-
-            return ds, da
-
-    return MjBlock
+            # Action gradients don't depend on each other once the adjoints are known
+            grad_actions = np.zeros((ctx.horizon, action_size), dtype=np_dtype)
+            grad_actions[:steps] = np.einsum("ts,tsa->ta", grad_next_states, dsda) + grad_rewards[:, None] * drda
+
+            return torch.from_numpy(grad_state), torch.from_numpy(grad_actions)
+
+    return MjTrajectoryBlock
+
+
+def mj_torch_batch_block_factory(agent, vector_agent):
+    """
+    One step of a whole batch of episodes as one block: takes states [B, S], actions [B, A], and a mask [B] of episodes
+    that are still running, and returns next states [B, S] and rewards [B]. The episodes are simulated by a
+    mujoco.utils.vector.VectorAgent, and backward calculates the jacobians of all running episodes in one call and
+    applies them with batched vector-jacobian products. Finished episodes aren't simulated; they stay in their states
+    with zero rewards and gradients.
+    """
+
+    # Jacobian stacks and adjoints are in the block's dtype, next states and rewards are kept in float64 for finite
+    # differences
+    dtype = block_dtype(agent.cfg)
+    np_dtype = numpy_dtype(dtype)
+
+    class MjBatchBlock(autograd.Function):
+
+        @staticmethod
+        def forward(ctx, states, actions, active):
+
+            # Advance simulations of running episodes, keeping snapshots for backward
+            ctx.active = active.numpy().copy()
+            next_states, rewards, ctx.snapshots = \
+                vector_agent.step(states.detach().numpy(), actions.detach().numpy(), ctx.active)
+            ctx.next_states = next_states
+            ctx.rewards = rewards
+            ctx.jacobians = None
+
+            return torch.as_tensor(next_states, dtype=dtype), torch.as_tensor(rewards, dtype=dtype)
+
+        @staticmethod
+        def backward(ctx, grad_next_states, grad_rewards):
+
+            # Calculate jacobians of all running episodes at once; they're calculated once per graph, so repeated
+            # backward passes through it (retain_graph) reuse them
+            if ctx.jacobians is None:
+                ctx.jacobians = [jacobians.astype(np_dtype, copy=False) for jacobians in
+                                 vector_agent.gradients(ctx.snapshots, ctx.next_states, ctx.rewards)]
+
+            # Weight copies of the running episodes' jacobians like the fused block does
+            episodes = np.flatnonzero(ctx.active)
+            dsds, dsda, drds, drda = [jacobians[episodes] for jacobians in ctx.jacobians]
+            snapshot_step_idx = np.array([ctx.snapshots[episode_idx].step_idx.value for episode_idx in episodes])
+            weight_jacobian_stack(agent, episodes, snapshot_step_idx, dsda, drds, drda)
+
+            grad_next_states = grad_next_states.detach().numpy()[episodes]
+            grad_rewards = grad_rewards.detach().numpy()[episodes]
+            grad_states = np.zeros((len(ctx.active), dsds.shape[2]), dtype=np_dtype)
+            grad_actions = np.zeros((len(ctx.active), dsda.shape[2]), dtype=np_dtype)
+            grad_states[episodes] = np.einsum("bs,bsz->bz", grad_next_states, dsds) + grad_rewards[:, None] * drds
+            grad_actions[episodes] = np.einsum("bs,bsa->ba", grad_next_states, dsda) + grad_rewards[:, None] * drda
+
+            return torch.from_numpy(grad_states), torch.from_numpy(grad_actions), None
 
+    return MjBatchBlock
@@ -19,8 +19,8 @@ class DynamicsModel(torch.nn.Module):
 
     def forward(self, state, action):
 
-        # Predict next state given current state and action
-        next_state = self.net(torch.cat([state, action]))
+        # Predict next state given current state and action (or next states [B, S] of a batch [B, S] / [B, A])
+        next_state = self.net(torch.cat([state, action], dim=-1))
 
         return next_state
 
@@ -9,6 +9,46 @@ from torch.nn.parameter import Parameter
 from optimizer import Optimizer
 
 
+def discounted_returns(rewards, gamma):
+    """
+    Discounted returns R_t = r_t + gamma * R_t+1 of rewards [B, T], scanned backwards over steps for all episodes at
+    once, in O(B*T) (dividing a cumulative sum by gamma^t would underflow to 0 / 0 over long horizons)
+    """
+    rewards = rewards.double()
+    returns = torch.empty_like(rewards)
+    running = torch.zeros(rewards.shape[0], dtype=torch.float64)
+    for step_idx in reversed(range(rewards.shape[1])):
+        running = rewards[:, step_idx] + gamma * running
+        returns[:, step_idx] = running
+    return returns
+
+
+class BatchLossTerms(object):
+    """
+    Everything the loss functions need from a batch, calculated once with tensor ops on [B, T]: losses with invalid
+    steps (after an episode terminated) zeroed, loss of each episode, discounted returns, and advantages with the
+    per-step baseline of valid episodes removed
+    """
+
+    def __init__(self, batch_loss, mask, gamma, eps):
+
+        # Steps that weren't simulated used to be marked with NaNs
+        if mask is None:
+            mask = ~torch.isnan(batch_loss)
+        self.mask = mask
+
+        self.loss = torch.where(mask, batch_loss, torch.zeros((), dtype=batch_loss.dtype))
+        self.episode_loss = torch.sum(self.loss, dim=1)
+        self.returns = discounted_returns(-self.loss.detach(), gamma)
+
+        # Remove baseline, using only valid episodes at each step
+        count = mask.sum(dim=0)
+        mean = torch.sum(self.returns * mask, dim=0) / count.clamp(min=1)
+        deviation = (self.returns - mean) * mask
+        sd = torch.sqrt(torch.sum(deviation ** 2, dim=0) / (count - 1).clamp(min=1))
+        self.advantages = deviation / (sd + eps)
+
+
 class BaseStrategy(ABC, nn.Module):
 
     def __init__(self, cfg, agent, reinforce_loss_weight=1.0,
@@ -57,13 +97,58 @@ class BaseStrategy(ABC, nn.Module):
         self.episode_idx = agent.get_episode_idx()
 
     @abstractmethod
-    def optimize(self, batch_loss):
+    def optimize(self, batch_loss, mask=None):
+        """
+        :param batch_loss: torch.Tensor [B, T] of losses (negative rewards)
+        :param mask: torch.Tensor [B, T] of bools, True for steps that were simulated
+        """
         pass
 
     @abstractmethod
     def forward(self, state):
         pass
 
+    def batch_forward(self, states):
+        """
+        Actions for all episodes of a batch at the current step; strategies that can sample the whole batch at once
+        override this, otherwise forward is called for each episode
+        :param states: torch.Tensor [B, S]
+        :return: torch.Tensor [B, A]
+        """
+        actions = []
+        for episode_idx, state in enumerate(states):
+            # Episode index is one-based
+            self.episode_idx.set(episode_idx + 1)
+            actions.append(self.forward(state))
+        return torch.stack(actions)
+
+    @property
+    def has_batch_mean(self):
+        """Whether batch_mean can be used, i.e. the mean is a network of the state"""
+        return isinstance(getattr(self, "mean", None), nn.Module)
+
+    def batch_mean(self, states):
+        """
+        Deterministic actions of a closed-loop policy (MODEL.POLICY.NETWORK) for any number of states, without sampling
+        or recording them, e.g. for imagined rollouts on a learned dynamics model
+        :param states: torch.Tensor [B, S]
+        :return: torch.Tensor [B, A]
+        """
+        return self.clamp_action(self.mean(states))
+
+    def truncated_backward(self, window_loss):
+        """
+        Backpropagate the losses of one truncated backpropagation window (MODEL.TRUNCATED_BPTT) right away, so that the
+        graph and snapshots of the window can be freed. Gradients are accumulated until optimize is called.
+        :param window_loss: torch.Tensor of losses (negative rewards) of the window, of one or all episodes of the batch
+        """
+        if not window_loss.requires_grad:
+            return
+
+        # Objective loss is a sum of batch averaged losses, so each window's share of it can be backpropagated
+        # separately (see mujoco.build.build_agent for which policies support it)
+        (window_loss.sum() / self.batch_size).backward()
+
     @staticmethod
     def clip(x, mean, limit):
         xmin = mean - limit
@@ -126,128 +211,54 @@ class BaseStrategy(ABC, nn.Module):
 
     # Initialise mean / sd or get dim from initial values
 
-    def calculate_reinforce_loss(self, batch_loss, stepwise_loss=False):
-        # Initialise a tensor for returns
-        returns = torch.empty(batch_loss.shape, dtype=torch.float64)
+    def calculate_reinforce_loss(self, terms, stepwise_loss=False):
 
-        # Calculate returns
-        for episode_idx, episode_loss in enumerate(batch_loss):
-            R = 0
-            for step_idx in range(1, len(episode_loss)+1):
-                R = -episode_loss[-step_idx] + self.gamma*R
-                returns[episode_idx, -step_idx] = R
-
-        # Remove baseline
-        advantages = ((returns - returns.mean(dim=0)) / (returns.std(dim=0) + self.eps)).detach()
+        # Log probabilities aren't defined for steps after an episode terminated
+        weighted_log_prob = torch.where(terms.mask, -terms.advantages * self.log_prob,
+                                        torch.zeros((), dtype=terms.advantages.dtype))
 
         # Return REINFORCE loss
-        #reinforce_loss = torch.mean((-advantages * self.log_prob).sum(dim=1))
-        #reinforce_loss = torch.sum((-advantages * self.log_prob))
-        avg_stepwise_loss = (-advantages * self.log_prob).mean(dim=0)
         if stepwise_loss:
-            return avg_stepwise_loss
+            return weighted_log_prob.mean(dim=0)
         else:
-            #return torch.sum(avg_stepwise_loss)
-            return torch.mean(torch.sum((-advantages * self.log_prob), dim=1))
-
-    def calculate_objective_loss(self, batch_loss, stepwise_loss=False):
-        #batch_loss = (batch_loss.mean(dim=0) - batch_loss) / (batch_loss.std(dim=0) + self.eps)
-        #batch_loss = batch_loss.mean() - batch_loss
-
-        # Initialise a tensor for returns
-        #ret = torch.empty(batch_loss.shape, dtype=torch.float64)
-        ## Calculate returns
-        #for episode_idx, episode_loss in enumerate(batch_loss):
-        #    R = torch.zeros(1, dtype=torch.float64)
-        #    for step_idx in range(1, len(episode_loss)+1):
-        #        R = -episode_loss[-step_idx] + self.gamma*R.detach()
-        #        ret[episode_idx, -step_idx] = R
-        #avg_stepwise_loss = torch.mean(-ret, dim=0)
-        #advantages = ret - ret.mean(dim=0)
-
-        #means = torch.mean(batch_loss, dim=0)
-        #idxs = (batch_loss > torch.mean(batch_loss)).detach()
-        #idxs = sums < np.mean(sums)
-
-        #advantages = torch.zeros((1, batch_loss.shape[1]))
-        #advantages = []
-        #idxs = batch_loss < torch.mean(batch_loss)
-        #for i in range(batch_loss.shape[1]):
-        #    avg = torch.mean(batch_loss[:,i]).detach().numpy()
-        #    idxs = batch_loss[:,i].detach().numpy() < avg
-        #    advantages[0,i] = torch.mean(batch_loss[idxs,i], dim=0)
-        #    if torch.any(idxs[:,i]):
-        #        advantages.append(torch.mean(batch_loss[idxs[:,i],i], dim=0))
-
-        #batch_loss = (batch_loss - batch_loss.mean(dim=1).detach()) / (batch_loss.std(dim=1).detach() + self.eps)
-        #batch_loss = (batch_loss - batch_loss.mean(dim=0).detach()) / (batch_loss.std(dim=0).detach() + self.eps)
-        #batch_loss = (batch_loss - batch_loss.mean(dim=0).detach())
-
-        #fvals = torch.empty(batch_loss.shape[0])
-        #for episode_idx, episode_loss in enumerate(batch_loss):
-        #    nans = torch.isnan(episode_loss)
-        #    fvals[episode_idx] = torch.sum(episode_loss[nans == False])
-
-        nans = torch.isnan(batch_loss)
-        batch_loss[nans] = 0
+            return torch.mean(torch.sum(weighted_log_prob, dim=1))
 
+    def calculate_objective_loss(self, terms, stepwise_loss=False):
         if stepwise_loss:
-            return torch.mean(batch_loss, dim=0)
+            return torch.mean(terms.loss, dim=0)
         else:
-            #return torch.sum(batch_loss[0][100])
-            #return torch.sum(advantages[advantages<0])
-            #idxs = torch.isnan(batch_loss) == False
-            #return torch.sum(batch_loss[idxs])
-            #return torch.mean(fvals)
-            #return torch.mean(torch.sum(batch_loss, dim=1))
-
-            return torch.sum(torch.mean(batch_loss, dim=0))
-            #return batch_loss[0][-1]
-            #return torch.sum(torch.stack(advantages))
+            return torch.sum(torch.mean(terms.loss, dim=0))
 
-        # Remove baseline
-        #advantages = ((ret - ret.mean(dim=0)) / (ret.std(dim=0) + self.eps))
-        #advantages = ret
-
-        # Return REINFORCE loss
-        #avg_stepwise_loss = -advantages.mean(dim=0)
-        #if stepwise_loss:
-        #    return avg_stepwise_loss
-        #else:
-        #    return torch.sum(avg_stepwise_loss)
-
-    def R_loss(self, batch_loss):
+    def R_loss(self, terms):
 
         # Get objective loss
-        objective_loss = self.calculate_objective_loss(batch_loss)
+        objective_loss = self.calculate_objective_loss(terms)
 
-        return objective_loss, {"objective_loss": float(torch.mean(torch.sum(batch_loss, dim=1)).detach().numpy()),
+        return objective_loss, {"objective_loss": float(terms.episode_loss.mean().detach().numpy()),
                                 "total_loss": float(objective_loss.detach().numpy())}
-                                #"total_loss": batch_loss.detach().numpy()}
-
 
-    def PR_loss(self, batch_loss):
+    def PR_loss(self, terms):
 
         # Get REINFORCE loss
-        reinforce_loss = self.calculate_reinforce_loss(batch_loss)
+        reinforce_loss = self.calculate_reinforce_loss(terms)
 
         # Get objective loss
-        objective_loss = self.calculate_objective_loss(batch_loss)
+        objective_loss = self.calculate_objective_loss(terms)
 
         # Return a sum of the objective loss and REINFORCE loss
         loss = objective_loss + self.reinforce_loss_weight*reinforce_loss
 
-        return loss, {"objective_loss": float(torch.mean(torch.sum(batch_loss, dim=1)).detach().numpy()),
+        return loss, {"objective_loss": float(terms.episode_loss.mean().detach().numpy()),
                       "reinforce_loss": float(reinforce_loss.detach().numpy()),
                       "total_loss": float(loss.detach().numpy())}
 
-    def IR_loss(self, batch_loss):
+    def IR_loss(self, terms):
 
         # Get REINFORCE loss
-        reinforce_loss = self.calculate_reinforce_loss(batch_loss)
+        reinforce_loss = self.calculate_reinforce_loss(terms)
 
         # Get objective loss
-        objective_loss = self.calculate_objective_loss(batch_loss)
+        objective_loss = self.calculate_objective_loss(terms)
 
         # Return an interpolated mix of the objective loss and REINFORCE loss
         clamped_sd = self.clamp_sd(self.sd)
@@ -260,13 +271,13 @@ class BaseStrategy(ABC, nn.Module):
                       "reinforce_loss": [reinforce_loss.detach().numpy()],
                       "total_loss": [loss.detach().numpy()]}
 
-    def SIR_loss(self, batch_loss):
+    def SIR_loss(self, terms):
 
         # Get REINFORCE loss
-        reinforce_loss = self.calculate_reinforce_loss(batch_loss, stepwise_loss=True)
+        reinforce_loss = self.calculate_reinforce_loss(terms, stepwise_loss=True)
 
         # Get objective loss
-        objective_loss = self.calculate_objective_loss(batch_loss, stepwise_loss=True)
+        objective_loss = self.calculate_objective_loss(terms, stepwise_loss=True)
 
         # Return an interpolated mix of the objective loss and REINFORCE loss
         clamped_sd = self.clamp_sd(self.sd)
@@ -279,13 +290,13 @@ class BaseStrategy(ABC, nn.Module):
                       "reinforce_loss": [reinforce_loss.detach().numpy()],
                       "total_loss": [loss.detach().numpy()]}
 
-    def H_loss(self, batch_loss):
+    def H_loss(self, terms):
 
         # Get REINFORCE loss
-        reinforce_loss = self.calculate_reinforce_loss(batch_loss)
+        reinforce_loss = self.calculate_reinforce_loss(terms)
 
         # Get objective loss
-        objective_loss = torch.sum(batch_loss, dim=1)
+        objective_loss = terms.episode_loss
 
         # Get idx of best sampled action values
         best_idx = objective_loss.argmin()
@@ -308,13 +319,20 @@ class BaseStrategy(ABC, nn.Module):
         # Return a generator that behaves like self.named_parameters()
         return ((x, params[x]) for x in params)
 
-    def standard_optimize(self, batch_loss):
+    def standard_optimize(self, batch_loss, mask=None):
 
         # Get appropriate loss
-        loss, stats = self.loss_functions[self.method](batch_loss)
-
-        self.optimizer.zero_grad()
-        loss.backward()
+        terms = BatchLossTerms(batch_loss, mask, self.gamma, self.eps)
+        loss, stats = self.loss_functions[self.method](terms)
+
+        # With truncated backpropagation objective loss gradients have been accumulated during the rollout, see
+        # truncated_backward, and batch_loss doesn't carry a graph anymore
+        if self.cfg.MODEL.TRUNCATED_BPTT > 0:
+            if loss.requires_grad:
+                loss.backward()
+        else:
+            self.optimizer.zero_grad()
+            loss.backward()
         #nn.utils.clip_grad_norm_(self.parameters(), 0.1)
         if self.cfg.SOLVER.OPTIMIZER == "sgd":
             nn.utils.clip_grad_value_(self.parameters(), 1)
@@ -339,6 +357,7 @@ class BaseStrategy(ABC, nn.Module):
         #            param.grad = (param.grad * gradient_clip) / (total_norm_sqr ** 0.5)
                     #pass
         self.optimizer.step()
+        self.optimizer.zero_grad()
 
         #print("ll0 weight: {} {}".format(self.mean._layers["linear_layer_0"].weight_std.min(),
         #                        self.mean._layers["linear_layer_0"].weight_std.max()))
@@ -363,10 +382,11 @@ class BaseStrategy(ABC, nn.Module):
 
         return stats
 
-    def H_optimize(self, batch_loss):
+    def H_optimize(self, batch_loss, mask=None):
 
         # Get appropriate loss
-        loss, best_objective_loss, stats = self.loss_functions[self.method](batch_loss)
+        terms = BatchLossTerms(batch_loss, mask, self.gamma, self.eps)
+        loss, best_objective_loss, stats = self.loss_functions[self.method](terms)
 
         # Adapt the mean
         self.optimizer["mean"].zero_grad()
@@ -424,14 +444,52 @@ class VariationalOptimization(BaseStrategy):
         # We need log probabilities for calculating REINFORCE loss
         self.log_prob = torch.empty(self.batch_size, self.horizon, dtype=torch.float64)
 
+        # Sampled open-loop actions of a whole batch are calculated at once from noise [A, T, B] that is drawn when the
+        # batch starts, and their log probabilities when optimizing; forward only indexes them
+        self.vectorized = not self.cfg.MODEL.POLICY.NETWORK and self.method != "H" and self.batch_size > 1
+        self.noise = None
+        self.actions = None
+
+    def sample_batch(self):
+        """Draw noise for the whole batch, and reparameterize actions [A, T, B] with it"""
+        self.noise = torch.randn(self.action_dim, self.horizon, self.batch_size, dtype=self.sd.dtype)
+
+        # Windows of a rollout that are backpropagated separately (MODEL.TRUNCATED_BPTT) can't share one graph, so
+        # then actions are reparameterized step by step in batch_action
+        if self.cfg.MODEL.TRUNCATED_BPTT == 0:
+            self.actions = self.mean.unsqueeze(2) + self.clamp_sd(self.sd).unsqueeze(2) * self.noise
+
+    def batch_action(self):
+        """Action of the current step and episode from the batch's noise"""
+        if self.noise is None or (self.step_idx == 0 and self.episode_idx == 1):
+            self.sample_batch()
+
+        if self.cfg.MODEL.TRUNCATED_BPTT == 0:
+            return self.actions[:, self.step_idx, self.episode_idx-1]
+        else:
+            return self.mean[:, self.step_idx] + \
+                   self.clamp_sd(self.sd[:, self.step_idx]) * self.noise[:, self.step_idx, self.episode_idx-1]
+
+    def batch_log_prob(self):
+        """Actions and their log probabilities for the whole batch in one vectorized call"""
+        mean = self.mean.unsqueeze(2)
+        clamped_sd = self.clamp_sd(self.sd).unsqueeze(2)
+        actions = (mean + clamped_sd * self.noise).detach()
+        self.clamped_action = actions.numpy()
+        self.log_prob = torch.distributions.Normal(mean, clamped_sd).log_prob(actions).sum(dim=0).t()
+
     def forward(self, state):
 
+        # Sampled open-loop actions are calculated for the whole batch at once
+        if self.vectorized and self.training:
+            return self.batch_action()
+
         # Get clamped sd
         clamped_sd = self.clamp_sd(self.sd[:, self.step_idx])
 
         # Get mean of action value
         if self.cfg.MODEL.POLICY.NETWORK:
-            mean = self.mean(state).double()
+            mean = self.mean(state).to(self.sd.dtype)
         else:
             mean = self.mean[:, self.step_idx]
 
@@ -463,8 +521,34 @@ class VariationalOptimization(BaseStrategy):
 
         return action
 
-    def optimize(self, batch_loss):
-        return self.optimize_functions.get(self.method, self.standard_optimize)(batch_loss)
+    def batch_forward(self, states):
+
+        # The first episode of "H" takes the best actions, and a batch of one takes the mean, so those are stepped
+        # episode by episode
+        if not self.training or self.method == "H" or self.batch_size == 1:
+            return super(VariationalOptimization, self).batch_forward(states)
+
+        # Sampled open-loop actions are indexed from the batch's noise like in batch_action
+        if self.vectorized:
+            if self.noise is None or self.step_idx == 0:
+                self.sample_batch()
+            if self.cfg.MODEL.TRUNCATED_BPTT == 0:
+                return self.actions[:, self.step_idx].t()
+            else:
+                return (self.mean[:, self.step_idx].unsqueeze(1) +
+                        self.clamp_sd(self.sd[:, self.step_idx]).unsqueeze(1) * self.noise[:, self.step_idx]).t()
+
+        # Closed-loop actions are sampled for all states at once, and recorded like in forward
+        dist = torch.distributions.Normal(self.mean(states).to(self.sd.dtype), self.clamp_sd(self.sd[:, self.step_idx]))
+        actions = dist.rsample()
+        self.clamped_action[:, self.step_idx, :] = actions.detach().numpy().T
+        self.log_prob[:, self.step_idx] = dist.log_prob(actions.detach()).sum(dim=1)
+        return actions
+
+    def optimize(self, batch_loss, mask=None):
+        if self.vectorized and self.noise is not None:
+            self.batch_log_prob()
+        return self.optimize_functions.get(self.method, self.standard_optimize)(batch_loss, mask)
 
 
 class CMAES(BaseStrategy):
@@ -489,22 +573,34 @@ class CMAES(BaseStrategy):
         self.optimizer = cma.CMAEvolutionStrategy(self.mean, self.cfg.MODEL.POLICY.INITIAL_SD, inopts=cmaes_options)
         self.actions = []
 
+    def sample_batch(self):
+        self.orig_actions = self.optimizer.ask()
+        self.actions = torch.empty(self.action_dim, self.horizon, self.batch_size, dtype=torch.float64)
+        for ep_idx, ep_actions in enumerate(self.orig_actions):
+            self.actions[:, :, ep_idx] = torch.from_numpy(np.reshape(ep_actions, (self.action_dim, self.horizon)))
+
     def forward(self, state):
 
         # If we've hit the end of minibatch we need to sample more actions
         if self.step_idx == 0 and self.episode_idx - 1 == 0 and self.training:
-            self.orig_actions = self.optimizer.ask()
-            self.actions = torch.empty(self.action_dim, self.horizon, self.batch_size, dtype=torch.float64)
-            for ep_idx, ep_actions in enumerate(self.orig_actions):
-                self.actions[:, :, ep_idx] = torch.from_numpy(np.reshape(ep_actions, (self.action_dim, self.horizon)))
+            self.sample_batch()
 
         # Get action
         action = self.actions[:, self.step_idx, self.episode_idx-1]
 
         return action
 
-    def optimize(self, batch_loss):
-        loss = batch_loss.sum(axis=1)
+    def batch_forward(self, states):
+        if not self.training:
+            return super(CMAES, self).batch_forward(states)
+
+        # Actions of every episode are sampled when the batch starts
+        if self.step_idx == 0:
+            self.sample_batch()
+        return self.actions[:, self.step_idx].t()
+
+    def optimize(self, batch_loss, mask=None):
+        loss = BatchLossTerms(batch_loss, mask, self.gamma, self.eps).episode_loss
         self.optimizer.tell(self.orig_actions, loss.detach().numpy())
         return {"objective_loss": float(loss.detach().numpy().mean()), "total_loss": float(loss.detach().numpy().mean())}
 
@@ -533,15 +629,18 @@ class Perttu(BaseStrategy):
                       nBatch=self.cfg.MODEL.BATCH_SIZE,
                       solver=self.cfg.SOLVER.OPTIMIZER)
 
+    def sample_batch(self, **kwargs):
+        samples = self.optimizer.ask(**kwargs)
+        self.actions = torch.empty(self.action_dim, self.horizon, self.batch_size)
+        for ep_idx, ep_actions in enumerate(samples):
+            self.actions[:, :, ep_idx] = torch.reshape(ep_actions, (self.action_dim, self.horizon))
+
     def forward(self, state):
 
         # If we've hit the end of minibatch we need to sample more actions
         if self.training:
             if self.step_idx == 0 and self.episode_idx-1 == 0:
-                samples = self.optimizer.ask()
-                self.actions = torch.empty(self.action_dim, self.horizon, self.batch_size)
-                for ep_idx, ep_actions in enumerate(samples):
-                    self.actions[:, :, ep_idx] = torch.reshape(ep_actions, (self.action_dim, self.horizon))
+                self.sample_batch()
 
             # Get action
             action = self.actions[:, self.step_idx, self.episode_idx-1]
@@ -549,17 +648,27 @@ class Perttu(BaseStrategy):
         else:
             if self.method != "CMA-ES":
                 if self.step_idx == 0:
-                    samples = self.optimizer.ask(testing=~self.training)
-                    self.actions = torch.empty(self.action_dim, self.horizon, self.batch_size)
-                    for ep_idx, ep_actions in enumerate(samples):
-                        self.actions[:, :, ep_idx] = torch.reshape(ep_actions, (self.action_dim, self.horizon))
+                    self.sample_batch(testing=~self.training)
 
             # Get action
             action = self.actions[:, self.step_idx, 0]
 
         return action.double()
 
-    def optimize(self, batch_loss):
+    def batch_forward(self, states):
+        if not self.training:
+            return super(Perttu, self).batch_forward(states)
+
+        # Actions of every episode are sampled when the batch starts
+        if self.step_idx == 0:
+            self.sample_batch()
+        return self.actions[:, self.step_idx].t().double()
+
+    def optimize(self, batch_loss, mask=None):
+
+        # The optimizer expects steps that weren't simulated to be marked with NaNs
+        if mask is not None:
+            batch_loss = batch_loss.masked_fill(~mask, np.nan)
         loss, meanFval = self.optimizer.tell(batch_loss)
         return {"objective_loss": float(meanFval), "total_loss": float(loss)}
 
@@ -47,6 +47,6 @@ class TrajOpt(BasePolicy):
     def episode_callback(self):
         self.step_index = 0
 
-    def optimize(self, batch_loss):
-        return self.strategy.optimize(batch_loss)
+    def optimize(self, batch_loss, mask=None):
+        return self.strategy.optimize(batch_loss, mask)
 
@@ -42,6 +42,65 @@ _C.MODEL.NSTEPS_FOR_BACKWARD = 1
 _C.MODEL.FRAME_SKIP = 1
 _C.MODEL.TIMESTEP = 0.0
 _C.MODEL.RANDOM_SEED = 0
+_C.MODEL.TRAJECTORY_BLOCK = False  # roll out open-loop policies with one autograd block per episode
+_C.MODEL.BATCH_BLOCK = False  # step all episodes of a batch together in a vector of simulations
+_C.MODEL.PRECISION = "mixed"  # "mixed" (single precision policy net, double elsewhere), "single", or "double"
+_C.MODEL.TRUNCATED_BPTT = 0  # backpropagate every this many steps during rollouts, 0 backpropagates whole batches
+
+# ---------------------------------------------------------------------------- #
+# __Gradient Configs
+# ---------------------------------------------------------------------------- #
+_C.MODEL.GRADIENTS = CN()
+# "step" steps the whole env for every finite-difference perturbation, "skip" chains substep jacobians evaluated with
+# mj_forwardSkip (falls back to "step" for envs without tensor_reward, closed-loop policies, quaternions, or RK4),
+# "sparse" perturbs columns that can't affect the same states in one simulation (same fallbacks, and NSTEPS == 1)
+_C.MODEL.GRADIENTS.ENGINE = "step"
+# Sparsity pattern for the "sparse" engine: "tree" declares it from the kinematic tree, "detect" takes it from dense
+# finite differences calculated every SPARSITY_REFRESH steps
+_C.MODEL.GRADIENTS.SPARSITY = "tree"
+_C.MODEL.GRADIENTS.SPARSITY_REFRESH = 100
+# Reward gradients from autograd through the env's tensor_reward, chained with the dynamics jacobians, so the "step"
+# engine only simulates next states (envs without tensor_reward, closed-loop policies, and NSTEPS > 1 use FD rewards)
+_C.MODEL.GRADIENTS.TENSOR_REWARD = False
+# Reuse jacobians with Broyden rank-one updates, and calculate them with finite differences only every BROYDEN_REFRESH
+# steps (0 calculates them at every step), or when state and action moved further than BROYDEN_MAX_STEP, or when the
+# previous jacobians mispredict the transition by more than BROYDEN_MAX_ERROR (relative error)
+_C.MODEL.GRADIENTS.BROYDEN_REFRESH = 0
+_C.MODEL.GRADIENTS.BROYDEN_MAX_STEP = 1.0
+_C.MODEL.GRADIENTS.BROYDEN_MAX_ERROR = 0.1
+# Estimate jacobians from the previous step's ones and finite differences along SKETCH_DIRECTIONS random directions
+# (0 perturbs every column instead), with full finite differences every SKETCH_AUDIT steps to correct the estimate and
+# report its error; open-loop policies, NSTEPS_FOR_BACKWARD == 1, and models without quaternions only
+_C.MODEL.GRADIENTS.SKETCH_DIRECTIONS = 0
+_C.MODEL.GRADIENTS.SKETCH_AUDIT = 100
+# Fit time-varying linear dynamics and rewards to the transitions of all episodes of a batch at each step, instead of
+# finite differences; each fit is regularised towards the previous batch's one (REGRESSION_PRIOR weighs the prior
+# against the average variance of states and actions), and steps the batch can't determine or whose relative residual
+# exceeds REGRESSION_MAX_RESIDUAL fall back to finite differences. Backward has to be called after the whole batch
+_C.MODEL.GRADIENTS.REGRESSION = False
+_C.MODEL.GRADIENTS.REGRESSION_PRIOR = 1.0
+_C.MODEL.GRADIENTS.REGRESSION_MAX_RESIDUAL = 0.1
+# Dynamics jacobians from autograd through a forward dynamics model trained with model.engine.dynamics_model_trainer,
+# given as the path of its weights ("" disables); the forward pass is still simulated. Finite differences recalibrate
+# them every LEARNED_DYNAMICS_CALIBRATION steps, and their discrepancy is reported. Needs the env's tensor_reward,
+# open-loop policies, and NSTEPS_FOR_BACKWARD == 1 (finite differences are used otherwise)
+_C.MODEL.GRADIENTS.LEARNED_DYNAMICS = ""
+_C.MODEL.GRADIENTS.LEARNED_DYNAMICS_CALIBRATION = 100
+# Hand every snapshot to the worker pool (MUJOCO.POOL_SIZE) as soon as it's taken, so jacobians are calculated while
+# the rollout continues; open-loop policies only
+_C.MODEL.GRADIENTS.SPECULATIVE = False
+
+# Dyna / MBPO style training (main.py --mode imagined): a forward dynamics model is trained on transitions of real
+# rollouts, and the policy is updated with autograd through batches of short imagined rollouts on it, so real rollouts
+# only collect data and validate. Needs a closed-loop policy (MODEL.POLICY.NETWORK) and the env's batch_reward
+_C.MODEL.IMAGINED = CN()
+_C.MODEL.IMAGINED.REAL_EPISODES = 1  # real episodes per epoch
+_C.MODEL.IMAGINED.BUFFER_SIZE = 100000  # real transitions kept for training the dynamics model
+_C.MODEL.IMAGINED.MODEL_UPDATES = 20  # dynamics model updates per epoch
+_C.MODEL.IMAGINED.MODEL_BATCH_SIZE = 256  # transitions per dynamics model update
+_C.MODEL.IMAGINED.POLICY_UPDATES = 10  # policy updates per epoch, each from one batch of imagined rollouts
+_C.MODEL.IMAGINED.ROLLOUTS = 1000  # imagined rollouts per batch, started from states of the buffer
+_C.MODEL.IMAGINED.HORIZON = 5  # steps of an imagined rollout
 
 # ---------------------------------------------------------------------------- #
 # Model Configs
@@ -51,7 +110,27 @@ _C.MUJOCO.ENV = 'InvertedPendulumEnv'
 _C.MUJOCO.ASSETS_PATH = "./mujoco/assets/"
 _C.MUJOCO.REWARD_SCALE = 1
 _C.MUJOCO.CLIP_ACTIONS = True
-_C.MUJOCO.POOL_SIZE = CN()
+# "mujoco_py", or "mujoco" for the official bindings. MODEL.GRADIENTS.ENGINE applies to both; with "mujoco" the "skip"
+# engine takes substep jacobians from mjd_transitionFD, and still falls back to "step" for RK4, envs without
+# tensor_reward, closed-loop policies, and quaternions
+_C.MUJOCO.BACKEND = "mujoco_py"
+_C.MUJOCO.POOL_SIZE = 0  # number of worker processes for finite differences, 0 computes them serially
+_C.MUJOCO.VECTOR_WORKERS = 0  # number of worker processes for the batch block simulations, 0 runs them in-process
+_C.MUJOCO.SNAPSHOT_BUFFER_SIZE = 0  # rows in the snapshot ring buffer, 0 fits a whole batch of episodes
+_C.MUJOCO.SNAPSHOT_CHECKPOINT_PERIOD = 1  # keep a snapshot every this many steps, re-simulate the others in backward
+
+# Constraint solver settings for nominal rollouts
+_C.MUJOCO.ROLLOUT_SOLVER = CN()
+_C.MUJOCO.ROLLOUT_SOLVER.ITERATIONS = 0  # 0 keeps the model's own setting
+_C.MUJOCO.ROLLOUT_SOLVER.TOLERANCE = 0.0  # zero so solvers don't stop early
+_C.MUJOCO.ROLLOUT_SOLVER.WARMSTART = True
+
+# Constraint solver settings for finite-difference perturbations (warm-started from the center point's snapshot)
+_C.MUJOCO.FD_SOLVER = CN()
+_C.MUJOCO.FD_SOLVER.ITERATIONS = 0  # 0 keeps the model's own setting
+_C.MUJOCO.FD_SOLVER.TOLERANCE = 0.0
+_C.MUJOCO.FD_SOLVER.WARMSTART = True
+_C.MUJOCO.FD_SOLVER.WARMUP = 3  # extra solver iterations at the center point before substep jacobians
 
 # ---------------------------------------------------------------------------- #
 # Experience Replay
@@ -136,3 +136,6 @@ def do_training(
 
     # Save model
     torch.save(dynamics_model.state_dict(), os.path.join(output_weights_dir, "final_weights.pt"))
+
+    # Shut down the agent's worker processes
+    agent.close()
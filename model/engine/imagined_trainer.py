@@ -0,0 +1,226 @@
+import torch
+import numpy as np
+import os
+
+from model.engine.tester import do_testing
+import utils.logger as lg
+from utils.visdom_plots import VisdomLogger
+from mujoco import build_agent
+from model import build_model
+from model.blocks.policy.dynamics import DynamicsModel
+
+
+class TransitionBuffer(object):
+    """Ring buffer of transitions from real rollouts"""
+
+    def __init__(self, size, state_size, action_size, dtype):
+        self.size = size
+        self.states = torch.empty(size, state_size, dtype=dtype)
+        self.actions = torch.empty(size, action_size, dtype=dtype)
+        self.next_states = torch.empty(size, state_size, dtype=dtype)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def add(self, states, actions, next_states):
+        """
+        :param states: torch.Tensor [N, S]
+        :param actions: torch.Tensor [N, A]
+        :param next_states: torch.Tensor [N, S]
+        """
+        idx = torch.arange(self.count, self.count + states.shape[0]) % self.size
+        self.states[idx] = states
+        self.actions[idx] = actions
+        self.next_states[idx] = next_states
+        self.count += states.shape[0]
+
+    def sample(self, n):
+        idx = torch.randint(len(self), (n,))
+        return self.states[idx], self.actions[idx], self.next_states[idx]
+
+
+def real_episode(cfg, model, agent):
+    """
+    Roll out one episode in the simulation with the policy; nothing is backpropagated, so no jacobians are calculated.
+    Actions are the policy's mean plus exploration noise of its sd, drawn here so that the policy's forward doesn't
+    sample or record them (its actions and log probabilities are only for its own training)
+    :return: states [T, S], actions [T, A], next states [T, S], and rewards [T]
+    """
+    policy_net = model.policy_net
+    states, actions, next_states, rewards = [], [], [], []
+    state = torch.tensor(agent.reset(), dtype=model.dtype)
+    with torch.no_grad():
+        for step_idx in range(cfg.MODEL.POLICY.MAX_HORIZON_STEPS):
+            mean = policy_net.batch_mean(state.to(model.policy_dtype)).to(model.dtype)
+            sd = policy_net.clamp_sd(policy_net.sd[:, step_idx]).to(model.dtype)
+            action = mean + sd * torch.randn_like(mean)
+            next_state, reward = model.mj_block(state, action)
+            states.append(state)
+            actions.append(action)
+            next_states.append(next_state)
+            rewards.append(reward)
+            state = next_state
+            if agent.is_done:
+                break
+    return torch.stack(states), torch.stack(actions), torch.stack(next_states), torch.cat(rewards)
+
+
+def prediction_error(dynamics_model, states, actions, next_states):
+    """Mean squared error of predicted next states"""
+    predicted = dynamics_model(states.float(), actions.float()).to(next_states.dtype)
+    return torch.pow(next_states - predicted, 2).mean()
+
+
+def imagined_loss(cfg, model, dynamics_model, agent, buffer):
+    """
+    Roll out the policy on the dynamics model from a batch of states of the buffer, all at once
+    :return: negative discounted reward of the imagined rollouts, averaged over the batch
+    """
+    states = buffer.sample(cfg.MODEL.IMAGINED.ROLLOUTS)[0]
+    rewards = []
+    for step_idx in range(cfg.MODEL.IMAGINED.HORIZON):
+        actions = model.policy_net.batch_mean(states.to(model.policy_dtype)).to(model.dtype)
+        next_states = dynamics_model(states.float(), actions.float()).to(model.dtype)
+        rewards.append(cfg.MODEL.POLICY.GAMMA ** step_idx *
+                       agent.unwrapped.batch_reward(states, actions, next_states))
+        states = next_states
+    return -torch.stack(rewards, dim=1).sum(dim=1).mean()
+
+
+def do_training(
+        cfg,
+        logger,
+        output_results_dir,
+        output_rec_dir,
+        output_weights_dir,
+        iter
+):
+    assert cfg.MODEL.POLICY.NETWORK, "Imagined rollouts need a closed-loop policy"
+    assert cfg.MODEL.POLICY.METHOD != "H", "Policy is updated with one optimizer"
+    assert cfg.MODEL.POLICY.ARCH == "VariationalOptimization", \
+        "Imagined rollouts backpropagate through the policy's mean, which only VariationalOptimization optimizes with " \
+        "gradients, not {}".format(cfg.MODEL.POLICY.ARCH)
+
+    if cfg.MODEL.RANDOM_SEED > 0:
+        np.random.seed(cfg.MODEL.RANDOM_SEED + iter)
+        torch.manual_seed(cfg.MODEL.RANDOM_SEED + iter)
+
+    # Build the agent
+    agent = build_agent(cfg)
+    assert hasattr(agent.unwrapped, "batch_reward"), "Imagined rollouts need the env's batch_reward"
+
+    # Build the model; the simulation is used only for collecting data and validating
+    model = build_model(cfg, agent)
+    device = torch.device(cfg.MODEL.DEVICE)
+    model.to(device)
+    assert model.policy_net.has_batch_mean, "Imagined rollouts need a policy whose mean is a network"
+
+    # Build a forward dynamics model, and a buffer of real transitions to train it with
+    dynamics_model = DynamicsModel(agent)
+    buffer = TransitionBuffer(cfg.MODEL.IMAGINED.BUFFER_SIZE, agent.observation_space.shape[0],
+                              agent.action_space.shape[0], model.dtype)
+
+    # Set mode to training (aside from policy output, matters for Dropout, BatchNorm, etc.)
+    model.train()
+    dynamics_model.train()
+
+    # Set up visdom
+    if cfg.LOG.PLOT.ENABLED:
+        visdom = VisdomLogger(cfg.LOG.PLOT.DISPLAY_PORT)
+        visdom.register_keys(["objective_loss", "imagined_loss", "model_error"])
+
+    # wrap screen recorder if testing mode is on
+    if cfg.LOG.TESTING.ENABLED:
+        if cfg.LOG.PLOT.ENABLED:
+            visdom.register_keys(['test_reward'])
+
+    # Collect losses here
+    output = {"epoch": [], "objective_loss": [], "imagined_loss": [], "model_error": []}
+
+    # Start training
+    for epoch_idx in range(cfg.MODEL.EPOCHS):
+
+        # Collect real transitions; the dynamics model is validated on them before it's trained with them
+        episode_losses = []
+        model_errors = []
+        for episode_idx in range(cfg.MODEL.IMAGINED.REAL_EPISODES):
+            states, actions, next_states, rewards = real_episode(cfg, model, agent)
+            episode_losses.append(-rewards.sum().item())
+            if len(buffer) > 0:
+                with torch.no_grad():
+                    model_errors.append(prediction_error(dynamics_model, states, actions, next_states).item())
+            buffer.add(states, actions, next_states)
+
+        # Train the dynamics model
+        for _ in range(cfg.MODEL.IMAGINED.MODEL_UPDATES):
+            loss = prediction_error(dynamics_model, *buffer.sample(cfg.MODEL.IMAGINED.MODEL_BATCH_SIZE))
+            dynamics_model.optimizer.zero_grad()
+            loss.backward()
+            dynamics_model.optimizer.step()
+
+        # Update the policy with plain autograd through imagined rollouts (the dynamics model's gradients are zeroed
+        # before it's trained)
+        imagined_losses = []
+        for _ in range(cfg.MODEL.IMAGINED.POLICY_UPDATES):
+            loss = imagined_loss(cfg, model, dynamics_model, agent, buffer)
+            model.policy_net.optimizer.zero_grad()
+            loss.backward()
+            model.policy_net.optimizer.step()
+            imagined_losses.append(loss.item())
+
+        output["objective_loss"].append(np.mean(episode_losses))
+        output["imagined_loss"].append(np.mean(imagined_losses))
+        output["model_error"].append(np.mean(model_errors) if model_errors else np.nan)
+        output["epoch"].append(epoch_idx)
+
+        if epoch_idx % cfg.LOG.PERIOD == 0:
+
+            if cfg.LOG.PLOT.ENABLED:
+                visdom.update({"objective_loss": output["objective_loss"][-1],
+                               "imagined_loss": output["imagined_loss"][-1],
+                               "model_error": output["model_error"][-1]})
+
+            logger.info("REWARD: \t\t{} (iteration {})".format(output["objective_loss"][-1], epoch_idx))
+            logger.info("IMAGINED: \t\t{}".format(output["imagined_loss"][-1]))
+            logger.info("MODEL ERROR: \t\t{}".format(output["model_error"][-1]))
+
+        if cfg.LOG.PLOT.ENABLED and epoch_idx % cfg.LOG.PLOT.ITER_PERIOD == 0:
+            visdom.do_plotting()
+
+        if epoch_idx % cfg.LOG.CHECKPOINT_PERIOD == 0:
+            torch.save(model.state_dict(),
+                       os.path.join(output_weights_dir, 'iter_{}.pth'.format(epoch_idx)))
+
+        if cfg.LOG.TESTING.ENABLED:
+            if epoch_idx % cfg.LOG.TESTING.ITER_PERIOD == 0:
+
+                # Record if required
+                agent.start_recording(os.path.join(output_rec_dir, "iter_{}_{}.mp4".format(iter, epoch_idx)))
+
+                test_rewards = []
+                for _ in range(cfg.LOG.TESTING.COUNT_PER_ITER):
+                    test_reward = do_testing(
+                        cfg,
+                        model,
+                        agent,
+                        # first_state=state_xr.get_item(),
+                    )
+                    test_rewards.append(test_reward)
+
+                # Set training mode on again
+                model.train()
+
+                # Close the recorder
+                agent.stop_recording()
+
+    # Save outputs into log folder
+    lg.save_dict_into_csv(output_results_dir, "output_{}".format(iter), output)
+
+    # Save the dynamics model, e.g. for MODEL.GRADIENTS.LEARNED_DYNAMICS
+    torch.save(dynamics_model.state_dict(), os.path.join(output_weights_dir, "dynamics_{}.pt".format(iter)))
+
+    # Shut down the batch block's simulations; the agent is closed by the caller
+    model.close()
+
+    return agent
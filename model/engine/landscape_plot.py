@@ -65,3 +65,6 @@ def visualise2d(agent, output_dir, iter):
     pp.imshow(loss.detach().numpy(), extent=[-1, 1, -1, 1], origin="lower", cmap="RdGy", alpha=0.5)
     pp.colorbar()
     pp.savefig(os.path.join(output_dir, "contour_{}.png".format(iter)))
+
+    # Shut down the batch block's simulations
+    model.close()
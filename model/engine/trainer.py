@@ -7,6 +7,7 @@ import utils.logger as lg
 from utils.visdom_plots import VisdomLogger
 from mujoco import build_agent
 from model import build_model
+from model.blocks.mujoco import reset_running_sums
 
 
 def do_training(
@@ -49,32 +50,84 @@ def do_training(
     # Collect losses here
     output = {"epoch": [], "objective_loss": [], "average_sd": []}
 
+    # Backpropagate every this many steps during rollouts (zero to backpropagate whole batches in optimize)
+    window = cfg.MODEL.TRUNCATED_BPTT
+
     # Start training
     for epoch_idx in range(cfg.MODEL.EPOCHS):
-        batch_loss = torch.empty(cfg.MODEL.BATCH_SIZE, cfg.MODEL.POLICY.MAX_HORIZON_STEPS, dtype=torch.float64)
-        batch_loss.fill_(np.nan)
-
-        for episode_idx in range(cfg.MODEL.BATCH_SIZE):
-
-            initial_state = torch.DoubleTensor(agent.reset())
-            states = []
-            states.append(initial_state)
-            #grads = np.zeros((cfg.MODEL.POLICY.MAX_HORIZON_STEPS, 120))
+        # Losses of the batch, and which steps were simulated (episodes can terminate early)
+        batch_loss = torch.zeros(cfg.MODEL.BATCH_SIZE, cfg.MODEL.POLICY.MAX_HORIZON_STEPS, dtype=torch.float64)
+        batch_mask = torch.zeros(cfg.MODEL.BATCH_SIZE, cfg.MODEL.POLICY.MAX_HORIZON_STEPS, dtype=torch.bool)
+
+        # Running sums of GRAD_WEIGHTS "prioritise" are accumulated by backward for each episode, which truncated
+        # backpropagation calls already during the rollout
+        reset_running_sums(agent)
+
+        # Step all episodes of the batch together
+        if cfg.MODEL.BATCH_BLOCK:
+            states = torch.from_numpy(model.vector_agent.reset()).to(model.dtype)
+            active = torch.ones(cfg.MODEL.BATCH_SIZE, dtype=torch.bool)
+            window_loss = []
             for step_idx in range(cfg.MODEL.POLICY.MAX_HORIZON_STEPS):
-                state, reward = model(states[step_idx])
-                batch_loss[episode_idx, step_idx] = -reward
-                #(-reward).backward(retain_graph=True)
-                #grads[step_idx, :] = model.policy_net.optimizer.mean.grad.detach().numpy()
-                #grads[step_idx, step_idx+1:40] = np.nan
-                #grads[step_idx, 40+step_idx+1:80] = np.nan
-                #grads[step_idx, 80+step_idx+1:] = np.nan
-                #model.policy_net.optimizer.optimizer.zero_grad()
-                states.append(state)
-                if agent.is_done:
+                agent.set_step_idx(step_idx)
+                states, rewards = model.forward_batch(states, active)
+                if window > 0:
+                    batch_loss[active, step_idx] = -rewards[active].detach()
+                    window_loss.append(-rewards[active])
+                else:
+                    batch_loss[active, step_idx] = -rewards[active]
+                batch_mask[active, step_idx] = True
+                # Finished episodes aren't simulated anymore
+                active &= torch.from_numpy(~model.vector_agent.is_done)
+                if not active.any():
                     break
-
-        agent.running_sum = 0
-        loss = model.policy_net.optimize(batch_loss)
+                if window > 0 and (step_idx + 1) % window == 0:
+                    model.policy_net.truncated_backward(torch.cat(window_loss))
+                    window_loss = []
+                    states = states.detach()
+            if window_loss:
+                model.policy_net.truncated_backward(torch.cat(window_loss))
+
+        else:
+            for episode_idx in range(cfg.MODEL.BATCH_SIZE):
+
+                state = torch.tensor(agent.reset(), dtype=model.dtype)
+
+                # Roll out the whole episode at once
+                if cfg.MODEL.TRAJECTORY_BLOCK:
+                    _, rewards = model.rollout(state)
+                    batch_loss[episode_idx, :len(rewards)] = -rewards
+                    batch_mask[episode_idx, :len(rewards)] = True
+                    continue
+
+                # Only the latest state is kept, so graphs of finished windows can be freed
+                window_loss = []
+                #grads = np.zeros((cfg.MODEL.POLICY.MAX_HORIZON_STEPS, 120))
+                for step_idx in range(cfg.MODEL.POLICY.MAX_HORIZON_STEPS):
+                    state, reward = model(state)
+                    if window > 0:
+                        batch_loss[episode_idx, step_idx] = -reward.detach()
+                        window_loss.append(-reward.reshape(-1))
+                    else:
+                        batch_loss[episode_idx, step_idx] = -reward
+                    batch_mask[episode_idx, step_idx] = True
+                    #(-reward).backward(retain_graph=True)
+                    #grads[step_idx, :] = model.policy_net.optimizer.mean.grad.detach().numpy()
+                    #grads[step_idx, step_idx+1:40] = np.nan
+                    #grads[step_idx, 40+step_idx+1:80] = np.nan
+                    #grads[step_idx, 80+step_idx+1:] = np.nan
+                    #model.policy_net.optimizer.optimizer.zero_grad()
+                    if agent.is_done:
+                        break
+                    # Free the graph and snapshots of a finished window, and don't backpropagate through its states
+                    if window > 0 and (step_idx + 1) % window == 0:
+                        model.policy_net.truncated_backward(torch.cat(window_loss))
+                        window_loss = []
+                        state = state.detach()
+                if window_loss:
+                    model.policy_net.truncated_backward(torch.cat(window_loss))
+
+        loss = model.policy_net.optimize(batch_loss, batch_mask)
         #zero = np.abs(grads) < 1e-9
         #grads[zero] = np.nan
         #medians = np.nanmedian(grads, axis=0)
@@ -110,6 +163,17 @@ def do_training(
 #                visdom.set({'action_grad': model.policy_net.mean.grad.detach().numpy().transpose()})
 
             logger.info("REWARD: \t\t{} (iteration {})".format(loss["objective_loss"], epoch_idx))
+            logger.info("SOLVER: \t\t{}".format(agent.solver_profiles.report()))
+            if agent.broyden is not None:
+                logger.info("JACOBIAN REUSE: \t{}".format(agent.broyden.report()))
+            if agent.sketch is not None:
+                logger.info("JACOBIAN SKETCH: \t{}".format(agent.sketch.report()))
+            if agent.regression is not None:
+                logger.info("REGRESSION: \t\t{}".format(agent.regression.report()))
+            if agent.learned_dynamics is not None:
+                logger.info("LEARNED DYNAMICS: \t{}".format(agent.learned_dynamics.report()))
+            if agent.snapshot_checkpoints is not None:
+                logger.info("SNAPSHOTS: \t\t{}".format(agent.snapshot_checkpoints.report()))
 
         if cfg.LOG.PLOT.ENABLED and epoch_idx % cfg.LOG.PLOT.ITER_PERIOD == 0:
             visdom.do_plotting()
@@ -143,5 +207,8 @@ def do_training(
     # Save outputs into log folder
     lg.save_dict_into_csv(output_results_dir, "output_{}".format(iter), output)
 
+    # Shut down the batch block's simulations; the agent is closed by the caller
+    model.close()
+
     # Return actions
     return agent
\ No newline at end of file
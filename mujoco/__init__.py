@@ -1,3 +1,3 @@
-from .build import build_agent
+from .build import build_agent, build_vector_agent
 
-__all__ = ["build_agent"]
+__all__ = ["build_agent", "build_vector_agent"]
@@ -1,6 +1,38 @@
 from mujoco import envs
 from mujoco.utils.wrappers.mj_block import MjBlockWrapper
 from mujoco.utils.wrappers.etc import SnapshotWrapper, IndexWrapper, ViewerWrapper
+from mujoco.utils.pool import GradientPool
+from mujoco.utils.backend import build_backend
+from mujoco.utils.vector import VectorAgent
+from mujoco.utils.kernel import SteppingKernel
+from mujoco.utils.solver import SolverProfiles
+from mujoco.utils.checkpoint import SnapshotCheckpoints
+from mujoco.utils.regression import TransitionRegression
+from mujoco.utils.learned import LearnedJacobian
+
+
+def snapshot_buffer_size(cfg, worker=False):
+    """
+    Snapshots of a whole batch are needed at the same time when backward is called after the batch, or snapshots of
+    one truncated backpropagation window (for every episode of the batch if they're stepped together)
+    :param worker: size for a worker agent (see build_worker_agent), which simulates at most one episode of a batch
+                   and keeps every snapshot of it
+    """
+    if cfg.MUJOCO.SNAPSHOT_BUFFER_SIZE > 0:
+        return cfg.MUJOCO.SNAPSHOT_BUFFER_SIZE
+    if cfg.MODEL.TRUNCATED_BPTT > 0:
+        steps = cfg.MODEL.TRUNCATED_BPTT
+    else:
+        steps = cfg.MODEL.POLICY.MAX_HORIZON_STEPS
+    if worker:
+        return steps
+
+    # Only checkpoints are kept, plus one for a segment that started before a truncated backpropagation window
+    period = cfg.MUJOCO.SNAPSHOT_CHECKPOINT_PERIOD
+    if period > 1:
+        steps = -(-steps // period) + 1
+
+    return cfg.MODEL.BATCH_SIZE * steps
 
 
 def build_agent(cfg):
@@ -19,6 +51,13 @@ def build_agent(cfg):
     # Make configs accessible through agent
     #agent.cfg = cfg
 
+    # Windows are backpropagated during the rollout, so the policy's loss has to be a sum over steps that gradients go
+    # through the simulation for; REINFORCE and Perttu's losses need the whole batch
+    if cfg.MODEL.TRUNCATED_BPTT > 0:
+        assert cfg.MODEL.POLICY.ARCH == "VariationalOptimization" and cfg.MODEL.POLICY.METHOD in ["R", "PR"], \
+            "Truncated backpropagation (MODEL.TRUNCATED_BPTT) works only with VariationalOptimization and METHOD " \
+            "'R' or 'PR', not with {} and '{}'".format(cfg.MODEL.POLICY.ARCH, cfg.MODEL.POLICY.METHOD)
+
     # Record video
     agent = ViewerWrapper(agent)
 
@@ -26,12 +65,89 @@ def build_agent(cfg):
     agent = IndexWrapper(agent, cfg.MODEL.BATCH_SIZE)
 
     # Grab and set snapshots of data
-    agent = SnapshotWrapper(agent)
+    agent = SnapshotWrapper(agent, snapshot_buffer_size(cfg))
 
     # This should probably be last so we get all wrappers
     agent = MjBlockWrapper(agent)
 
-    # Maybe we should set opt tolerance to zero so mujoco solvers shouldn't stop early?
-    agent.model.opt.tolerance = 0
+    # Simulate with mujoco-py or the official mujoco bindings
+    agent.backend = build_backend(cfg, agent)
+
+    # Separate solver settings for rollouts and finite differences
+    agent.solver_profiles = SolverProfiles(cfg, agent.backend)
+
+    # Bypass the wrapper chain in finite-difference and rollout loops
+    agent.kernel = SteppingKernel(agent)
+
+    # Speculative jacobians are calculated in the pool, where closed-loop policies aren't available
+    if cfg.MODEL.GRADIENTS.SPECULATIVE:
+        assert cfg.MUJOCO.POOL_SIZE > 0, "Speculative jacobians need a worker pool"
+        assert not cfg.MODEL.POLICY.NETWORK, "Speculative jacobians can be used only with open-loop policies"
+
+        # Workers calculate every jacobian of a step from scratch, so estimators that carry state between steps in this
+        # process can't be used with them
+        assert cfg.MODEL.GRADIENTS.BROYDEN_REFRESH == 0, "Speculative jacobians can't be reused with Broyden updates"
+        assert cfg.MODEL.GRADIENTS.SKETCH_DIRECTIONS == 0, "Speculative jacobians can't be sketched"
+        assert not cfg.MODEL.GRADIENTS.REGRESSION, "Speculative jacobians can't be fitted to the batch's transitions"
+        assert cfg.MODEL.GRADIENTS.LEARNED_DYNAMICS == "", \
+            "Speculative jacobians can't be taken from a learned dynamics model"
+
+    # Spread finite-difference calculations over worker processes
+    if cfg.MUJOCO.POOL_SIZE > 0:
+        agent.gradient_pool = GradientPool(cfg)
+
+    # Keep only every k-th snapshot of the fused block, and re-simulate the rest in backward
+    if cfg.MUJOCO.SNAPSHOT_CHECKPOINT_PERIOD > 1:
+        assert not cfg.MODEL.GRADIENTS.SPECULATIVE, "Speculative jacobians need every snapshot during the rollout"
+        assert not cfg.MODEL.TRAJECTORY_BLOCK and not cfg.MODEL.BATCH_BLOCK, \
+            "Snapshot checkpointing can be used only with the fused block"
+        agent.snapshot_checkpoints = SnapshotCheckpoints(cfg, agent.kernel)
+
+    # Fit jacobians to the transitions of the whole batch, which have to be recorded before backward is called
+    if cfg.MODEL.GRADIENTS.REGRESSION:
+        assert cfg.MODEL.TRUNCATED_BPTT == 0, "Jacobians can be fitted only once the whole batch has been simulated"
+        assert not cfg.MODEL.BATCH_BLOCK, "Batch block doesn't record transitions for fitting jacobians"
+
+        # Like learned dynamics jacobians, fits describe one step of the simulation without the policy's response
+        assert cfg.MODEL.NSTEPS_FOR_BACKWARD == 1, "Jacobians can be fitted only to single-step transitions"
+        assert not cfg.MODEL.POLICY.NETWORK, "Jacobians can be fitted only with open-loop policies"
+        agent.regression = TransitionRegression(cfg, agent)
+
+    # Take dynamics jacobians from a trained forward dynamics model
+    if cfg.MODEL.GRADIENTS.LEARNED_DYNAMICS != "":
+        agent.learned_dynamics = LearnedJacobian(cfg, agent)
 
     return agent
+
+
+def build_worker_agent(cfg):
+    """Build an agent for a finite-difference worker process; no viewer or autograd blocks needed"""
+    agent_factory = getattr(envs, cfg.MUJOCO.ENV)
+    agent = agent_factory(cfg)
+
+    # Keep track of step, episode, and batch indices (the reward function may depend on step index)
+    agent = IndexWrapper(agent, cfg.MODEL.BATCH_SIZE)
+
+    # Grab and set snapshots of data
+    agent = SnapshotWrapper(agent, snapshot_buffer_size(cfg, worker=True))
+
+    # Use the same simulator and solver settings as the main simulation
+    agent.backend = build_backend(cfg, agent)
+    agent.solver_profiles = SolverProfiles(cfg, agent.backend)
+    agent.kernel = SteppingKernel(agent)
+
+    # Finite differences are calculated serially in workers
+    agent.gradient_pool = None
+    agent.sparsity = None
+    agent.broyden = None
+    agent.sketch = None
+    agent.regression = None
+    agent.learned_dynamics = None
+    agent.snapshot_checkpoints = None
+
+    return agent
+
+
+def build_vector_agent(cfg, policy_net=None):
+    """Build a batch of simulations that are stepped together, see mujoco.utils.vector.VectorAgent"""
+    return VectorAgent(cfg, policy_net)
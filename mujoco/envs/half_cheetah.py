@@ -1,5 +1,4 @@
 import os
-import torch
 import numpy as np
 from gym import utils
 from gym.envs.mujoco import mujoco_env
@@ -22,15 +21,13 @@ class HalfCheetahEnv(mujoco_env.MujocoEnv, utils.EzPickle):
         self.initialised = True
 
     def step(self, action):
-        xposbefore = self.sim.data.qpos[0]
+        state = self._get_obs()
         self.do_simulation(action, self.frame_skip)
-        xposafter = self.sim.data.qpos[0]
         ob = self._get_obs()
-        reward_ctrl = - 0.01 * np.square(action).sum()
-        reward_run = (xposafter - xposbefore) / self.dt
-        reward = reward_ctrl + reward_run
+        info = {}
+        reward = self.batch_reward(state, action, ob, info)
         done = False
-        return ob, reward, done, dict(reward_run=reward_run, reward_ctrl=reward_ctrl)
+        return ob, reward, done, info
 
     def _get_obs(self):
         """DIFFERENT FROM ORIGINAL GYM"""
@@ -58,11 +55,20 @@ class HalfCheetahEnv(mujoco_env.MujocoEnv, utils.EzPickle):
         done = False
         return done
 
+    def batch_reward(self, state, action, next_state, terms=None):
+        """
+        Reward for a batch of transitions, e.g. [B, T, S] / [B, T, A]; numpy arrays or torch tensors
+        :param terms: dict to fill with the terms of the reward (reward_run, reward_ctrl), e.g. step's info
+        :return: rewards [B, T]
+        """
+        xposbefore = state[..., 0]
+        xposafter = next_state[..., 0]
+        reward_ctrl = - 0.01 * (action * action).sum(-1)
+        reward_run = (xposafter - xposbefore) / self.dt
+        if terms is not None:
+            terms.update(reward_run=reward_run, reward_ctrl=reward_ctrl)
+        return reward_ctrl + reward_run
+
     def tensor_reward(self, state, action, next_state):
         """DIFFERENT FROM ORIGINAL GYM"""
-        xposbefore = state[0]
-        xposafter = next_state[0]
-        reward_ctrl = - 0.01 * torch.sum(torch.mul(action, action))
-        reward_run = (xposafter - xposbefore) / self.dt
-        reward = reward_ctrl + reward_run
-        return reward.view([1, ])
+        return self.batch_reward(state, action, next_state).view([1, ])
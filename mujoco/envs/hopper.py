@@ -1,8 +1,8 @@
 import os
-import torch
 import numpy as np
 from gym import utils
 from gym.envs.mujoco import mujoco_env
+from mujoco.utils.arrays import array_module
 import math
 
 
@@ -27,22 +27,14 @@ class HopperEnv(mujoco_env.MujocoEnv, utils.EzPickle):
     def sigmoid(self, x, mi, mx): return mi + (mx - mi) * (lambda t: (1 + 200 ** (-t + 0.5)) ** (-1))((x - mi) / (mx - mi))
 
     def step(self, a):
-        posbefore = self.sim.data.qpos[0]
+        state = self._get_obs()
         self.do_simulation(a, self.frame_skip)
-        posafter, height, ang = self.sim.data.qpos[0:3]
-        alive_bonus = 1.0
-        reward = (posafter - posbefore) / self.dt
-        ang_abs = abs(ang) % (2*math.pi)
-        if ang_abs > math.pi:
-            ang_abs = 2*math.pi - ang_abs
-        coeff1 = self.sigmoid(height/1.25, 0, 1)
-        coeff2 = self.sigmoid((math.pi - ang_abs)/math.pi, 0, 1)
-        reward += coeff1 * alive_bonus + coeff2 * alive_bonus
-        reward -= 1e-3 * np.square(a).sum()
+        ob = self._get_obs()
+        height, ang = self.sim.data.qpos[1:3]
+        reward = self.batch_reward(state, a, ob)
         s = self.state_vector()
         done = not (np.isfinite(s).all() and (np.abs(s[2:]) < 100).all() and
                     (height > .7) and (abs(ang) < .2)) and self.initialised
-        ob = self._get_obs()
         return ob, reward, False, {}
 
     def _get_obs(self):
@@ -75,12 +67,24 @@ class HopperEnv(mujoco_env.MujocoEnv, utils.EzPickle):
                     (height > .7) and (abs(ang) < .2))
         return done
 
-    def tensor_reward(self, state, action, next_state):
-        """DIFFERENT FROM ORIGINAL GYM"""
-        posbefore = state[0]
-        posafter, height, ang = next_state[0:3]
+    def batch_reward(self, state, action, next_state):
+        """
+        Reward for a batch of transitions, e.g. [B, T, S] / [B, T, A]; numpy arrays or torch tensors
+        :return: rewards [B, T]
+        """
+        xp = array_module(next_state)
+        posbefore = state[..., 0]
+        posafter, height, ang = next_state[..., 0], next_state[..., 1], next_state[..., 2]
         alive_bonus = 1.0
         reward = (posafter - posbefore) / self.dt
-        reward += alive_bonus
-        reward -= 1e-3 * torch.sum(torch.mul(action, action))
-        return reward.view([1, ])
+        ang_abs = xp.abs(ang) % (2*math.pi)
+        ang_abs = xp.where(ang_abs > math.pi, 2*math.pi - ang_abs, ang_abs)
+        coeff1 = self.sigmoid(height/1.25, 0, 1)
+        coeff2 = self.sigmoid((math.pi - ang_abs)/math.pi, 0, 1)
+        reward = reward + coeff1 * alive_bonus + coeff2 * alive_bonus
+        reward = reward - 1e-3 * (action * action).sum(-1)
+        return reward
+
+    def tensor_reward(self, state, action, next_state):
+        """DIFFERENT FROM ORIGINAL GYM"""
+        return self.batch_reward(state, action, next_state).view([1, ])
@@ -1,8 +1,8 @@
 import os
-import torch
 import numpy as np
 from gym import utils
 from gym.envs.mujoco import mujoco_env
+from mujoco.utils.arrays import array_module
 
 
 class InvertedDoublePendulumEnv(mujoco_env.MujocoEnv, utils.EzPickle):
@@ -23,14 +23,11 @@ class InvertedDoublePendulumEnv(mujoco_env.MujocoEnv, utils.EzPickle):
         self.initialised = True
 
     def step(self, action):
+        state = self._get_obs()
         self.do_simulation(action, self.frame_skip)
         ob = self._get_obs()
-        x, _, y = self.sim.data.site_xpos[0]
-        dist_penalty = 0.01 * x ** 2 + (y - 2) ** 2
-        v1, v2 = self.sim.data.qvel[1:3]
-        vel_penalty = 1e-3 * v1 ** 2 + 5e-3 * v2 ** 2
-        alive_bonus = 10
-        r = - dist_penalty - vel_penalty
+        r = self.batch_reward(state, action, ob)
+        _, _, y = self.sim.data.site_xpos[0]
         done = bool(y <= 1)
         return ob, r, False, {}
 
@@ -65,19 +62,27 @@ class InvertedDoublePendulumEnv(mujoco_env.MujocoEnv, utils.EzPickle):
         done = bool(y <= 1)
         return done
 
-    def tensor_reward(self, state, action, next_state):
-        """DIFFERENT FROM ORIGINAL GYM"""
+    def batch_reward(self, state, action, next_state):
+        """
+        Reward for a batch of transitions, e.g. [B, T, S] / [B, T, A]; numpy arrays or torch tensors
+        :return: rewards [B, T]
+        """
+        xp = array_module(next_state)
+
+        # Position of the tip site (the poles rotate about the y axis, starting upright from the cart)
         arm_length = 0.6
-        theta_1 = next_state[1]
-        theta_2 = next_state[2]
-        y = arm_length * torch.cos(theta_1) + \
-            arm_length * torch.cos(theta_1 + theta_2)
-        x = arm_length * torch.cos(theta_1) + \
-            arm_length * torch.cos(theta_1 + theta_2) + \
-            next_state[0]
+        theta_1 = next_state[..., 1]
+        theta_2 = next_state[..., 2]
+        y = arm_length * xp.cos(theta_1) + \
+            arm_length * xp.cos(theta_1 + theta_2)
+        x = arm_length * xp.sin(theta_1) + \
+            arm_length * xp.sin(theta_1 + theta_2) + \
+            next_state[..., 0]
         dist_penalty = 0.01 * x ** 2 + (y - 2) ** 2
-        v1, v2 = next_state[4:6]
+        v1, v2 = next_state[..., 4], next_state[..., 5]
         vel_penalty = 1e-3 * v1 ** 2 + 5e-3 * v2 ** 2
-        alive_bonus = 10
-        reward = alive_bonus - dist_penalty - vel_penalty
-        return reward.view([1, ])
+        return - dist_penalty - vel_penalty
+
+    def tensor_reward(self, state, action, next_state):
+        """DIFFERENT FROM ORIGINAL GYM"""
+        return self.batch_reward(state, action, next_state).view([1, ])
@@ -1,8 +1,8 @@
 import os
-import torch
 import numpy as np
 from gym import utils
 from gym.envs.mujoco import mujoco_env
+from mujoco.utils.arrays import array_module
 
 
 class InvertedPendulumEnv(mujoco_env.MujocoEnv, utils.EzPickle):
@@ -23,16 +23,10 @@ class InvertedPendulumEnv(mujoco_env.MujocoEnv, utils.EzPickle):
 
     def step(self, a):
         """DIFFERENT FROM ORIGINAL GYM"""
-        arm_length = 0.6
+        state = self._get_obs()
         self.do_simulation(a, self.frame_skip)
         ob = self._get_obs()
-        theta = ob[1]
-        y = arm_length * np.cos(theta)
-        x = arm_length * np.cos(theta)
-        dist_penalty = 0.01 * x ** 2 + (y - 1) ** 2
-        #v = ob[3]
-        #vel_penalty = 1e-3 * v ** 2
-        reward = -dist_penalty - 0.001*(a**2)
+        reward = self.batch_reward(state, a, ob)
         notdone = np.isfinite(ob).all() and (np.abs(ob[1]) <= .2)
         done = not notdone
         return ob, reward, False, {}
@@ -57,14 +51,21 @@ class InvertedPendulumEnv(mujoco_env.MujocoEnv, utils.EzPickle):
         done = False
         return done
 
-    def tensor_reward(self, state, action, next_state):
-        """DIFFERENT FROM ORIGINAL GYM"""
+    def batch_reward(self, state, action, next_state):
+        """
+        Reward for a batch of transitions, e.g. [B, T, S] / [B, T, A]; numpy arrays or torch tensors
+        :return: rewards [B, T]
+        """
+        xp = array_module(next_state)
         arm_length = 0.6
-        theta = next_state[1]
-        y = arm_length * torch.cos(theta)
-        x = arm_length * torch.cos(theta)
+        theta = next_state[..., 1]
+        y = arm_length * xp.cos(theta)
+        x = arm_length * xp.cos(theta)
         dist_penalty = 0.01 * x ** 2 + (y - 1) ** 2
-        v = next_state[3]
-        vel_penalty = 1e-3 * v ** 2
-        reward = -dist_penalty - vel_penalty
-        return reward.view([1, ])
+        #v = next_state[..., 3]
+        #vel_penalty = 1e-3 * v ** 2
+        return -dist_penalty - 0.001 * (action * action).sum(-1)
+
+    def tensor_reward(self, state, action, next_state):
+        """DIFFERENT FROM ORIGINAL GYM"""
+        return self.batch_reward(state, action, next_state).view([1, ])
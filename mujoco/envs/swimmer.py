@@ -1,5 +1,4 @@
 import os
-import torch
 import numpy as np
 from gym import utils
 from gym.envs.mujoco import mujoco_env
@@ -20,16 +19,12 @@ class SwimmerEnv(mujoco_env.MujocoEnv, utils.EzPickle):
         utils.EzPickle.__init__(self)
 
     def step(self, a):
-        ctrl_cost_coeff = 0.0001
-        xposbefore = self.sim.data.qpos[0]
+        state = self._get_obs()
         self.do_simulation(a, self.frame_skip)
-        xposafter = self.sim.data.qpos[0]
-        reward_fwd = (xposafter - xposbefore) / self.dt
-        reward_ctrl = - ctrl_cost_coeff * np.square(a).sum()
-        reward = reward_fwd + reward_ctrl
-
         ob = self._get_obs()
-        return ob, reward, False, dict(reward_fwd=reward_fwd, reward_ctrl=reward_ctrl)
+        info = {}
+        reward = self.batch_reward(state, a, ob, info)
+        return ob, reward, False, info
 
     def _get_obs(self):
         """DIFFERENT FROM ORIGINAL GYM"""
@@ -53,12 +48,21 @@ class SwimmerEnv(mujoco_env.MujocoEnv, utils.EzPickle):
         done = False
         return done
 
-    def tensor_reward(self, state, action, next_state):
-        """DIFFERENT FROM ORIGINAL GYM"""
+    def batch_reward(self, state, action, next_state, terms=None):
+        """
+        Reward for a batch of transitions, e.g. [B, T, S] / [B, T, A]; numpy arrays or torch tensors
+        :param terms: dict to fill with the terms of the reward (reward_fwd, reward_ctrl), e.g. step's info
+        :return: rewards [B, T]
+        """
         ctrl_cost_coeff = 0.0001
-        xposbefore = state[0]
-        xposafter = next_state[0]
+        xposbefore = state[..., 0]
+        xposafter = next_state[..., 0]
         reward_fwd = (xposafter - xposbefore) / self.dt
-        reward_ctrl = - ctrl_cost_coeff * torch.sum(torch.mul(action, action))
-        reward = reward_fwd + reward_ctrl
-        return reward.view([1, ])
+        reward_ctrl = - ctrl_cost_coeff * (action * action).sum(-1)
+        if terms is not None:
+            terms.update(reward_fwd=reward_fwd, reward_ctrl=reward_ctrl)
+        return reward_fwd + reward_ctrl
+
+    def tensor_reward(self, state, action, next_state):
+        """DIFFERENT FROM ORIGINAL GYM"""
+        return self.batch_reward(state, action, next_state).view([1, ])
@@ -1,6 +1,7 @@
 import numpy as np
 from gym import utils
 from gym.envs.mujoco import mujoco_env
+from mujoco.utils.arrays import array_module
 import os
 import math
 
@@ -20,17 +21,13 @@ class Walker2dEnv(mujoco_env.MujocoEnv, utils.EzPickle):
         self.initialised = True
 
     def step(self, a):
-        posbefore = self.sim.data.qpos[0]
+        state = self._get_obs()
         self.do_simulation(a, self.frame_skip)
-        posafter, height, ang = self.sim.data.qpos[0:3]
-        alive_bonus = 1.0
-        reward = ((posafter - posbefore) / self.dt)
-        coeff = min(max(height/0.8, 0), 1)*0.5 + max(((math.pi - abs(ang))/math.pi), 1)*0.5
-        reward += coeff*alive_bonus
-        reward -= 1e-3 * np.square(a).sum()
+        ob = self._get_obs()
+        height, ang = self.sim.data.qpos[1:3]
+        reward = self.batch_reward(state, a, ob)
         done = not (height > 0.8 and height < 2.0 and
                     ang > -1.0 and ang < 1.0) and self.initialised
-        ob = self._get_obs()
         #if not done:
         #    reward += alive_bonus
         return ob, reward, False, {}
@@ -55,4 +52,23 @@ class Walker2dEnv(mujoco_env.MujocoEnv, utils.EzPickle):
         self.viewer.cam.trackbodyid = 2
         self.viewer.cam.distance = self.model.stat.extent * 0.5
         self.viewer.cam.lookat[2] = 1.15
-        self.viewer.cam.elevation = -20
\ No newline at end of file
+        self.viewer.cam.elevation = -20
+
+    def batch_reward(self, state, action, next_state):
+        """
+        Reward for a batch of transitions, e.g. [B, T, S] / [B, T, A]; numpy arrays or torch tensors
+        :return: rewards [B, T]
+        """
+        xp = array_module(next_state)
+        posbefore = state[..., 0]
+        posafter, height, ang = next_state[..., 0], next_state[..., 1], next_state[..., 2]
+        alive_bonus = 1.0
+        reward = ((posafter - posbefore) / self.dt)
+        coeff = xp.clip(height/0.8, 0, 1)*0.5 + xp.clip((math.pi - xp.abs(ang))/math.pi, 1, None)*0.5
+        reward = reward + coeff*alive_bonus
+        reward = reward - 1e-3 * (action * action).sum(-1)
+        return reward
+
+    def tensor_reward(self, state, action, next_state):
+        """DIFFERENT FROM ORIGINAL GYM"""
+        return self.batch_reward(state, action, next_state).view([1, ])
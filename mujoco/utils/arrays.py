@@ -0,0 +1,7 @@
+import numpy as np
+import torch
+
+
+def array_module(x):
+    """torch for tensors, numpy for everything else; lets the same code work on both"""
+    return torch if torch.is_tensor(x) else np
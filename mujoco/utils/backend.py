@@ -0,0 +1,180 @@
+import os
+import sys
+import importlib
+from xml.etree import ElementTree
+import numpy as np
+import mujoco_py as mj
+
+from mujoco.utils.backward import transition_derivatives, eps
+
+
+def import_mujoco_bindings():
+    """
+    Import the official mujoco python bindings. They're also called "mujoco", so they are shadowed by this package;
+    import them with this repository removed from the path, and then put this package back in place.
+    """
+    local_modules = {k: sys.modules.pop(k) for k in list(sys.modules) if k == "mujoco" or k.startswith("mujoco.")}
+    root = os.path.dirname(os.path.dirname(os.path.abspath(local_modules["mujoco"].__file__)))
+    path = sys.path[:]
+    sys.path[:] = [p for p in sys.path if os.path.abspath(p or os.curdir) != root]
+    try:
+        bindings = importlib.import_module("mujoco")
+    finally:
+        sys.path[:] = path
+        sys.modules.update(local_modules)
+    return bindings
+
+
+def absolute_asset_dirs(xml, assets_path):
+    """
+    Point mesh and texture directories of a model's xml to the assets directory, so the model can be built from a
+    string without writing it next to the assets
+    """
+    root = ElementTree.fromstring(xml)
+    compiler = root.find("compiler")
+    if compiler is None:
+        compiler = ElementTree.SubElement(root, "compiler")
+    for attribute in ["meshdir", "texturedir"]:
+        compiler.set(attribute, os.path.join(os.path.abspath(assets_path), compiler.get(attribute, "")))
+    return ElementTree.tostring(root, encoding="unicode")
+
+
+class MujocoPyBackend(object):
+    """Simulates and calculates transition derivatives with mujoco-py (the env's own simulation)"""
+
+    def __init__(self, cfg, agent):
+        self.cfg = cfg
+        self.sim = agent.unwrapped.sim
+
+        # Data the substeps advance
+        self.data = self.sim.data
+
+    def install(self, env):
+        # The env already steps with mujoco-py
+        pass
+
+    def load(self):
+        # Substeps advance the env's own data
+        pass
+
+    def store(self):
+        pass
+
+    def substep(self):
+        self.sim.step()
+
+    def simulate(self, nsubsteps):
+        for _ in range(nsubsteps):
+            self.sim.step()
+
+    def solver_options(self):
+        return [self.sim.model.opt]
+
+    def warmstart_disable_bits(self):
+        """Bit of disableflags that disables warmstart, for each of solver_options"""
+        return [mj.const.DSBL_WARMSTART]
+
+    def transition_derivatives_available(self):
+        # Our own finite-differences integrate with mj_Euler
+        return self.sim.model.opt.integrator == mj.const.INT_EULER
+
+    def transition_derivatives(self):
+        return transition_derivatives(self.sim.model, self.sim.data, self.cfg.MUJOCO.FD_SOLVER.WARMUP)
+
+
+class MujocoBackend(object):
+    """
+    Simulates and calculates transition derivatives with the official mujoco bindings. The env's mujoco-py simulation
+    is kept in sync after every step (or every finite-difference evaluation), so observations, rewards, and rendering
+    work as before.
+    """
+
+    def __init__(self, cfg, agent):
+        self.cfg = cfg
+        self.sim = agent.unwrapped.sim
+        self.mujoco = import_mujoco_bindings()
+
+        # Build the model from the same xml; nothing is written to disk, since every worker process builds one too
+        xml = absolute_asset_dirs(self.sim.model.get_xml(), cfg.MUJOCO.ASSETS_PATH)
+        self.model = self.mujoco.MjModel.from_xml_string(xml)
+        self.data = self.mujoco.MjData(self.model)
+
+        # Options may have been changed after the model was loaded (solver settings are set by solver profiles)
+        self.model.opt.timestep = self.sim.model.opt.timestep
+        self.model.opt.integrator = self.sim.model.opt.integrator
+
+        # Transition derivatives are written into these
+        nx = 2*self.model.nv + self.model.na
+        self.A = np.empty((nx, nx))
+        self.B = np.empty((nx, self.model.nu))
+
+    def install(self, env):
+        # Step the env with the official bindings
+        env.unwrapped.do_simulation = self.do_simulation
+
+    def load(self):
+        """Copy state and inputs from the mujoco-py simulation"""
+        d = self.sim.data
+        self.data.time = d.time
+        self.data.qpos[:] = d.qpos
+        self.data.qvel[:] = d.qvel
+        if self.model.na > 0:
+            self.data.act[:] = d.act
+        self.data.ctrl[:] = d.ctrl
+        self.data.qacc_warmstart[:] = d.qacc_warmstart
+        self.data.qfrc_applied[:] = d.qfrc_applied
+        self.data.xfrc_applied[:] = d.xfrc_applied
+
+    def store(self):
+        """Copy state back into the mujoco-py simulation and recompute its derived quantities (once per sync)"""
+        d = self.sim.data
+        d.time = self.data.time
+        d.qpos[:] = self.data.qpos
+        d.qvel[:] = self.data.qvel
+        if self.model.na > 0:
+            d.act[:] = self.data.act
+        mj.functions.mj_forward(self.sim.model, d)
+        d.qacc_warmstart[:] = self.data.qacc_warmstart
+
+    def do_simulation(self, ctrl, n_frames):
+        self.sim.data.ctrl[:] = ctrl
+        self.simulate(n_frames)
+
+    def substep(self):
+        """Advance only the native data; call load before and store after a run of substeps"""
+        self.mujoco.mj_step(self.model, self.data)
+
+    def simulate(self, nsubsteps):
+        self.load()
+        for _ in range(nsubsteps):
+            self.mujoco.mj_step(self.model, self.data)
+        self.store()
+
+    def solver_options(self):
+        return [self.sim.model.opt, self.model.opt]
+
+    def warmstart_disable_bits(self):
+        """
+        Bit of disableflags that disables warmstart, for each of solver_options (the MuJoCo versions of mujoco-py and
+        the official bindings number it differently)
+        """
+        return [mj.const.DSBL_WARMSTART, int(self.mujoco.mjtDisableBit.mjDSBL_WARMSTART)]
+
+    def transition_derivatives_available(self):
+        # mjd_transitionFD can't differentiate RK4 steps
+        return self.model.opt.integrator != self.mujoco.mjtIntegrator.mjINT_RK4
+
+    def transition_derivatives(self):
+        """
+        Derivatives at the native data, which has to be loaded
+        :return: dzdz [2*nv+na, 2*nv+na] and dzdctrl [2*nv+na, nu], where z = [qpos, qvel, act]
+        """
+        self.mujoco.mjd_transitionFD(self.model, self.data, eps, 0, self.A, self.B, None, None)
+        return self.A.copy(), self.B.copy()
+
+
+def build_backend(cfg, agent):
+    backend_factory = {"mujoco_py": MujocoPyBackend, "mujoco": MujocoBackend}[cfg.MUJOCO.BACKEND]
+    backend = backend_factory(cfg, agent)
+    backend.install(agent)
+    return backend
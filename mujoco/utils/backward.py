@@ -3,77 +3,283 @@
 import mujoco_py as mj
 import numpy as np
 import torch
-from copy import deepcopy
+from utils.precision import policy_dtype
 
 # ============================================================
 #                           CONFIG
 # ============================================================
-niter = 30
-nwarmup = 3
 eps = 1e-6
 
 
-def copy_data(m, d_source, d_dest):
-    d_dest.time = d_source.time
-    d_dest.qpos[:] = d_source.qpos
-    d_dest.qvel[:] = d_source.qvel
-    d_dest.qacc[:] = d_source.qacc
-    d_dest.qacc_warmstart[:] = d_source.qacc_warmstart
-    d_dest.qfrc_applied[:] = d_source.qfrc_applied
-    for i in range(m.nbody):
-        d_dest.xfrc_applied[i][:] = d_source.xfrc_applied[i]
-    d_dest.ctrl[:] = d_source.ctrl
+def perturb_qpos(m, d, i):
 
-    # copy d_source.act? probably need to when dealing with muscle actuators
-    #d_dest.act = d_source.act
+    # Get joint id for this dof
+    jid = m.dof_jntid[i]
 
+    # Get quaternion address and dof position within quaternion (-1: not in quaternion)
+    quatadr = -1
+    dofpos = 0
+    if m.jnt_type[jid] == mj.const.JNT_BALL:
+        quatadr = m.jnt_qposadr[jid]
+        dofpos = i - m.jnt_dofadr[jid]
+    elif m.jnt_type[jid] == mj.const.JNT_FREE and i >= m.jnt_dofadr[jid] + 3:
+        quatadr = m.jnt_qposadr[jid] + 3
+        dofpos = i - m.jnt_dofadr[jid] - 3
 
-def initialise_simulation(d_dest, d_source):
-    d_dest.time = d_source.time
-    d_dest.qpos[:] = d_source.qpos
-    d_dest.qvel[:] = d_source.qvel
-    d_dest.qacc_warmstart[:] = d_source.qacc_warmstart
-    d_dest.ctrl[:] = d_source.ctrl
-    if d_source.act is not None:
-        d_dest.act[:] = d_source.act
+    # Apply quaternion or simple perturbation
+    if quatadr >= 0:
+        angvel = np.array([0., 0., 0.])
+        angvel[dofpos] = eps
+        mj.functions.mju_quatIntegrate(d.qpos + quatadr, angvel, 1)
+    else:
+        d.qpos[m.jnt_qposadr[jid] + i - m.jnt_dofadr[jid]] += eps
+
+
+def perturb_column(m, d, i):
+    """Perturb control, velocity, or position; columns are indexed as [ctrl (nu), qvel (nv), qpos (nq)]"""
+    if i < m.nu:
+        d.ctrl[i] += eps
+    elif i < m.nu + m.nv:
+        d.qvel[i - m.nu] += eps
+    else:
+        perturb_qpos(m, d, i - m.nu - m.nv)
+
+
+def tensor_reward_applicable(agent):
+    # Reward gradients can come from tensor_reward when the reward of one step is differentiated wrt an open-loop action
+    return agent.cfg.MODEL.GRADIENTS.TENSOR_REWARD and hasattr(agent.unwrapped, "tensor_reward") and \
+        agent.cfg.MODEL.NSTEPS_FOR_BACKWARD == 1 and not agent.cfg.MODEL.POLICY.NETWORK
+
+
+def batched_policy(agent):
+    # Closed-loop controls of all columns can be calculated at once if the policy evaluates batches of states
+    return agent.cfg.MODEL.POLICY.NETWORK and getattr(agent.policy_net, "has_batch_mean", False)
+
+
+def closed_loop_controls(agent, data_snapshot, columns):
+    """
+    Controls of perturbed columns with a closed-loop policy that has batch_mean (see batched_policy): all perturbed
+    states are built first and the policy's mean is evaluated once for all of them. Sampled actions are the mean plus
+    reparameterized noise, so with the noise of the forward pass kept fixed a perturbed state changes the action by as
+    much as the mean; that change is added to the snapshot's control. Nothing is sampled or recorded.
+    :param columns: iterable of column indices, see calculate_columns
+    :return: controls [len(columns), nu]; control columns get their perturbed control
+    """
+    # Defining m and d just for shorter notations
+    kernel = agent.kernel
+    m = kernel.model
+    d = kernel.data
+    ns = m.nq + m.nv
+
+    # Unperturbed state first, then perturbed states of all columns
+    states = np.empty((len(columns) + 1, ns))
+    ctrls = np.empty((len(columns), m.nu))
+    states[0, :m.nq] = data_snapshot.qpos
+    states[0, m.nq:] = data_snapshot.qvel
+    for col_idx, i in enumerate(columns):
+
+        # Initialise simulation
+        kernel.restore(data_snapshot)
+
+        # Perturb control, velocity, or position
+        perturb_column(m, d, i)
+        states[col_idx + 1, :m.nq] = d.qpos
+        states[col_idx + 1, m.nq:] = d.qvel
+        ctrls[col_idx] = d.ctrl
+
+    # Controls of state columns depend on the state
+    state_columns = np.asarray(columns) >= m.nu
+    if state_columns.any():
+        with torch.no_grad():
+            actions = agent.policy_net.batch_mean(torch.from_numpy(states).to(policy_dtype(agent.cfg)))
+        actions = actions.double().numpy()
+        ctrls[state_columns] += actions[1:][state_columns] - actions[0]
+
+    return ctrls
+
+
+def calculate_columns(agent, data_snapshot, columns, qpos_fwd, qvel_fwd, reward, ctrls=None):
+    """
+    Finite-difference a subset of the Jacobian columns. Columns are indexed as [ctrl (nu), qvel (nv), qpos (nq)].
+    With tensor rewards (see tensor_reward_applicable) only next states are needed, so the simulation is stepped
+    without calling the env's step, and reward gradients are left as zeros.
+    :param columns: iterable of column indices
+    :param ctrls: controls of the columns with closed-loop policies, see closed_loop_controls (calculated if None and
+                  the policy has batch_mean, otherwise the policy is called for each state column)
+    :return: state gradients [nq+nv, len(columns)] and reward gradients [len(columns)]
+    """
+    # Defining m and d just for shorter notations
+    kernel = agent.kernel
+    m = kernel.model
+    d = kernel.data
+
+    # Get number of steps (must be >=2 for muscles)
+    nsteps = agent.cfg.MODEL.NSTEPS_FOR_BACKWARD
+
+    dsdcol = np.empty((m.nq + m.nv, len(columns)))
+    drdcol = np.zeros(len(columns))
+    raw = tensor_reward_applicable(agent)
+    closed_loop = agent.cfg.MODEL.POLICY.NETWORK
+    if ctrls is None and batched_policy(agent):
+        ctrls = closed_loop_controls(agent, data_snapshot, columns)
+    dtype = policy_dtype(agent.cfg)
+
+    for col_idx, i in enumerate(columns):
+
+        # Initialise simulation
+        kernel.restore(data_snapshot)
+
+        # Perturb control, velocity, or position
+        perturb_column(m, d, i)
+
+        # Use the precalculated ctrl, or calculate new ctrl (if it's dependent on state)
+        if ctrls is not None:
+            d.ctrl[:] = ctrls[col_idx]
+        elif i >= m.nu and closed_loop:
+            d.ctrl[:] = agent.policy_net(torch.from_numpy(np.concatenate((d.qpos, d.qvel))).to(dtype)).detach().numpy()
+
+        # Step with perturbed simulation; skip the env's step (observations, reward) if we don't need the reward
+        if raw:
+            kernel.simulate()
+        else:
+            for _ in range(nsteps):
+                info = kernel.step_raw(d.ctrl.copy())
+
+        # Compute gradient of state wrt perturbed value
+        dsdcol[:m.nq, col_idx] = (d.qpos - qpos_fwd) / eps
+        dsdcol[m.nq:, col_idx] = (d.qvel - qvel_fwd) / eps
+
+        # Compute gradient of reward wrt perturbed value
+        if not raw:
+            drdcol[col_idx] = (info[1] - reward) / eps
+
+    return dsdcol, drdcol
+
+
+def check_forward_pass(agent, data_snapshot, next_state, reward):
+    """
+    Sanity check: re-simulating the snapshot must give the same "next_state" and "reward" as the forward pass,
+    otherwise this simulation has diverged from it. The forward pass was simulated under the rollout solver profile.
+    """
+    kernel = agent.kernel
+    with agent.solver_profiles.use("rollout"):
+        kernel.restore(data_snapshot)
+        info = kernel.step_raw(kernel.data.ctrl.copy())
+    assert reward == info[1], "reward is different from forward pass [{} != {}] at timepoint {}".format(
+        reward, info[1], data_snapshot.time)
+    assert (next_state == info[0]).all(), "state is different from forward pass"
+
+
+def fd_center(agent, data_snapshot, next_state, reward):
+    """
+    Center point of finite differences. The forward pass was simulated under the rollout solver profile, so if the
+    finite-difference profile is different the center is re-simulated under it; otherwise every column would pick up
+    the difference of the solvers divided by eps.
+    :return: next state and reward to take finite differences from
+    """
+    if not agent.solver_profiles.differ():
+        return next_state, reward
+    kernel = agent.kernel
+    kernel.restore(data_snapshot)
+    info = kernel.step_raw(kernel.data.ctrl.copy())
+    return info[0], info[1]
+
+
+def calculate_gradients(agent, data_snapshot, next_state, reward, test=False):
+    # Defining m and d just for shorter notations
+    kernel = agent.kernel
+    m = kernel.model
+    d = kernel.data
+
+    # Get number of steps (must be >=2 for muscles)
+    nsteps = agent.cfg.MODEL.NSTEPS_FOR_BACKWARD
 
+    # For testing purposes
+    if test:
+        check_forward_pass(agent, data_snapshot, next_state, reward)
+
+    # Get state from the forward pass (simulated under the finite-difference solver profile)
+    if nsteps > 1:
+        kernel.restore(data_snapshot)
+        for _ in range(nsteps):
+            info = kernel.step_raw(d.ctrl.copy())
+        qpos_fwd = info[0][:m.nq]
+        qvel_fwd = info[0][m.nq:]
+        reward = info[1]
+    else:
+        state_fwd, reward = fd_center(agent, data_snapshot, next_state, reward)
+        qpos_fwd = state_fwd[:m.nq]
+        qvel_fwd = state_fwd[m.nq:]
+
+    # Finite-difference over control values, velocity, and position; spread the columns over worker processes if
+    # we have a pool (closed-loop controls need the policy net, so they're calculated here in one batch and handed to
+    # the workers; policies without batch_mean are called for each column here)
+    columns = range(m.nu + m.nv + m.nq)
+    if agent.gradient_pool is not None and (not agent.cfg.MODEL.POLICY.NETWORK or batched_policy(agent)):
+        ctrls = closed_loop_controls(agent, data_snapshot, columns) if agent.cfg.MODEL.POLICY.NETWORK else None
+        dsdcol, drdcol = agent.gradient_pool.calculate_columns(data_snapshot, columns, qpos_fwd, qvel_fwd, reward,
+                                                               ctrls)
+    else:
+        dsdcol, drdcol = calculate_columns(agent, data_snapshot, columns, qpos_fwd, qvel_fwd, reward)
 
-def integrate_dynamics_gradients(env, dqaccdqpos, dqaccdqvel, dqaccdctrl):
-    m = env.model
-    nv = m.nv
-    nu = m.nu
-    dt = env.model.opt.timestep * env.frame_skip
+    # Split the columns into control, velocity, and position gradients
+    dsdctrl, dsdqvel, dsdqpos = np.split(dsdcol, [m.nu, m.nu + m.nv], axis=1)
+    drdctrl, drdqvel, drdqpos = np.split(drdcol.reshape(1, -1), [m.nu, m.nu + m.nv], axis=1)
 
-    # dfds: d(next_state)/d(current_state): consists of four parts ul, dl, ur, and ud
-    ul = np.identity(nv, dtype=np.float32)
-    ur = np.identity(nv, dtype=np.float32) * dt
-    dl = dqaccdqpos * dt
-    dr = np.identity(nv, dtype=np.float32) + dqaccdqvel * dt
-    dfds = np.concatenate([np.concatenate([ul, dl], axis=0),
-                           np.concatenate([ur, dr], axis=0)],
-                          axis=1)
+    # Set dynamics gradients
+    agent.dynamics_gradients = {"state": np.concatenate((dsdqpos, dsdqvel), axis=1), "action": dsdctrl}
 
-    # dfda: d(next_state)/d(action_values)
-    dfda = np.concatenate([np.zeros([nv, nu]), dqaccdctrl * dt], axis=0)
-    return dfds, dfda
+    # Set reward gradients; chain tensor_reward with the dynamics jacobians if the columns didn't calculate them
+    if tensor_reward_applicable(agent):
+        drds, drda = step_tensor_reward_gradients(agent, data_snapshot, next_state, agent.dynamics_gradients)
+        agent.reward_gradients = {"state": drds, "action": drda}
+    else:
+        agent.reward_gradients = {"state": np.concatenate((drdqpos, drdqvel), axis=1), "action": drdctrl}
 
+    return agent.dynamics_gradients, agent.reward_gradients
 
-def integrate_reward_gradient(env, drdqpos, drdqvel, drdctrl):
-    return np.concatenate([np.array(drdqpos).reshape(1, env.model.nq),
-                           np.array(drdqvel).reshape(1, env.model.nv)], axis=1), \
-           np.array(drdctrl).reshape(1, env.model.nu)
 
+def euler_substep(m, d, skipstage, warmstart, initial):
+    """
+    Evaluate forward dynamics (skipping stages up to skipstage) with the given warmstart, integrate one substep, read
+    out the next state, and restore d to the initial state
+    :param initial: (time, qpos, qvel, act) to restore
+    :return: next state [qpos, qvel, act]
+    """
+    time_initial, qpos_initial, qvel_initial, act_initial = initial
 
-def dynamics_worker(env, d):
-    m = env.sim.model
-    dmain = env.sim.data
+    # Evaluate dynamics, with center warmstart
+    d.qacc_warmstart[:] = warmstart
+    mj.functions.mj_forwardSkip(m, d, skipstage, 1)
 
-    dqaccdqpos = [None] * m.nv * m.nv
-    dqaccdqvel = [None] * m.nv * m.nv
-    dqaccdctrl = [None] * m.nv * m.nu
+    # Integrate like mj_step does (including implicit damping)
+    mj.functions.mj_Euler(m, d)
+    if m.na > 0:
+        z = np.concatenate((d.qpos, d.qvel, d.act))
+        d.act[:] = act_initial
+    else:
+        z = np.concatenate((d.qpos, d.qvel))
 
-    # copy state and control from dmain to thread-specific d
-    copy_data(m, dmain, d)
+    # Undo integration
+    d.time = time_initial
+    d.qpos[:] = qpos_initial
+    d.qvel[:] = qvel_initial
+
+    return z
+
+
+def transition_derivatives(m, d, nwarmup):
+    """
+    Finite-difference one substep wrt control, activation, velocity and position. Perturbations skip the stages they
+    don't affect (control and activation skip position and velocity stages, velocity skips position stage) and start
+    from the warmstart of the center point. d is left at its initial state.
+    :param nwarmup: extra solver iterations at the center point, see MUJOCO.FD_SOLVER.WARMUP
+    :return: dzdz [nq+nv+na, nv+nv+na] and dzdctrl [nq+nv+na, nu], where z = [qpos, qvel, act]
+    """
+    initial = (d.time, d.qpos.copy(), d.qvel.copy(), d.act.copy() if m.na > 0 else None)
+
+    dzdz = np.empty((m.nq + m.nv + m.na, 2*m.nv + m.na))
+    dzdctrl = np.empty((m.nq + m.nv + m.na, m.nu))
 
     # is_forward
     mj.functions.mj_forward(m, d)
@@ -81,403 +287,701 @@ def dynamics_worker(env, d):
     # extra solver iterations to improve warmstart (qacc) at center point
     for rep in range(nwarmup):
         mj.functions.mj_forwardSkip(m, d, mj.const.STAGE_VEL, 1)
-
-    # select output from forward dynamics
-    output = d.qacc  # always differentiate qacc
-
-    # save output for center point and warmstart (needed in forward only)
-    center = output.copy()
     warmstart = d.qacc_warmstart.copy()
 
+    # Evaluate center point the same way as the perturbations
+    center = euler_substep(m, d, mj.const.STAGE_VEL, warmstart, initial)
+
     # finite-difference over control values: skip = mjSTAGE_VEL
     for i in range(m.nu):
-
-        # perturb selected target
+        ctrl = d.ctrl[i]
         d.ctrl[i] += eps
+        dzdctrl[:, i] = (euler_substep(m, d, mj.const.STAGE_VEL, warmstart, initial) - center) / eps
+        d.ctrl[i] = ctrl
 
-        # evaluate dynamics, with center warmstart
-        mj.functions.mju_copy(d.qacc_warmstart, warmstart, m.nv)
-        mj.functions.mj_forwardSkip(m, d, mj.const.STAGE_VEL, 1)
-
-        # undo perturbation
-        d.ctrl[i] = dmain.ctrl[i]
-
-        # compute column i of derivative 2
-        for j in range(m.nv):
-            dqaccdctrl[i + j * m.nu] = (output[j] - center[j]) / eps
+    # finite-difference over activations: skip = mjSTAGE_VEL
+    for i in range(m.na):
+        d.act[i] += eps
+        dzdz[:, 2*m.nv + i] = (euler_substep(m, d, mj.const.STAGE_VEL, warmstart, initial) - center) / eps
 
     # finite-difference over velocity: skip = mjSTAGE_POS
     for i in range(m.nv):
-
-        # perturb velocity
         d.qvel[i] += eps
-
-        # evaluate dynamics, with center warmstart
-        mj.functions.mju_copy(d.qacc_warmstart, warmstart, m.nv)
-        mj.functions.mj_forwardSkip(m, d, mj.const.STAGE_POS, 1)
-
-        # undo perturbation
-        d.qvel[i] = dmain.qvel[i]
-
-        # compute column i of derivative 1
-        for j in range(m.nv):
-            dqaccdqvel[i + j * m.nv] = (output[j] - center[j]) / eps
+        dzdz[:, m.nv + i] = (euler_substep(m, d, mj.const.STAGE_POS, warmstart, initial) - center) / eps
 
     # finite-difference over position: skip = mjSTAGE_NONE
     for i in range(m.nv):
+        perturb_qpos(m, d, i)
+        dzdz[:, i] = (euler_substep(m, d, mj.const.STAGE_NONE, warmstart, initial) - center) / eps
 
-        # get joint id for this dof
-        jid = m.dof_jntid[i]
-
-        # get quaternion address and dof position within quaternion (-1: not in quaternion)
-        quatadr = -1
-        dofpos = 0
-        if m.jnt_type[jid] == mj.const.JNT_BALL:
-            quatadr = m.jnt_qposadr[jid]
-            dofpos = i - m.jnt_dofadr[jid]
-        elif m.jnt_type[jid] == mj.const.JNT_FREE and i >= m.jnt_dofadr[jid] + 3:
-            quatadr = m.jnt_qposadr[jid] + 3
-            dofpos = i - m.jnt_dofadr[jid] - 3
-
-        # apply quaternion or simple perturbation
-        if quatadr >= 0:
-            angvel = np.array([0., 0., 0.])
-            angvel[dofpos] = eps
-            mj.functions.mju_quatIntegrate(d.qpos + quatadr, angvel, 1)
-        else:
-            d.qpos[m.jnt_qposadr[jid] + i - m.jnt_dofadr[jid]] += eps
+    return dzdz, dzdctrl
 
-        # evaluate dynamics, with center warmstart
-        mj.functions.mju_copy(d.qacc_warmstart, warmstart, m.nv)
-        mj.functions.mj_forwardSkip(m, d, mj.const.STAGE_NONE, 1)
 
-        # undo perturbation
-        mj.functions.mju_copy(d.qpos, dmain.qpos, m.nq)
+def tensor_reward_gradients(agent, state, action, next_state, dsds, dsda, dnsds, dnsda):
+    """
+    Reward gradients from autograd through agent.tensor_reward, chained with the jacobians of state and next_state
+    :param dsds, dsda: jacobians of state wrt the state and action we're differentiating with respect to
+    :param dnsds, dnsda: jacobians of next_state wrt the state and action we're differentiating with respect to
+    :return: drds [1, nq+nv] and drda [1, nu]
+    """
+    state = torch.from_numpy(state).requires_grad_()
+    action = torch.from_numpy(action).requires_grad_()
+    next_state = torch.from_numpy(next_state).requires_grad_()
 
-        # compute column i of derivative 0
-        for j in range(m.nv):
-            dqaccdqpos[i + j * m.nv] = (output[j] - center[j]) / eps
+    reward = agent.tensor_reward(state, action, next_state).sum()
+    grads = torch.autograd.grad(reward, (state, action, next_state), allow_unused=True)
 
-    dqaccdqpos = np.array(dqaccdqpos).reshape(m.nv, m.nv)
-    dqaccdqvel = np.array(dqaccdqvel).reshape(m.nv, m.nv)
-    dqaccdctrl = np.array(dqaccdctrl).reshape(m.nv, m.nu)
-    dfds, dfda = integrate_dynamics_gradients(env, dqaccdqpos, dqaccdqvel, dqaccdctrl)
-    return dfds, dfda
+    # Unused inputs get zero gradients
+    drdstate, drdaction, drdnext = [np.zeros((1, x.shape[0])) if g is None else g.detach().numpy().reshape(1, -1)
+                                    for x, g in zip((state, action, next_state), grads)]
 
+    drds = np.matmul(drdstate, dsds) + np.matmul(drdnext, dnsds)
+    drda = drdaction + np.matmul(drdstate, dsda) + np.matmul(drdnext, dnsda)
+    return drds, drda
 
-def dynamics_worker_separate(env):
-    m = env.sim.model
-    d = env.sim.data
 
-    dsdctrl = np.empty((m.nq + m.nv, m.nu))
-    dsdqpos = np.empty((m.nq + m.nv, m.nq))
-    dsdqvel = np.empty((m.nq + m.nv, m.nv))
+def step_tensor_reward_gradients(agent, data_snapshot, next_state, dynamics_gradients):
+    """
+    Reward gradients of one step from tensor_reward, when next_state was simulated from the snapshot state
+    :return: drds [1, nq+nv] and drda [1, nu]
+    """
+    m = agent.model
+    ns = m.nq + m.nv
+    state = np.concatenate((data_snapshot.qpos, data_snapshot.qvel))
+    return tensor_reward_gradients(agent, state, data_snapshot.ctrl.copy(), next_state,
+                                   np.identity(ns), np.zeros((ns, m.nu)),
+                                   dynamics_gradients["state"], dynamics_gradients["action"])
 
-    # Copy initial state
-    time_initial = d.time
-    qvel_initial = d.qvel.copy()
-    qpos_initial = d.qpos.copy()
-    ctrl_initial = d.ctrl.copy()
-    qacc_warmstart_initial = d.qacc_warmstart.copy()
-    act_initial = d.act.copy() if d.act is not None else None
 
-    # Step with the main simulation
-    mj.functions.mj_step(m, d)
+def skip_engine_applicable(agent):
+    # The "skip" engine needs transition derivatives from the backend (mujoco-py ones integrate with mj_Euler) and
+    # takes rewards from tensor_reward; it can't handle quaternions or state dependent (closed-loop) controls either
+    m = agent.model
+    return agent.backend.transition_derivatives_available() and m.nq == m.nv and \
+        hasattr(agent.unwrapped, "tensor_reward") and not agent.cfg.MODEL.POLICY.NETWORK
 
-    # Get qpos, qvel of the main simulation
-    qpos = d.qpos.copy()
-    qvel = d.qvel.copy()
 
-    # finite-difference over control values: skip = mjSTAGE_VEL
-    for i in range(m.nu):
+def calculate_gradients_skip(agent, data_snapshot, next_state, reward, test=False):
+    """
+    Same as calculate_gradients, but instead of stepping the whole env for every perturbation, chain the jacobians of
+    each simulation substep (from the backend, see mujoco.utils.backend). Reward gradients are calculated from
+    tensor_reward.
+    """
+    # Fall back to stepping the env when needed
+    if not skip_engine_applicable(agent):
+        return calculate_gradients(agent, data_snapshot, next_state, reward, test=test)
 
-        # Initialise simulation
-        initialise_simulation(d, time_initial, qpos_initial, qvel_initial, qacc_warmstart_initial, ctrl_initial, act_initial)
+    # Defining m and d just for shorter notations
+    kernel = agent.kernel
+    m = kernel.model
+    d = kernel.data
+    ns = m.nq + m.nv
 
-        # Perturb control
-        d.ctrl[i] += eps
+    # For testing purposes
+    if test:
+        check_forward_pass(agent, data_snapshot, next_state, reward)
 
-        # Step with perturbed simulation
-        mj.functions.mj_step(m, d)
+    # Number of substeps for one (or more) env steps
+    nsubsteps = kernel.frame_skip * agent.cfg.MODEL.NSTEPS_FOR_BACKWARD
 
-        # Compute gradients of qpos and qvel wrt control
-        dsdctrl[:m.nq, i] = (d.qpos - qpos) / eps
-        dsdctrl[m.nq:, i] = (d.qvel - qvel) / eps
+    # Initialise simulation; the backend's data is synced with the env's only before and after all substeps
+    kernel.restore(data_snapshot)
+    action = d.ctrl.copy()
+    backend = kernel.backend
+    backend.load()
+    bd = backend.data
 
-    # finite-difference over velocity: skip = mjSTAGE_POS
-    for i in range(m.nv):
+    # Jacobians of z = [qpos, qvel, act] wrt initial z and ctrl
+    dzdz = np.identity(m.nq + m.nv + m.na)
+    dzdctrl = np.zeros((m.nq + m.nv + m.na, m.nu))
 
-        # Initialise simulation
-        initialise_simulation(d, time_initial, qpos_initial, qvel_initial, qacc_warmstart_initial, ctrl_initial, act_initial)
+    for substep in range(nsubsteps):
 
-        # Perturb velocity
-        d.qvel[i] += eps
+        # Reward is calculated over the last env step, so we need the state (and its jacobians) where it starts
+        if substep == nsubsteps - kernel.frame_skip:
+            state = np.concatenate((bd.qpos, bd.qvel))
+            dsds = dzdz[:ns, :ns].copy()
+            dsda = dzdctrl[:ns].copy()
 
-        # Step with perturbed simulation
-        mj.functions.mj_step(m, d)
+        # Chain jacobians of this substep
+        warmstart = bd.qacc_warmstart.copy()
+        dzdz_substep, dzdctrl_substep = backend.transition_derivatives()
+        dzdctrl = np.matmul(dzdz_substep, dzdctrl) + dzdctrl_substep
+        dzdz = np.matmul(dzdz_substep, dzdz)
 
-        # Compute gradients of qpos and qvel wrt qvel
-        dsdqvel[:m.nq, i] = (d.qpos - qpos) / eps
-        dsdqvel[m.nq:, i] = (d.qvel - qvel) / eps
+        # Advance the center simulation exactly like the forward pass does
+        bd.qacc_warmstart[:] = warmstart
+        backend.substep()
 
-    # finite-difference over position: skip = mjSTAGE_NONE
-    for i in range(m.nq):
+    backend.store()
+    next_state_center = np.concatenate((d.qpos, d.qvel))
 
-        # Initialise simulation
-        initialise_simulation(d, time_initial, qpos_initial, qvel_initial, qacc_warmstart_initial, ctrl_initial, act_initial)
-
-        # Get joint id for this dof
-        jid = m.dof_jntid[i]
-
-        # Get quaternion address and dof position within quaternion (-1: not in quaternion)
-        quatadr = -1
-        dofpos = 0
-        if m.jnt_type[jid] == mj.const.JNT_BALL:
-            quatadr = m.jnt_qposadr[jid]
-            dofpos = i - m.jnt_dofadr[jid]
-        elif m.jnt_type[jid] == mj.const.JNT_FREE and i >= m.jnt_dofadr[jid] + 3:
-            quatadr = m.jnt_qposadr[jid] + 3
-            dofpos = i - m.jnt_dofadr[jid] - 3
-
-        # Apply quaternion or simple perturbation
-        if quatadr >= 0:
-            angvel = np.array([0., 0., 0.])
-            angvel[dofpos] = eps
-            mj.functions.mju_quatIntegrate(d.qpos + quatadr, angvel, 1)
+    # Sanity check. "next_state" must equal the center simulation, otherwise it has diverged from the forward pass
+    # (unless the center was simulated with other solver settings)
+    if test and agent.cfg.MODEL.NSTEPS_FOR_BACKWARD == 1 and not agent.solver_profiles.differ():
+        assert (next_state == next_state_center).all(), "state is different from forward pass"
+
+    # Set dynamics gradients
+    agent.dynamics_gradients = {"state": dzdz[:ns, :ns], "action": dzdctrl[:ns]}
+
+    # Set reward gradients
+    drds, drda = tensor_reward_gradients(agent, state, action, next_state_center, dsds, dsda,
+                                         agent.dynamics_gradients["state"], agent.dynamics_gradients["action"])
+    agent.reward_gradients = {"state": drds, "action": drda}
+
+    return agent.dynamics_gradients, agent.reward_gradients
+
+
+def tendon_bodies(m, tendon_id):
+    """Bodies a tendon is attached to or wraps around"""
+    bodies = []
+    for wrap_id in range(m.tendon_adr[tendon_id], m.tendon_adr[tendon_id] + m.tendon_num[tendon_id]):
+        wrap_type = m.wrap_type[wrap_id]
+        obj_id = m.wrap_objid[wrap_id]
+        if wrap_type == mj.const.WRAP_JOINT:
+            bodies.append(m.jnt_bodyid[obj_id])
+        elif wrap_type == mj.const.WRAP_SITE:
+            bodies.append(m.site_bodyid[obj_id])
+        elif wrap_type in (mj.const.WRAP_SPHERE, mj.const.WRAP_CYLINDER):
+            bodies.append(m.geom_bodyid[obj_id])
+    return bodies
+
+
+def actuator_bodies(m, actuator_id):
+    """Bodies an actuator applies forces to; None if we can't tell"""
+    trntype = m.actuator_trntype[actuator_id]
+    trnid = m.actuator_trnid[actuator_id]
+    if trntype in (mj.const.TRN_JOINT, mj.const.TRN_JOINTINPARENT):
+        return [m.jnt_bodyid[trnid[0]]]
+    elif trntype == mj.const.TRN_TENDON:
+        return tendon_bodies(m, trnid[0])
+    elif trntype == mj.const.TRN_SLIDERCRANK:
+        return [m.site_bodyid[trnid[0]], m.site_bodyid[trnid[1]]]
+    elif trntype == mj.const.TRN_SITE:
+        return [m.site_bodyid[trnid[0]]]
+    return None
+
+
+def kinematic_components(m):
+    """
+    Group the kinematic trees (bodies attached to the world) into components that can affect each other within one
+    step: trees are merged if an equality constraint, tendon, actuator, or a possible contact couples them
+    :return: component id of every body (the world body isn't part of any component)
+    """
+    parent = np.arange(m.nbody)
+
+    def find(body_id):
+        while parent[body_id] != body_id:
+            parent[body_id] = parent[parent[body_id]]
+            body_id = parent[body_id]
+        return body_id
+
+    def merge(bodies):
+        roots = [find(m.body_rootid[body_id]) for body_id in bodies if m.body_rootid[body_id] != 0]
+        for root in roots[1:]:
+            parent[find(root)] = find(roots[0])
+
+    # Equality constraints
+    for eq_id in range(m.neq):
+        obj1, obj2 = m.eq_obj1id[eq_id], m.eq_obj2id[eq_id]
+        if m.eq_type[eq_id] == mj.const.EQ_JOINT:
+            merge([m.jnt_bodyid[obj] for obj in (obj1, obj2) if obj >= 0])
+        elif m.eq_type[eq_id] == mj.const.EQ_TENDON:
+            merge([body_id for obj in (obj1, obj2) if obj >= 0 for body_id in tendon_bodies(m, obj)])
         else:
-            d.qpos[m.jnt_qposadr[jid] + i - m.jnt_dofadr[jid]] += eps
+            merge([obj1, obj2])
 
-        # Step simulation with perturbed position
-        mj.functions.mj_step(m, d)
+    # Tendons
+    for tendon_id in range(m.ntendon):
+        merge(tendon_bodies(m, tendon_id))
 
-        # Compute gradients of qpos and qvel wrt qpos
-        dsdqpos[:m.nq, i] = (d.qpos - qpos) / eps
-        dsdqpos[m.nq:, i] = (d.qvel - qvel) / eps
+    # Actuators; if we don't know where one applies forces, everything is coupled
+    for actuator_id in range(m.nu):
+        bodies = actuator_bodies(m, actuator_id)
+        merge(range(m.nbody) if bodies is None else bodies)
 
-    return np.concatenate((dsdqpos, dsdqvel), axis=1), dsdctrl
+    # Contacts between geoms whose contype and conaffinity are compatible
+    collides = ((m.geom_contype[:, None] & m.geom_conaffinity[None, :]) |
+                (m.geom_conaffinity[:, None] & m.geom_contype[None, :])) != 0
+    for geom1, geom2 in zip(*np.nonzero(np.triu(collides))):
+        merge([m.geom_bodyid[geom1], m.geom_bodyid[geom2]])
 
+    # Explicit contact pairs
+    for pair_id in range(m.npair):
+        merge([m.geom_bodyid[m.pair_geom1[pair_id]], m.geom_bodyid[m.pair_geom2[pair_id]]])
 
-def reward_worker(env, d):
-    m = env.sim.model
-    dmain = env.sim.data
+    return np.array([find(m.body_rootid[body_id]) for body_id in range(m.nbody)])
 
-    drdqpos = [None] * m.nv
-    drdqvel = [None] * m.nv
-    drdctrl = [None] * m.nu
 
-    # copy state and control from dmain to thread-specific d
-    copy_data(m, dmain, d)
+def tree_sparsity(m):
+    """
+    Declare the jacobian sparsity pattern from the kinematic tree: a column can only affect the states of its own
+    component (see kinematic_components)
+    :return: boolean pattern [nq+nv, nu+nv+nq], columns are indexed as in calculate_columns
+    """
+    body_component = kinematic_components(m)
+    dof_component = body_component[m.dof_bodyid]
 
-    # is_forward
-    mj.functions.mj_forward(m, d)
+    # An actuator's bodies are all in one component (or all components were merged if we couldn't tell); actuators
+    # that only act on the world don't affect anything
+    actuator_component = np.full(m.nu, -1, dtype=dof_component.dtype)
+    for actuator_id in range(m.nu):
+        bodies = actuator_bodies(m, actuator_id)
+        for body_id in range(m.nbody) if bodies is None else bodies:
+            if m.body_rootid[body_id] != 0:
+                actuator_component[actuator_id] = body_component[body_id]
+                break
 
-    # extra solver iterations to improve warmstart (qacc) at center point
-    for rep in range(nwarmup):
-        mj.functions.mj_forwardSkip(m, d, mj.const.STAGE_VEL, 1)
+    row_component = np.concatenate((dof_component, dof_component))
+    column_component = np.concatenate((actuator_component, dof_component, dof_component))
+    return row_component[:, None] == column_component[None, :]
 
-    # get center reward
-    _, center, _, _ = env.step(d.ctrl)
-    copy_data(m, d, dmain)  # revert changes to state and forces
 
-    # finite-difference over control values
-    for i in range(m.nu):
-        # perturb selected target
-        d.ctrl[i] += eps
+def color_columns(pattern):
+    """
+    Greedy coloring: columns that don't affect any of the same states share a color, and are perturbed together
+    :param pattern: boolean sparsity pattern [rows, columns]
+    :return: list of colors, each a list of column indices
+    """
+    colors = []
+    color_rows = []
+    for column in np.argsort(-pattern.sum(axis=0), kind="stable"):
+        for color, rows in zip(colors, color_rows):
+            if not (rows & pattern[:, column]).any():
+                color.append(column)
+                rows |= pattern[:, column]
+                break
+        else:
+            colors.append([column])
+            color_rows.append(pattern[:, column].copy())
+    return colors
 
-        _, output, _, _ = env.step(d.ctrl)
-        copy_data(m, d, dmain)  # undo perturbation
 
-        drdctrl[i] = (output - center) / eps
+class JacobianSparsity:
+    """Sparsity pattern of the dynamics jacobian and the column colors it gives"""
 
-    # finite-difference over velocity
-    for i in range(m.nv):
-        # perturb velocity
-        d.qvel[i] += eps
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.colors = color_columns(pattern)
+        self.calls = 0
 
-        _, output, _, _ = env.step(d.ctrl)
-        copy_data(m, d, dmain)  # undo perturbation
+    def update(self, dsdcol):
+        # Anything that was affected in a dense finite-difference pass is part of the pattern from now on
+        self.pattern |= dsdcol != 0
+        self.colors = color_columns(self.pattern)
 
-        drdqvel[i] = (output - center) / eps
 
-    # finite-difference over position: skip = mjSTAGE_NONE
-    for i in range(m.nv):
+def calculate_colored_columns(agent, data_snapshot, sparsity, qpos_fwd, qvel_fwd):
+    """
+    Finite-difference all jacobian columns with one simulation per color
+    :return: state gradients [nq+nv, nu+nv+nq]
+    """
+    # Defining m and d just for shorter notations
+    kernel = agent.kernel
+    m = kernel.model
+    d = kernel.data
 
-        # get joint id for this dof
-        jid = m.dof_jntid[i]
-
-        # get quaternion address and dof position within quaternion (-1: not in quaternion)
-        quatadr = -1
-        dofpos = 0
-        if m.jnt_type[jid] == mj.const.JNT_BALL:
-            quatadr = m.jnt_qposadr[jid]
-            dofpos = i - m.jnt_dofadr[jid]
-        elif m.jnt_type[jid] == mj.const.JNT_FREE and i >= m.jnt_dofadr[jid] + 3:
-            quatadr = m.jnt_qposadr[jid] + 3
-            dofpos = i - m.jnt_dofadr[jid] - 3
-
-        # apply quaternion or simple perturbation
-        if quatadr >= 0:
-            angvel = np.array([0., 0., 0.])
-            angvel[dofpos] = eps
-            mj.functions.mju_quatIntegrate(d.qpos + quatadr, angvel, 1)
-        else:
-            d.qpos[m.jnt_qposadr[jid] + i - m.jnt_dofadr[jid]] += eps
+    state_fwd = np.concatenate((qpos_fwd, qvel_fwd))
+    dsdcol = np.zeros(sparsity.pattern.shape)
 
-        _, output, _, _ = env.step(d.ctrl)
-        copy_data(m, d, dmain)  # undo perturbation
+    for color in sparsity.colors:
 
-        # compute column i of derivative 0
-        drdqpos[i] = (output - center) / eps
+        # Initialise simulation
+        kernel.restore(data_snapshot)
 
-    drds, drda = integrate_reward_gradient(env, drdqpos, drdqvel, drdctrl)
-    return drds, drda
+        # Perturb all columns of this color at once
+        for i in color:
+            perturb_column(m, d, i)
 
+        # Step the perturbed simulation; rewards come from tensor_reward, so the env's step isn't needed
+        kernel.simulate()
 
-def calculate_reward(env, qpos, qvel, ctrl, qpos_next, qvel_next):
-    current_state = np.concatenate((qpos, qvel))
-    next_state = np.concatenate((qpos_next, qvel_next))
-    reward = env.tensor_reward(torch.DoubleTensor(current_state), torch.DoubleTensor(ctrl), torch.DoubleTensor(next_state))
-    return reward.detach().numpy()
+        # The columns don't affect the same states, so each state difference belongs to exactly one of them
+        dsdcolor = (np.concatenate((d.qpos, d.qvel)) - state_fwd) / eps
+        for i in color:
+            rows = sparsity.pattern[:, i]
+            dsdcol[rows, i] = dsdcolor[rows]
 
+    return dsdcol
 
-def calculate_gradients(agent, data_snapshot, next_state, reward, test=False):
-    # Defining m and d just for shorter notations
+
+def sparse_engine_applicable(agent):
+    # Rewards of perturbed columns can't be told apart, so they come from tensor_reward; closed-loop controls would
+    # couple all columns
     m = agent.model
-    d = agent.data
+    return m.nq == m.nv and agent.cfg.MODEL.NSTEPS_FOR_BACKWARD == 1 and \
+        hasattr(agent.unwrapped, "tensor_reward") and not agent.cfg.MODEL.POLICY.NETWORK
 
-    # Dynamics gradients
-    dsdctrl = np.empty((m.nq + m.nv, m.nu))
-    dsdqpos = np.empty((m.nq + m.nv, m.nq))
-    dsdqvel = np.empty((m.nq + m.nv, m.nv))
 
-    # Reward gradients
-    drdctrl = np.empty((1, m.nu))
-    drdqpos = np.empty((1, m.nq))
-    drdqvel = np.empty((1, m.nv))
+def calculate_gradients_sparse(agent, data_snapshot, next_state, reward, test=False):
+    """
+    Same as calculate_gradients, but columns that can't affect the same states (see MODEL.GRADIENTS.SPARSITY) are
+    perturbed in one simulation. Reward gradients are calculated from tensor_reward.
+    """
+    # Fall back to stepping the env for every column when needed
+    if not sparse_engine_applicable(agent):
+        return calculate_gradients(agent, data_snapshot, next_state, reward, test=test)
 
-    # Get number of steps (must be >=2 for muscles)
-    nsteps = agent.cfg.MODEL.NSTEPS_FOR_BACKWARD
+    # Defining m and d just for shorter notations
+    kernel = agent.kernel
+    m = kernel.model
+    d = kernel.data
+    cfg = agent.cfg.MODEL.GRADIENTS
 
     # For testing purposes
     if test:
+        check_forward_pass(agent, data_snapshot, next_state, reward)
+
+    state_fwd, reward_fwd = fd_center(agent, data_snapshot, next_state, reward)
+    qpos_fwd = state_fwd[:m.nq]
+    qvel_fwd = state_fwd[m.nq:]
+    columns = range(m.nu + m.nv + m.nq)
+
+    # Declare the pattern from the kinematic tree, or detect it from dense finite differences every now and then
+    if cfg.SPARSITY == "tree":
+        if agent.sparsity is None:
+            agent.sparsity = JacobianSparsity(tree_sparsity(m))
+        dsdcol = calculate_colored_columns(agent, data_snapshot, agent.sparsity, qpos_fwd, qvel_fwd)
+    elif cfg.SPARSITY == "detect":
+        if agent.sparsity is None:
+            agent.sparsity = JacobianSparsity(np.zeros((m.nq + m.nv, len(columns)), dtype=bool))
+        if agent.sparsity.calls % cfg.SPARSITY_REFRESH == 0:
+            dsdcol, _ = calculate_columns(agent, data_snapshot, columns, qpos_fwd, qvel_fwd, reward_fwd)
+            agent.sparsity.update(dsdcol)
+        else:
+            dsdcol = calculate_colored_columns(agent, data_snapshot, agent.sparsity, qpos_fwd, qvel_fwd)
+    else:
+        raise ValueError("MODEL.GRADIENTS.SPARSITY has to be 'tree' or 'detect'")
+    agent.sparsity.calls += 1
+
+    # Split the columns into control, velocity, and position gradients
+    dsdctrl, dsdqvel, dsdqpos = np.split(dsdcol, [m.nu, m.nu + m.nv], axis=1)
 
-        # Reset simulation to snapshot
-        agent.set_snapshot(data_snapshot)
+    # Set dynamics gradients
+    agent.dynamics_gradients = {"state": np.concatenate((dsdqpos, dsdqvel), axis=1), "action": dsdctrl}
 
-        # Step with the main simulation
-        info = agent.step(d.ctrl.copy())
+    # Set reward gradients
+    drds, drda = step_tensor_reward_gradients(agent, data_snapshot, next_state, agent.dynamics_gradients)
+    agent.reward_gradients = {"state": drds, "action": drda}
 
-        # Sanity check. "reward" must equal info[1], otherwise this simulation has diverged from the forward pass
-        assert reward == info[1], "reward is different from forward pass [{} != {}] at timepoint {}".format(reward, info[1], data_snapshot.time)
+    return agent.dynamics_gradients, agent.reward_gradients
 
-        # Another check. "next_state" must equal info[0], otherwise this simulation has diverged from the forward pass
-        assert (next_state == info[0]).all(), "state is different from forward pass"
 
-    # Get state from the forward pass
-    if nsteps > 1:
-        agent.set_snapshot(data_snapshot)
-        for _ in range(nsteps):
-            info = agent.step(d.ctrl.copy())
-        qpos_fwd = info[0][:agent.model.nq]
-        qvel_fwd = info[0][agent.model.nq:]
-        reward = info[1]
+class BroydenJacobian:
+    """Last full jacobian [[dsds, dsda], [drds, drda]] and the transition it was updated with, plus bookkeeping"""
+
+    def __init__(self):
+        self.x = None
+        self.y = None
+        self.jacobian = None
+        self.steps_since_refresh = 0
+        self.refreshes = 0
+        self.updates = 0
+        self.simulations_saved = 0
+
+    def report(self):
+        return "{} refreshes, {} rank-one updates, {} simulations saved".format(self.refreshes, self.updates,
+                                                                               self.simulations_saved)
+
+
+def calculate_gradients_broyden(agent, data_snapshot, next_state, reward, test=False):
+    """
+    Reuse the previous jacobians with a Broyden rank-one update built from the observed transition, and calculate them
+    with finite differences only every MODEL.GRADIENTS.BROYDEN_REFRESH steps, or when the state and action moved
+    further than BROYDEN_MAX_STEP, or when the previous jacobians mispredict the transition by more than
+    BROYDEN_MAX_ERROR (relative)
+    """
+    # Defining m just for shorter notation
+    m = agent.model
+    cfg = agent.cfg.MODEL.GRADIENTS
+    ns = m.nq + m.nv
+
+    if agent.broyden is None:
+        agent.broyden = BroydenJacobian()
+    broyden = agent.broyden
+
+    # Transition (state, action) -> (next state, reward)
+    x = np.concatenate((data_snapshot.qpos, data_snapshot.qvel, data_snapshot.ctrl))
+    y = np.concatenate((next_state, np.asarray(reward).reshape(1)))
+
+    refresh = broyden.jacobian is None or broyden.steps_since_refresh >= cfg.BROYDEN_REFRESH
+    if not refresh:
+        dx = x - broyden.x
+        dy = y - broyden.y
+        residual = dy - np.matmul(broyden.jacobian, dx)
+        refresh = np.linalg.norm(dx) > cfg.BROYDEN_MAX_STEP or \
+            np.linalg.norm(residual) > cfg.BROYDEN_MAX_ERROR * np.linalg.norm(dy)
+
+    if refresh:
+        dynamics_gradients, reward_gradients = \
+            base_gradient_engine(agent.cfg)(agent, data_snapshot, next_state, reward, test=test)
+        jacobian = np.block([[dynamics_gradients["state"], dynamics_gradients["action"]],
+                             [reward_gradients["state"], reward_gradients["action"]]])
+        broyden.steps_since_refresh = 0
+        broyden.refreshes += 1
     else:
-        qpos_fwd = next_state[:agent.model.nq]
-        qvel_fwd = next_state[agent.model.nq:]
+        # Smallest change to the jacobian that makes it agree with the observed transition
+        jacobian = broyden.jacobian.copy()
+        dxdx = np.dot(dx, dx)
+        if dxdx > 0:
+            jacobian += np.outer(residual, dx) / dxdx
+        broyden.steps_since_refresh += 1
+        broyden.updates += 1
+        broyden.simulations_saved += m.nu + m.nv + m.nq
+
+    broyden.x = x
+    broyden.y = y
+    broyden.jacobian = jacobian
+
+    # Set dynamics and reward gradients
+    agent.dynamics_gradients = {"state": jacobian[:ns, :ns].copy(), "action": jacobian[:ns, ns:].copy()}
+    agent.reward_gradients = {"state": jacobian[ns:, :ns].copy(), "action": jacobian[ns:, ns:].copy()}
+
+    return agent.dynamics_gradients, agent.reward_gradients
+
+
+class SketchedJacobian:
+    """Last jacobian estimate [[dsds, dsda], [drds, drda]], and bookkeeping of audits against full finite differences"""
+
+    def __init__(self):
+        self.jacobian = None
+        self.calls = 0
+        self.audits = 0
+        self.sketches = 0
+        self.simulations_saved = 0
+        self.errors = []
+
+    def report(self):
+        error = "{:.3g} mean, {:.3g} max".format(np.mean(self.errors), np.max(self.errors)) if self.errors else "n/a"
+        report = "{} sketched steps, {} audits (relative error {}), {} simulations saved".format(
+            self.sketches, self.audits, error, self.simulations_saved)
+        self.audits = 0
+        self.sketches = 0
+        self.simulations_saved = 0
+        self.errors = []
+        return report
+
+
+def sketch_engine_applicable(agent):
+    # Directions perturb qpos additively and mix controls with states, so quaternions, closed-loop controls and
+    # multi-step differences aren't handled
+    m = agent.model
+    return m.nq == m.nv and agent.cfg.MODEL.NSTEPS_FOR_BACKWARD == 1 and not agent.cfg.MODEL.POLICY.NETWORK
 
-    # finite-difference over control values
-    for i in range(m.nu):
+
+def sketch_jacobian(agent, data_snapshot, next_state, reward, jacobian):
+    """
+    Correct a jacobian estimate with finite differences along MODEL.GRADIENTS.SKETCH_DIRECTIONS random orthonormal
+    directions V of [qpos, qvel, ctrl]: the smallest change that makes it agree with the measured directional
+    derivatives Y is J + (Y - J V) V^T, which is exact in the span of V and keeps the estimate everywhere else
+    :param jacobian: previous estimate [nq+nv+1, nq+nv+nu]
+    :return: corrected estimate (reward row is left as it was with tensor rewards)
+    """
+    # Defining m and d just for shorter notations
+    kernel = agent.kernel
+    m = kernel.model
+    d = kernel.data
+    ns = m.nq + m.nv
+    k = min(agent.cfg.MODEL.GRADIENTS.SKETCH_DIRECTIONS, ns + m.nu)
+
+    raw = tensor_reward_applicable(agent)
+    directions, _ = np.linalg.qr(np.random.randn(ns + m.nu, k))
+    dydv = np.zeros((ns + 1, k))
+
+    for dir_idx in range(k):
+        direction = eps * directions[:, dir_idx]
 
         # Initialise simulation
-        agent.set_snapshot(data_snapshot)
+        kernel.restore(data_snapshot)
 
-        # Perturb control
-        d.ctrl[i] += eps
+        # Perturb position, velocity, and control along the direction
+        d.qpos[:] += direction[:m.nq]
+        d.qvel[:] += direction[m.nq:ns]
+        d.ctrl[:] += direction[ns:]
 
-        # Step with perturbed simulation
-        for _ in range(nsteps):
-            info = agent.step(d.ctrl.copy())
+        # Step with perturbed simulation; skip the env's step (observations, reward) if we don't need the reward
+        if raw:
+            kernel.simulate()
+        else:
+            info = kernel.step_raw(d.ctrl.copy())
+            dydv[ns, dir_idx] = (info[1] - reward) / eps
 
-        # Compute gradient of state wrt control
-        dsdctrl[:m.nq, i] = (d.qpos - qpos_fwd) / eps
-        dsdctrl[m.nq:, i] = (d.qvel - qvel_fwd) / eps
+        dydv[:ns, dir_idx] = (np.concatenate((d.qpos, d.qvel)) - next_state) / eps
 
-        # Compute gradient of reward wrt to control
-        drdctrl[0, i] = (info[1] - reward) / eps
+    corrected = jacobian + np.matmul(dydv - np.matmul(jacobian, directions), directions.T)
 
-    # finite-difference over velocity
-    for i in range(m.nv):
+    # Reward row wasn't measured, it's chained from tensor_reward later
+    if raw:
+        corrected[ns] = jacobian[ns]
+    return corrected
 
-        # Initialise simulation
-        agent.set_snapshot(data_snapshot)
 
-        # Perturb velocity
-        d.qvel[i] += eps
+def calculate_gradients_sketch(agent, data_snapshot, next_state, reward, test=False):
+    """
+    Estimate the jacobians from the previous step's ones and finite differences along only
+    MODEL.GRADIENTS.SKETCH_DIRECTIONS random directions (see sketch_jacobian), instead of one simulation per column.
+    Full finite differences are calculated every SKETCH_AUDIT steps, and the sketched estimate of that step is
+    compared against them to report its relative error.
+    """
+    # Fall back to full finite differences when needed
+    if not sketch_engine_applicable(agent):
+        return base_gradient_engine(agent.cfg)(agent, data_snapshot, next_state, reward, test=test)
 
-        # Calculate new ctrl (if it's dependent on state)
-        if agent.cfg.MODEL.POLICY.NETWORK:
-            d.ctrl[:] = agent.policy_net(torch.from_numpy(np.concatenate((d.qpos, d.qvel))).float()).double().detach().numpy()
+    # Defining m just for shorter notation
+    m = agent.model
+    cfg = agent.cfg.MODEL.GRADIENTS
+    ns = m.nq + m.nv
+
+    if agent.sketch is None:
+        agent.sketch = SketchedJacobian()
+    sketch = agent.sketch
+
+    if sketch.jacobian is not None:
+        state_fwd, reward_fwd = fd_center(agent, data_snapshot, next_state, reward)
+        jacobian = sketch_jacobian(agent, data_snapshot, state_fwd, reward_fwd, sketch.jacobian)
+
+    if sketch.jacobian is None or sketch.calls % cfg.SKETCH_AUDIT == 0:
+        dynamics_gradients, reward_gradients = \
+            base_gradient_engine(agent.cfg)(agent, data_snapshot, next_state, reward, test=test)
+        audit = np.block([[dynamics_gradients["state"], dynamics_gradients["action"]],
+                          [reward_gradients["state"], reward_gradients["action"]]])
+
+        # Relative error of the sketched estimate (of dynamics only if rewards come from tensor_reward)
+        if sketch.jacobian is not None:
+            rows = ns if tensor_reward_applicable(agent) else ns + 1
+            error = np.linalg.norm(jacobian[:rows] - audit[:rows]) / max(np.linalg.norm(audit[:rows]), eps)
+            sketch.errors.append(error)
+
+        jacobian = audit
+        sketch.audits += 1
+    else:
+        sketch.sketches += 1
+        sketch.simulations_saved += m.nu + m.nv + m.nq - min(cfg.SKETCH_DIRECTIONS, ns + m.nu)
 
-        # Step with perturbed simulation
-        for _ in range(nsteps):
-            info = agent.step(d.ctrl)
+    sketch.jacobian = jacobian
+    sketch.calls += 1
 
-        # Compute gradient of state wrt qvel
-        dsdqvel[:m.nq, i] = (d.qpos - qpos_fwd) / eps
-        dsdqvel[m.nq:, i] = (d.qvel - qvel_fwd) / eps
+    # Set dynamics gradients
+    agent.dynamics_gradients = {"state": jacobian[:ns, :ns].copy(), "action": jacobian[:ns, ns:].copy()}
 
-        # Compute gradient of reward wrt qvel
-        drdqvel[0, i] = (info[1] - reward) / eps
+    # Set reward gradients; chain tensor_reward with the dynamics jacobians if they weren't sketched
+    if tensor_reward_applicable(agent):
+        drds, drda = step_tensor_reward_gradients(agent, data_snapshot, next_state, agent.dynamics_gradients)
+        agent.reward_gradients = {"state": drds, "action": drda}
+    else:
+        agent.reward_gradients = {"state": jacobian[ns:, :ns].copy(), "action": jacobian[ns:, ns:].copy()}
 
-    # finite-difference over position
-    for i in range(m.nq):
+    return agent.dynamics_gradients, agent.reward_gradients
 
-        # Initialise simulation
-        agent.set_snapshot(data_snapshot)
-
-        # Get joint id for this dof
-        jid = m.dof_jntid[i]
-
-        # Get quaternion address and dof position within quaternion (-1: not in quaternion)
-        quatadr = -1
-        dofpos = 0
-        if m.jnt_type[jid] == mj.const.JNT_BALL:
-            quatadr = m.jnt_qposadr[jid]
-            dofpos = i - m.jnt_dofadr[jid]
-        elif m.jnt_type[jid] == mj.const.JNT_FREE and i >= m.jnt_dofadr[jid] + 3:
-            quatadr = m.jnt_qposadr[jid] + 3
-            dofpos = i - m.jnt_dofadr[jid] - 3
-
-        # Apply quaternion or simple perturbation
-        if quatadr >= 0:
-            angvel = np.array([0., 0., 0.])
-            angvel[dofpos] = eps
-            mj.functions.mju_quatIntegrate(d.qpos + quatadr, angvel, 1)
-        else:
-            d.qpos[m.jnt_qposadr[jid] + i - m.jnt_dofadr[jid]] += eps
 
-        # Calculate new ctrl (if it's dependent on state)
-        if agent.cfg.MODEL.POLICY.NETWORK:
-            d.ctrl[:] = agent.policy_net(torch.from_numpy(np.concatenate((d.qpos, d.qvel))).float()).double().detach().numpy()
+def calculate_gradients_regression(agent, data_snapshot, next_state, reward, test=False):
+    """
+    Jacobians of the linear model fitted to the transitions of every episode of the batch at this step (see
+    mujoco.utils.regression.TransitionRegression), so no extra simulations are needed. Finite differences are
+    calculated instead when the batch doesn't determine the fit, or its residual is too high.
+    """
+    # Defining m just for shorter notation
+    m = agent.model
+    ns = m.nq + m.nv
 
-        # Step simulation with perturbed position
-        for _ in range(nsteps):
-            info = agent.step(d.ctrl)
+    regression = agent.regression
+    step_idx = data_snapshot.step_idx.value
+    jacobian = None if regression is None else regression.jacobian(step_idx)
 
-        # Compute gradient of state wrt qpos
-        dsdqpos[:m.nq, i] = (d.qpos - qpos_fwd) / eps
-        dsdqpos[m.nq:, i] = (d.qvel - qvel_fwd) / eps
+    # Fall back to finite differences, and use them as the prior of the next batch's fit
+    if jacobian is None:
+        dynamics_gradients, reward_gradients = \
+            base_gradient_engine(agent.cfg)(agent, data_snapshot, next_state, reward, test=test)
+        if regression is not None:
+            regression.fallback(step_idx, np.block([[dynamics_gradients["state"], dynamics_gradients["action"]],
+                                                    [reward_gradients["state"], reward_gradients["action"]]]))
+        return dynamics_gradients, reward_gradients
 
-        # Compute gradient of reward wrt qpos
-        drdqpos[0, i] = (info[1] - reward) / eps
+    # Set dynamics gradients
+    agent.dynamics_gradients = {"state": jacobian[:ns, :ns].copy(), "action": jacobian[:ns, ns:].copy()}
+
+    # Set reward gradients; tensor_reward gives them exactly given the dynamics jacobians
+    if tensor_reward_applicable(agent):
+        drds, drda = step_tensor_reward_gradients(agent, data_snapshot, next_state, agent.dynamics_gradients)
+        agent.reward_gradients = {"state": drds, "action": drda}
+    else:
+        agent.reward_gradients = {"state": jacobian[ns:, :ns].copy(), "action": jacobian[ns:, ns:].copy()}
+
+    return agent.dynamics_gradients, agent.reward_gradients
+
+
+def learned_engine_applicable(agent):
+    # The network predicts next states only, so rewards come from tensor_reward; closed-loop finite differences would
+    # include the policy's response, which the network doesn't
+    return agent.learned_dynamics is not None and hasattr(agent.unwrapped, "tensor_reward") and \
+        agent.cfg.MODEL.NSTEPS_FOR_BACKWARD == 1 and not agent.cfg.MODEL.POLICY.NETWORK
+
+
+def calculate_gradients_learned(agent, data_snapshot, next_state, reward, test=False):
+    """
+    Dynamics jacobians from autograd through a trained forward dynamics model (see
+    mujoco.utils.learned.LearnedJacobian), recalibrated with finite differences every
+    MODEL.GRADIENTS.LEARNED_DYNAMICS_CALIBRATION steps. Reward gradients are calculated from tensor_reward.
+    """
+    # Fall back to finite differences when needed
+    if not learned_engine_applicable(agent):
+        return base_gradient_engine(agent.cfg)(agent, data_snapshot, next_state, reward, test=test)
+
+    # Defining m just for shorter notation
+    m = agent.model
+    ns = m.nq + m.nv
+    learned = agent.learned_dynamics
+
+    state = np.concatenate((data_snapshot.qpos, data_snapshot.qvel))
+    jacobian = learned.jacobian(state, data_snapshot.ctrl.copy())
+
+    # Use finite differences as they are when recalibrating
+    if learned.needs_calibration():
+        dynamics_gradients, reward_gradients = \
+            base_gradient_engine(agent.cfg)(agent, data_snapshot, next_state, reward, test=test)
+        learned.calibrate(jacobian, np.concatenate((dynamics_gradients["state"], dynamics_gradients["action"]), axis=1))
+        return dynamics_gradients, reward_gradients
+
+    jacobian = learned.corrected(jacobian, m.nu + m.nv + m.nq)
 
     # Set dynamics gradients
-    agent.dynamics_gradients = {"state": np.concatenate((dsdqpos, dsdqvel), axis=1), "action": dsdctrl}
+    agent.dynamics_gradients = {"state": jacobian[:, :ns], "action": jacobian[:, ns:]}
 
     # Set reward gradients
-    agent.reward_gradients = {"state": np.concatenate((drdqpos, drdqvel), axis=1), "action": drdctrl}
+    drds, drda = step_tensor_reward_gradients(agent, data_snapshot, next_state, agent.dynamics_gradients)
+    agent.reward_gradients = {"state": drds, "action": drda}
+
+    return agent.dynamics_gradients, agent.reward_gradients
 
-    return
+
+def base_gradient_engine(cfg):
+    """
+    Choose how finite differences are evaluated. Every engine simulates through the backend; with the official mujoco
+    bindings the "skip" engine takes its substep jacobians from mjd_transitionFD.
+    """
+    return {"step": calculate_gradients, "skip": calculate_gradients_skip,
+            "sparse": calculate_gradients_sparse}[cfg.MODEL.GRADIENTS.ENGINE]
+
+
+def gradient_engine(cfg):
+    """
+    Choose how jacobians are calculated: finite differences at every step, reused with Broyden updates, estimated
+    from a few random directions, fitted to the batch's transitions, or taken from a learned dynamics model
+    """
+    estimators = [cfg.MODEL.GRADIENTS.BROYDEN_REFRESH > 0, cfg.MODEL.GRADIENTS.SKETCH_DIRECTIONS > 0,
+                  cfg.MODEL.GRADIENTS.REGRESSION, cfg.MODEL.GRADIENTS.LEARNED_DYNAMICS != ""]
+    assert sum(estimators) <= 1, "Only one of MODEL.GRADIENTS.BROYDEN_REFRESH, SKETCH_DIRECTIONS, REGRESSION, and " \
+                                 "LEARNED_DYNAMICS can be used at a time"
+    if cfg.MODEL.GRADIENTS.BROYDEN_REFRESH > 0:
+        return calculate_gradients_broyden
+    elif cfg.MODEL.GRADIENTS.SKETCH_DIRECTIONS > 0:
+        return calculate_gradients_sketch
+    elif cfg.MODEL.GRADIENTS.REGRESSION:
+        return calculate_gradients_regression
+    elif cfg.MODEL.GRADIENTS.LEARNED_DYNAMICS != "":
+        return calculate_gradients_learned
+    else:
+        return base_gradient_engine(cfg)
 
 
 def mj_gradients_factory(agent, mode):
@@ -489,7 +993,7 @@ def mj_gradients_factory(agent, mode):
     #mj_sim_main = env.sim
     #mj_sim = mj.MjSim(mj_sim_main.model)
 
-    #worker = {'dynamics': reward_worker, 'reward': reward_worker}[mode]
+    engine = gradient_engine(agent.cfg)
 
     @agent.gradient_wrapper(mode)
     def mj_gradients(data_snapshot, next_state, reward, test=False):
@@ -500,13 +1004,9 @@ def mj_gradients_factory(agent, mode):
         #env.set_state(qpos, qvel)
         #env.data.ctrl[:] = ctrl
         #d = mj_sim.data
-        # set solver options for finite differences
-        #mj_sim_main.model.opt.iterations = niter
-        #mj_sim_main.model.opt.tolerance = 0
-#        env.sim.model.opt.iterations = niter
-#        env.sim.model.opt.tolerance = 0
-        #dfds, dfda = worker(env)
-
-        calculate_gradients(agent, data_snapshot, next_state, reward, test=test)
+
+        # Backward can be called in the middle of a rollout (MODEL.TRUNCATED_BPTT), so leave the simulation as it was
+        with agent.kernel.preserved(), agent.solver_profiles.use("fd"):
+            return engine(agent, data_snapshot, next_state, reward, test=test)
 
     return mj_gradients
@@ -0,0 +1,106 @@
+import numpy as np
+
+
+class SnapshotSegment(object):
+    """
+    Consecutive steps of an episode: a snapshot of the first one (the checkpoint), and the states and actions that
+    were set for all of them
+    """
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.start = checkpoint.step_idx.value
+        self.states = []
+        self.actions = []
+
+        # Re-simulated snapshots, kept until backward has been called for every step of the segment
+        self.snapshots = None
+        self.pending = 0
+
+
+class SnapshotCheckpoints(object):
+    """
+    Keep a snapshot only every MUJOCO.SNAPSHOT_CHECKPOINT_PERIOD steps instead of every step, and rebuild the missing
+    ones in backward by re-simulating from the nearest earlier checkpoint with the recorded actions (like gradient
+    checkpointing in torch). A segment is re-simulated once when the first of its snapshots is needed, so memory is
+    traded for at most one extra simulated step per step.
+    """
+
+    def __init__(self, cfg, kernel):
+        self.period = cfg.MUJOCO.SNAPSHOT_CHECKPOINT_PERIOD
+        self.kernel = kernel
+        self.segment = None
+
+        # Bookkeeping for the memory / compute trade-off
+        self.row_bytes = kernel.snapshot_buffer.layout.size * 8
+        self.step_bytes = (kernel.model.nq + kernel.model.nv + kernel.model.nu) * 8
+        self.recorded = 0
+        self.checkpoints = 0
+        self.resimulated = 0
+
+    def record(self):
+        """
+        Call instead of taking a snapshot when state and action of a step have been set
+        :return: segment and offset of the step in it, for snapshot in backward
+        """
+        kernel = self.kernel
+        data = kernel.data
+        step_idx = kernel.step_idx.value
+
+        # Start a new segment at checkpoints, and whenever the step doesn't continue the current segment
+        segment = self.segment
+        if segment is None or step_idx % self.period == 0 or step_idx != segment.start + len(segment.actions):
+            segment = SnapshotSegment(kernel.snapshot())
+            self.segment = segment
+            self.checkpoints += 1
+
+        # The state that was set isn't necessarily the one the previous step ended in (e.g. it was rounded to
+        # MODEL.PRECISION "single"), so it's re-set when the step is re-simulated
+        segment.states.append(np.concatenate((data.qpos, data.qvel)))
+        segment.actions.append(data.ctrl.copy())
+        segment.pending += 1
+        self.recorded += 1
+        return segment, len(segment.actions) - 1
+
+    def snapshot(self, segment, offset):
+        """Snapshot of a step, re-simulated from the segment's checkpoint if it isn't available"""
+        if segment.snapshots is None or offset >= len(segment.snapshots):
+            segment.snapshots = self.resimulate(segment)
+        snapshot = segment.snapshots[offset]
+
+        # Free the re-simulated snapshots once they've all been used
+        segment.pending -= 1
+        if segment.pending == 0:
+            segment.snapshots = None
+
+        return snapshot
+
+    def resimulate(self, segment):
+        kernel = self.kernel
+        snapshots = [segment.checkpoint]
+
+        nq = kernel.model.nq
+
+        # Backward can be called in the middle of a rollout (MODEL.TRUNCATED_BPTT), so leave the simulation as it was
+        with kernel.preserved():
+            kernel.restore(segment.checkpoint)
+            for action, next_state, next_action in \
+                    zip(segment.actions[:-1], segment.states[1:], segment.actions[1:]):
+                kernel.step_raw(action.copy())
+                kernel.data.qpos[:] = next_state[:nq]
+                kernel.data.qvel[:] = next_state[nq:]
+                kernel.data.ctrl[:] = next_action
+                snapshots.append(kernel.snapshot_buffer.pack_copy(kernel.data, kernel.step_idx))
+                self.resimulated += 1
+
+        return snapshots
+
+    def report(self):
+        full = self.recorded * self.row_bytes / 1e6
+        kept = (self.checkpoints * self.row_bytes + self.recorded * self.step_bytes) / 1e6
+        report = "{} of {} snapshots kept ({:.1f} MB instead of {:.1f} MB), {} steps re-simulated".format(
+            self.checkpoints, self.recorded, kept, full, self.resimulated)
+        self.recorded = 0
+        self.checkpoints = 0
+        self.resimulated = 0
+        return report
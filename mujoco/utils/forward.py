@@ -9,6 +9,16 @@ def mj_forward_factory(agent, mode):
     :return:
     """
 
+    # Resolve the wrapper chain once, see mujoco.utils.kernel.SteppingKernel
+    kernel = agent.kernel
+
+    # Actions are converted into this buffer, so the simulation gets float64 values that don't reference agent's data
+    # (otherwise we might get into trouble if ctrl is limited and frame_skip is larger than one)
+    ctrl = np.empty(kernel.model.nu)
+
+    # Transitions are recorded for fitting jacobians to them if set, see mujoco.utils.regression.TransitionRegression
+    regression = agent.regression
+
     @agent.forward_wrapper(mode)
     def mj_forward(action=None):
         """
@@ -18,22 +28,27 @@ def mj_forward_factory(agent, mode):
 
         # If action wasn't explicitly given use the current one in agent's env
         if action is None:
-            action = agent.data.ctrl
+            action = kernel.data.ctrl
 
-        # Convert tensor to numpy array, and make sure we're using an action value that isn't referencing agent's data
-        # (otherwise we might get into trouble if ctrl is limited and frame_skip is larger than one)
+        # Convert tensors and arrays of any float dtype into the buffer
         if isinstance(action, torch.Tensor):
-            action = action.detach().numpy().copy()
+            ctrl[:] = action.detach().numpy()
         elif isinstance(action, np.ndarray):
-            action = action.copy()
+            ctrl[:] = action
         else:
             raise TypeError("Expecting a torch tensor or numpy ndarray")
 
-        # Make sure dtype is numpy.float64
-        assert action.dtype == np.float64, "You must use dtype numpy.float64 for actions"
+        # Transitions of test rollouts (policy in eval mode) aren't part of the batch the jacobians are fitted to
+        policy_net = getattr(kernel.env, "policy_net", None)
+        record = regression is not None and (policy_net is None or policy_net.training)
 
         # Advance simulation with one step
-        next_state, agent.reward, agent.is_done, _ = agent.step(action)
+        if record:
+            state = np.concatenate((kernel.data.qpos, kernel.data.qvel))
+            step_idx = kernel.step_idx.value
+        next_state, agent.reward, agent.is_done, _ = kernel.step_raw(ctrl)
+        if record:
+            regression.record(step_idx, state, ctrl, next_state, agent.reward)
 
         return next_state
 
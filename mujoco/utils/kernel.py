@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+
+
+class SteppingKernel(object):
+    """
+    Everything the finite-difference and rollout loops touch, resolved once from the wrapper chain. Attribute access
+    on the agent walks gym.Wrapper.__getattr__ through every wrapper, which adds up when done thousands of times per
+    epoch; the wrappers are still used for everything else.
+    """
+
+    def __init__(self, agent):
+        self.env = agent.unwrapped
+        self.sim = self.env.sim
+        self.model = self.sim.model
+        self.data = self.sim.data
+        self.cfg = agent.cfg
+        self.frame_skip = agent.frame_skip
+        self.backend = agent.backend
+        self.solver_profiles = agent.solver_profiles
+
+        # Same Index object IndexWrapper counts steps with
+        self.step_idx = agent.get_step_idx()
+
+        self.snapshot_buffer = agent.snapshot_buffer
+        self.env_step = self.env.step
+
+    def step_raw(self, ctrl):
+        """Same as agent.step: count the step and step the env"""
+        self.step_idx += 1
+        self.solver_profiles.count_step()
+        return self.env_step(ctrl)
+
+    def simulate(self):
+        """Advance the simulation by one env step with the current ctrl, without observations or reward"""
+        self.solver_profiles.count_step()
+        self.backend.simulate(self.frame_skip)
+
+    def snapshot(self):
+        return self.snapshot_buffer.pack(self.data, self.step_idx)
+
+    def restore(self, snapshot):
+        """Same as agent.set_snapshot"""
+        self.step_idx.set(snapshot.layout.unpack(snapshot.row, self.data))
+
+    @contextmanager
+    def preserved(self):
+        """Put the simulation back where it was afterwards, e.g. when jacobians are calculated in the middle of a
+        rollout (the snapshot doesn't take a row of the ring buffer)"""
+        snapshot = self.snapshot_buffer.pack_copy(self.data, self.step_idx)
+        try:
+            yield
+        finally:
+            self.restore(snapshot)
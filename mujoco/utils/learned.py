@@ -0,0 +1,70 @@
+import numpy as np
+import torch
+
+
+class LearnedJacobian(object):
+    """
+    Jacobians of the dynamics from autograd through a trained forward dynamics model (see
+    model.blocks.policy.dynamics.DynamicsModel and model.engine.dynamics_model_trainer), so backward needs one small
+    network jacobian instead of a simulation per column. Finite differences recalibrate them every
+    MODEL.GRADIENTS.LEARNED_DYNAMICS_CALIBRATION steps: their difference to the network's jacobian is added to the
+    following ones, and its relative size (the discrepancy) is reported.
+    """
+
+    def __init__(self, cfg, agent):
+        # Import here to avoid a circular import (model builds agents with mujoco.build)
+        from model.blocks.policy.dynamics import DynamicsModel
+
+        self.calibration_period = cfg.MODEL.GRADIENTS.LEARNED_DYNAMICS_CALIBRATION
+        self.model = DynamicsModel(agent)
+        self.model.load_state_dict(torch.load(cfg.MODEL.GRADIENTS.LEARNED_DYNAMICS))
+        self.model.eval()
+        self.dtype = next(self.model.parameters()).dtype
+
+        # Finite-difference jacobian minus the network's one at the last calibration
+        self.correction = None
+        self.steps_since_calibration = 0
+
+        # Bookkeeping
+        self.calibrations = 0
+        self.steps = 0
+        self.simulations_saved = 0
+        self.discrepancies = []
+
+    def jacobian(self, state, action):
+        """
+        :param state: np.array [S]
+        :param action: np.array [A]
+        :return: jacobian [dsds, dsda] of the network's next state [S, S+A]
+        """
+        dsds, dsda = torch.autograd.functional.jacobian(
+            self.model, (torch.from_numpy(state).to(self.dtype), torch.from_numpy(action).to(self.dtype)))
+        return np.concatenate((dsds.double().numpy(), dsda.double().numpy()), axis=1)
+
+    def needs_calibration(self):
+        return self.correction is None or self.steps_since_calibration >= self.calibration_period
+
+    def calibrate(self, jacobian, fd_jacobian):
+        """Correct the network's jacobians with a finite-difference one of the same step"""
+        self.discrepancies.append(np.linalg.norm(jacobian - fd_jacobian) / max(np.linalg.norm(fd_jacobian), 1e-12))
+        self.correction = fd_jacobian - jacobian
+        self.steps_since_calibration = 0
+        self.calibrations += 1
+
+    def corrected(self, jacobian, simulations):
+        """Network's jacobian corrected with the last calibration; it replaces the given number of simulations"""
+        self.steps_since_calibration += 1
+        self.steps += 1
+        self.simulations_saved += simulations
+        return jacobian + self.correction
+
+    def report(self):
+        discrepancy = "{:.3g} mean, {:.3g} max".format(np.mean(self.discrepancies), np.max(self.discrepancies)) \
+            if self.discrepancies else "n/a"
+        report = "{} steps from the network, {} calibrations (relative discrepancy {}), {} simulations saved".format(
+            self.steps, self.calibrations, discrepancy, self.simulations_saved)
+        self.steps = 0
+        self.calibrations = 0
+        self.simulations_saved = 0
+        self.discrepancies = []
+        return report
@@ -0,0 +1,72 @@
+import multiprocessing
+import numpy as np
+
+from mujoco.utils.backward import calculate_columns, gradient_engine
+
+# Each worker process keeps its own agent (and hence its own MjSim / MjData)
+_worker_agent = None
+
+
+def _initialise_worker(cfg):
+    global _worker_agent
+
+    # Import here to avoid a circular import (mujoco.build imports this module)
+    from mujoco.build import build_worker_agent
+    _worker_agent = build_worker_agent(cfg)
+
+
+def _calculate_columns(args):
+    data_snapshot, columns, qpos_fwd, qvel_fwd, reward, ctrls = args
+    with _worker_agent.solver_profiles.use("fd"):
+        return calculate_columns(_worker_agent, data_snapshot, columns, qpos_fwd, qvel_fwd, reward, ctrls)
+
+
+def _calculate_gradients(args):
+    data_snapshot, next_state, reward, test = args
+    with _worker_agent.solver_profiles.use("fd"):
+        return gradient_engine(_worker_agent.cfg)(_worker_agent, data_snapshot, next_state, reward, test=test)
+
+
+class GradientPool(object):
+    """Computes finite-difference Jacobian columns in a pool of worker processes. Every worker builds its own
+    simulation from the same config, receives the snapshot of the main simulation, and computes a slice of the columns.
+    """
+
+    def __init__(self, cfg):
+        self.size = cfg.MUJOCO.POOL_SIZE
+
+        # Use spawn instead of fork so workers don't inherit the main process' simulation and viewer (OpenGL) state
+        ctx = multiprocessing.get_context("spawn")
+        self.pool = ctx.Pool(self.size, initializer=_initialise_worker, initargs=(cfg,))
+
+    def calculate_columns(self, data_snapshot, columns, qpos_fwd, qvel_fwd, reward, ctrls=None):
+        """
+        :param columns: iterable of column indices, see mujoco.utils.backward.calculate_columns
+        :param ctrls: controls of the columns with closed-loop policies [len(columns), nu] (workers have no policy net)
+        :return: state gradients [nq+nv, len(columns)] and reward gradients [len(columns)]
+        """
+
+        # Split columns (and their controls) into (at most) one contiguous slice per worker
+        chunks = [chunk for chunk in np.array_split(np.arange(len(columns)), self.size) if len(chunk) > 0]
+        columns = np.asarray(columns)
+        results = self.pool.map(_calculate_columns,
+                                [(data_snapshot, columns[chunk], qpos_fwd, qvel_fwd, reward,
+                                  None if ctrls is None else ctrls[chunk]) for chunk in chunks])
+
+        # Assemble the slices in the original column order
+        dsdcol = np.concatenate([result[0] for result in results], axis=1)
+        drdcol = np.concatenate([result[1] for result in results])
+        return dsdcol, drdcol
+
+    def submit(self, data_snapshot, next_state, reward, test=False):
+        """
+        Start calculating all jacobians of one step in a worker, without waiting for them
+        :return: multiprocessing.pool.AsyncResult; get() returns dynamics and reward gradients
+        """
+        # Arguments are pickled later in the pool's task handler thread, when the snapshot's row of the ring buffer may
+        # already have been overwritten
+        return self.pool.apply_async(_calculate_gradients, ((data_snapshot.detach(), next_state, reward, test),))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
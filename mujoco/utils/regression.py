@@ -0,0 +1,124 @@
+import numpy as np
+
+
+class TransitionRegression(object):
+    """
+    Time-varying linear model [s_t+1, r_t] ~ J_t [s_t, a_t] + c_t fitted to the transitions of every episode of a
+    batch at each step (like guided policy search does), so jacobians come from the batch's own rollouts instead of
+    finite differences. The fit of each step is regularised towards the previous batch's one with
+    MODEL.GRADIENTS.REGRESSION_PRIOR, and isn't used if its relative residual exceeds REGRESSION_MAX_RESIDUAL.
+    """
+
+    def __init__(self, cfg, agent):
+        self.prior_weight = cfg.MODEL.GRADIENTS.REGRESSION_PRIOR
+        self.max_residual = cfg.MODEL.GRADIENTS.REGRESSION_MAX_RESIDUAL
+        self.horizon = cfg.MODEL.POLICY.MAX_HORIZON_STEPS
+        self.batch_size = cfg.MODEL.BATCH_SIZE
+
+        # Transitions of the current batch: inputs [s_t, a_t] and outputs [s_t+1, r_t] of every step and episode
+        m = agent.model
+        state_size = m.nq + m.nv
+        self.inputs = np.empty((self.horizon, self.batch_size, state_size + m.nu))
+        self.outputs = np.empty((self.horizon, self.batch_size, state_size + 1))
+        self.valid = np.zeros((self.horizon, self.batch_size), dtype=bool)
+
+        # Same Index object IndexWrapper counts episodes with (one-based)
+        self.episode_idx = agent.get_episode_idx()
+
+        # Fits of the current batch (None if finite differences are needed), and priors from the previous batch
+        self.fits = [None] * self.horizon
+        self.fitted = np.zeros(self.horizon, dtype=bool)
+        self.priors = [None] * self.horizon
+
+        # Bookkeeping
+        self.steps_fitted = 0
+        self.fallbacks = 0
+        self.residuals = []
+
+    def record(self, step_idx, state, action, next_state, reward):
+        """Keep a transition of the rollout; called by the forward pass"""
+        if step_idx >= self.horizon:
+            return
+        episode = (self.episode_idx.value - 1) % self.batch_size
+
+        # First step of the first episode starts a new batch
+        if step_idx == 0 and episode == 0:
+            self.valid[:] = False
+
+        self.inputs[step_idx, episode, :state.shape[0]] = state
+        self.inputs[step_idx, episode, state.shape[0]:] = action
+        self.outputs[step_idx, episode, :-1] = next_state
+        self.outputs[step_idx, episode, -1] = np.asarray(reward).item()
+        self.valid[step_idx, episode] = True
+        self.fitted[step_idx] = False
+
+    def jacobian(self, step_idx):
+        """
+        :return: fitted jacobian [[dsds, dsda], [drds, drda]] of a step, or None if finite differences are needed
+        """
+        if step_idx >= self.horizon:
+            return None
+
+        # The fit is shared by every episode of the batch, so it's calculated once
+        if not self.fitted[step_idx]:
+            self.fits[step_idx] = self.fit(step_idx)
+            self.fitted[step_idx] = True
+            if self.fits[step_idx] is not None:
+                self.steps_fitted += 1
+
+        return self.fits[step_idx]
+
+    def fit(self, step_idx):
+        inputs = self.inputs[step_idx, self.valid[step_idx]]
+        outputs = self.outputs[step_idx, self.valid[step_idx]]
+        prior = self.priors[step_idx]
+
+        # Without a prior the batch alone has to determine the jacobian
+        if len(inputs) < 2 or (prior is None and len(inputs) <= inputs.shape[1]):
+            return None
+
+        # The constant c_t is taken care of by centering
+        inputs = inputs - inputs.mean(axis=0)
+        outputs = outputs - outputs.mean(axis=0)
+        xx = np.matmul(inputs.T, inputs)
+        yx = np.matmul(outputs.T, inputs)
+
+        # Episodes that took the same actions from the same states don't tell anything
+        if np.trace(xx) == 0:
+            return None
+
+        # Ridge regression towards the prior, weighed relative to the average variance of the inputs; without a prior
+        # every direction has to vary in the batch (e.g. initial states are often the same in every episode)
+        if prior is None:
+            if np.linalg.matrix_rank(xx) < xx.shape[0]:
+                return None
+            jacobian = np.linalg.solve(xx, yx.T).T
+        else:
+            regularisation = self.prior_weight * np.trace(xx) / xx.shape[0]
+            jacobian = np.linalg.solve(xx + regularisation * np.identity(xx.shape[0]),
+                                       (yx + regularisation * prior).T).T
+
+        # Relative residual of the batch's transitions
+        residual = np.linalg.norm(outputs - np.matmul(inputs, jacobian.T)) / max(np.linalg.norm(outputs), 1e-12)
+        self.residuals.append(residual)
+        if residual > self.max_residual:
+            return None
+
+        self.priors[step_idx] = jacobian
+        return jacobian
+
+    def fallback(self, step_idx, jacobian):
+        """Use a jacobian calculated with finite differences as the prior of a step"""
+        self.fallbacks += 1
+        if step_idx < self.horizon:
+            self.priors[step_idx] = jacobian
+
+    def report(self):
+        residual = "{:.3g} mean, {:.3g} max".format(np.mean(self.residuals), np.max(self.residuals)) \
+            if self.residuals else "n/a"
+        report = "{} steps fitted (relative residual {}), {} finite-difference fallbacks".format(
+            self.steps_fitted, residual, self.fallbacks)
+        self.steps_fitted = 0
+        self.fallbacks = 0
+        self.residuals = []
+        return report
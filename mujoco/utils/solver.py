@@ -0,0 +1,79 @@
+import time
+from contextlib import contextmanager
+
+
+class SolverProfile(object):
+    """Constraint solver settings, plus the steps and time spent under them"""
+
+    def __init__(self, cfg, opt):
+        # Zero iterations keeps the model's own setting
+        self.iterations = cfg.ITERATIONS if cfg.ITERATIONS > 0 else opt.iterations
+        self.tolerance = cfg.TOLERANCE
+        self.warmstart = cfg.WARMSTART
+        self.steps = 0
+        self.seconds = 0.0
+
+    def apply(self, opt, dsbl_warmstart):
+        """
+        :param dsbl_warmstart: bit of opt.disableflags that disables warmstart in the bindings opt belongs to
+        """
+        opt.iterations = self.iterations
+        opt.tolerance = self.tolerance
+        if self.warmstart:
+            opt.disableflags &= ~dsbl_warmstart
+        else:
+            opt.disableflags |= dsbl_warmstart
+
+
+class SolverProfiles(object):
+    """
+    Solver profiles for nominal rollouts (MUJOCO.ROLLOUT_SOLVER) and finite differences (MUJOCO.FD_SOLVER). The rollout
+    profile is active by default, and the finite-difference one is swapped in around the finite-difference loops.
+    """
+
+    def __init__(self, cfg, backend):
+        # Options of every model the backend simulates with, and their warmstart bits
+        self.opts = backend.solver_options()
+        self.dsbl_warmstart = backend.warmstart_disable_bits()
+        self.profiles = {"rollout": SolverProfile(cfg.MUJOCO.ROLLOUT_SOLVER, self.opts[0]),
+                         "fd": SolverProfile(cfg.MUJOCO.FD_SOLVER, self.opts[0])}
+        self.active = None
+        self.started = time.perf_counter()
+        self.activate("rollout")
+
+    def activate(self, name):
+        # Charge the time since the last swap to the profile that was active
+        now = time.perf_counter()
+        if self.active is not None:
+            self.profiles[self.active].seconds += now - self.started
+        self.started = now
+
+        self.active = name
+        for opt, dsbl_warmstart in zip(self.opts, self.dsbl_warmstart):
+            self.profiles[name].apply(opt, dsbl_warmstart)
+
+    @contextmanager
+    def use(self, name):
+        previous = self.active
+        if name != previous:
+            self.activate(name)
+        try:
+            yield
+        finally:
+            if name != previous:
+                self.activate(previous)
+
+    def differ(self):
+        """Whether finite differences are simulated with other solver settings than the rollouts"""
+        rollout = self.profiles["rollout"]
+        fd = self.profiles["fd"]
+        return (rollout.iterations, rollout.tolerance, rollout.warmstart) != (fd.iterations, fd.tolerance, fd.warmstart)
+
+    def count_step(self):
+        self.profiles[self.active].steps += 1
+
+    def report(self):
+        # Bring the active profile's time up to date
+        self.activate(self.active)
+        return ", ".join("{} {} steps in {:.2f}s".format(name, profile.steps, profile.seconds)
+                         for name, profile in self.profiles.items())
@@ -0,0 +1,154 @@
+import multiprocessing
+import numpy as np
+
+from mujoco.utils.backward import gradient_engine
+
+
+def reset_agent(agent):
+    return agent.reset()
+
+
+def step_agent(agent, state, action):
+    """
+    Set state and action, take a snapshot, and advance the simulation by one step
+    :return: next state, reward, done, and snapshot
+    """
+    kernel = agent.kernel
+    kernel.data.qpos[:] = state[:kernel.model.nq]
+    kernel.data.qvel[:] = state[kernel.model.nq:]
+    kernel.data.ctrl[:] = action
+    data_snapshot = kernel.snapshot()
+    next_state, reward, done, _ = kernel.step_raw(action.copy())
+    return next_state, np.asarray(reward).item(), done, data_snapshot
+
+
+def gradients_agent(agent, data_snapshot, next_state, reward):
+    """
+    :return: dsds [S, S], dsda [S, A], drds [S], drda [A]
+    """
+    # Backward can be called in the middle of a rollout (MODEL.TRUNCATED_BPTT), so leave the simulation as it was
+    with agent.kernel.preserved(), agent.solver_profiles.use("fd"):
+        dynamics_gradients, reward_gradients = \
+            gradient_engine(agent.cfg)(agent, data_snapshot, next_state, reward, test=True)
+    return dynamics_gradients["state"], dynamics_gradients["action"], \
+        reward_gradients["state"].reshape(-1), reward_gradients["action"].reshape(-1)
+
+
+def _vector_worker(cfg, nagents, connection):
+
+    # Import here to avoid a circular import (mujoco.build imports this module)
+    from mujoco.build import build_worker_agent
+    agents = [build_worker_agent(cfg) for _ in range(nagents)]
+    functions = {"reset": reset_agent, "step": step_agent, "gradients": gradients_agent}
+
+    while True:
+        command, args = connection.recv()
+        if command == "close":
+            break
+        connection.send([None if agent_args is None else functions[command](agent, *agent_args)
+                         for agent, agent_args in zip(agents, args)])
+
+
+class VectorAgent(object):
+    """
+    A batch of independent simulations (worker agents, see mujoco.build.build_worker_agent) that are stepped together.
+    Simulations are run in this process, or spread over worker processes if MUJOCO.VECTOR_WORKERS > 0.
+    """
+
+    def __init__(self, cfg, policy_net=None):
+        self.size = cfg.MODEL.BATCH_SIZE
+        self.nworkers = min(cfg.MUJOCO.VECTOR_WORKERS, self.size)
+        self.is_done = np.zeros(self.size, dtype=bool)
+
+        if self.nworkers > 0:
+            assert not cfg.MODEL.POLICY.NETWORK, "Closed-loop finite differences can't be calculated in workers"
+
+            # Agents are split into contiguous slices, one slice per worker
+            self.slices = np.array_split(np.arange(self.size), self.nworkers)
+            ctx = multiprocessing.get_context("spawn")
+            self.connections = []
+            self.workers = []
+            for agent_idxs in self.slices:
+                connection, worker_connection = ctx.Pipe()
+                worker = ctx.Process(target=_vector_worker, args=(cfg, len(agent_idxs), worker_connection),
+                                     daemon=True)
+                worker.start()
+                self.connections.append(connection)
+                self.workers.append(worker)
+
+        else:
+            # Import here to avoid a circular import (mujoco.build imports this module)
+            from mujoco.build import build_worker_agent
+            self.agents = [build_worker_agent(cfg) for _ in range(self.size)]
+
+            # Closed-loop finite differences need the policy
+            for agent in self.agents:
+                agent.unwrapped.policy_net = policy_net
+
+    def _run(self, command, function, args):
+        """
+        Run function for every agent with the given per-agent args; returns a list of results
+        :param args: list of per-agent args, None for agents that are skipped (their result is None)
+        """
+        if self.nworkers > 0:
+            for connection, agent_idxs in zip(self.connections, self.slices):
+                connection.send((command, [args[idx] for idx in agent_idxs]))
+            return [result for connection in self.connections for result in connection.recv()]
+        else:
+            return [None if agent_args is None else function(agent, *agent_args)
+                    for agent, agent_args in zip(self.agents, args)]
+
+    def reset(self):
+        """
+        :return: initial states [B, S]
+        """
+        self.is_done[:] = False
+        return np.stack(self._run("reset", reset_agent, [()] * self.size))
+
+    def step(self, states, actions, active=None):
+        """
+        :param states: np.array [B, S]
+        :param actions: np.array [B, A]
+        :param active: np.array [B] of episodes to step (default all); the others stay in their states with zero
+                       rewards and no snapshots, and remain done
+        :return: next states [B, S], rewards [B], and a list of snapshots
+        """
+        if active is None:
+            active = np.ones(self.size, dtype=bool)
+        results = self._run("step", step_agent, [(state, action) if episode_active else None
+                                                 for state, action, episode_active in zip(states, actions, active)])
+
+        next_states = np.array(states, dtype=np.float64)
+        rewards = np.zeros(self.size)
+        snapshots = [None] * self.size
+        for agent_idx in np.flatnonzero(active):
+            next_states[agent_idx], rewards[agent_idx], self.is_done[agent_idx], snapshots[agent_idx] = \
+                results[agent_idx]
+        return next_states, rewards, snapshots
+
+    def gradients(self, snapshots, next_states, rewards):
+        """
+        :param snapshots: list of snapshots from step, None for episodes that weren't stepped
+        :return: jacobian stacks dsds [B, S, S], dsda [B, S, A], drds [B, S], drda [B, A]; rows of episodes that
+                 weren't stepped are zero
+        """
+        results = self._run("gradients", gradients_agent,
+                            [None if snapshot is None else (snapshot, next_state, reward)
+                             for snapshot, next_state, reward in zip(snapshots, next_states, rewards)])
+
+        shapes = [np.shape(jacobian) for jacobian in next(result for result in results if result is not None)]
+        stacks = [np.zeros((self.size,) + shape) for shape in shapes]
+        for agent_idx, result in enumerate(results):
+            if result is not None:
+                for stack, jacobian in zip(stacks, result):
+                    stack[agent_idx] = jacobian
+        return stacks
+
+    def close(self):
+        if self.nworkers > 0:
+            for connection, worker in zip(self.connections, self.workers):
+                connection.send(("close", None))
+                worker.join()
+                connection.close()
+            self.connections = []
+            self.workers = []
@@ -1,7 +1,6 @@
 import gym
 import torch
 import numpy as np
-from copy import deepcopy
 from utils.index import Index
 import mujoco_py
 from multiprocessing import Process, Queue
@@ -88,47 +87,119 @@ class TorchTensorWrapper(gym.Wrapper):
     #    return self.env.is_done(state)
 
 
-class SnapshotWrapper(gym.Wrapper):
-    """Handles all stateful stuff, like getting and setting snapshots of states, and resetting"""
-    def get_snapshot(self):
-
-        class DataSnapshot:
-            # Note: You should not modify these parameters after creation
+class SnapshotLayout:
+    """Where each field of MjData is packed in a flat float64 snapshot row; the last element holds step index"""
+
+    fields = ("time", "qpos", "qvel", "qacc_warmstart", "ctrl", "act", "qfrc_applied", "xfrc_applied",
+              # These probably aren't necessary, but they should fix the body in the same position with
+              # respect to worldbody frame?
+              "body_xpos", "body_xquat")
+
+    def __init__(self, d):
+        self.slices = {}
+        self.shapes = {}
+        offset = 0
+        for field in self.fields:
+            # act is None when there are no actuator activations
+            value = getattr(d, field)
+            shape = (0,) if value is None else np.shape(value)
+            size = int(np.prod(shape))
+            self.slices[field] = slice(offset, offset + size)
+            self.shapes[field] = shape
+            offset += size
+        self.step_idx = offset
+        self.size = offset + 1
+
+    def pack(self, d, step_idx, row):
+        """Copy data and step index into row"""
+        for field in self.fields:
+            sl = self.slices[field]
+            if sl.start < sl.stop:
+                row[sl] = np.ravel(getattr(d, field))
+        row[self.step_idx] = step_idx.value
+
+    def unpack(self, row, d):
+        """Copy a row back into data; returns the step index"""
+        d.time = row[self.slices["time"]][0]
+        for field in self.fields[1:]:
+            sl = self.slices[field]
+            if sl.start < sl.stop:
+                getattr(d, field)[:] = row[sl].reshape(self.shapes[field])
+        return Index(int(row[self.step_idx]))
+
+
+class DataSnapshot:
+    # Note: You should not modify these parameters after creation
+    # (defined at module level so snapshots can be pickled and sent to worker processes)
+
+    def __init__(self, row, layout):
+        # A view into a row of SnapshotBuffer
+        self.row = row
+        self.layout = layout
+
+    def __getattr__(self, field):
+        # Fields are views into the row
+        layout = self.__dict__.get("layout")
+        if layout is None:
+            raise AttributeError(field)
+        elif field == "time":
+            return self.row[layout.slices["time"]][0]
+        elif field == "step_idx":
+            return Index(int(self.row[layout.step_idx]))
+        elif field in layout.slices:
+            return self.row[layout.slices[field]].reshape(layout.shapes[field])
+        raise AttributeError(field)
+
+    def detach(self):
+        """Copy of this snapshot with its own row, which isn't overwritten when the ring buffer wraps"""
+        return DataSnapshot(self.row.copy(), self.layout)
+
+    def __getstate__(self):
+        # Pickle only this row, not the whole buffer it's a view into
+        return {"row": self.row.copy(), "layout": self.layout}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class SnapshotBuffer:
+    """
+    Preallocated ring buffer of snapshot rows [capacity, snapshot size]. Taking a snapshot packs data into the next row,
+    overwriting the oldest one, so capacity must cover all snapshots that are needed at the same time (e.g. all steps
+    of a batch whose backward hasn't been called yet).
+    """
+
+    def __init__(self, d, capacity):
+        self.layout = SnapshotLayout(d)
+        self.rows = np.empty((capacity, self.layout.size))
+        self.next_row = 0
+
+    def pack(self, d, step_idx):
+        row = self.rows[self.next_row]
+        self.next_row = (self.next_row + 1) % self.rows.shape[0]
+        self.layout.pack(d, step_idx, row)
+        return DataSnapshot(row, self.layout)
+
+    def pack_copy(self, d, step_idx):
+        """Like pack, but into a new row outside the ring buffer"""
+        row = np.empty(self.layout.size)
+        self.layout.pack(d, step_idx, row)
+        return DataSnapshot(row, self.layout)
 
-            def __init__(self, d_source, step_idx):
-                self.time = deepcopy(d_source.time)
-                self.qpos = deepcopy(d_source.qpos)
-                self.qvel = deepcopy(d_source.qvel)
-                self.qacc_warmstart = deepcopy(d_source.qacc_warmstart)
-                self.ctrl = deepcopy(d_source.ctrl)
-                self.act = deepcopy(d_source.act)
-                self.qfrc_applied = deepcopy(d_source.qfrc_applied)
-                self.xfrc_applied = deepcopy(d_source.xfrc_applied)
 
-                self.step_idx = deepcopy(step_idx)
+class SnapshotWrapper(gym.Wrapper):
+    """Handles all stateful stuff, like getting and setting snapshots of states, and resetting"""
 
-                # These probably aren't necessary, but they should fix the body in the same position with
-                # respect to worldbody frame?
-                self.body_xpos = deepcopy(d_source.body_xpos)
-                self.body_xquat = deepcopy(d_source.body_xquat)
+    def __init__(self, env, capacity):
+        super(SnapshotWrapper, self).__init__(env)
+        self.snapshot_buffer = SnapshotBuffer(self.env.sim.data, capacity)
 
-        return DataSnapshot(self.env.sim.data, self.get_step_idx())
+    def get_snapshot(self):
+        return self.snapshot_buffer.pack(self.env.sim.data, self.get_step_idx())
 
     def set_snapshot(self, snapshot_data):
-        self.env.sim.data.time = deepcopy(snapshot_data.time)
-        self.env.sim.data.qpos[:] = deepcopy(snapshot_data.qpos)
-        self.env.sim.data.qvel[:] = deepcopy(snapshot_data.qvel)
-        self.env.sim.data.qacc_warmstart[:] = deepcopy(snapshot_data.qacc_warmstart)
-        self.env.sim.data.ctrl[:] = deepcopy(snapshot_data.ctrl)
-        if snapshot_data.act is not None:
-            self.env.sim.data.act[:] = deepcopy(snapshot_data.act)
-        self.env.sim.data.qfrc_applied[:] = deepcopy(snapshot_data.qfrc_applied)
-        self.env.sim.data.xfrc_applied[:] = deepcopy(snapshot_data.xfrc_applied)
-
-        self.set_step_idx(snapshot_data.step_idx)
-
-        self.env.sim.data.body_xpos[:] = deepcopy(snapshot_data.body_xpos)
-        self.env.sim.data.body_xquat[:] = deepcopy(snapshot_data.body_xquat)
+        step_idx = snapshot_data.layout.unpack(snapshot_data.row, self.env.sim.data)
+        self.set_step_idx(step_idx)
 
 
 class IndexWrapper(gym.Wrapper):
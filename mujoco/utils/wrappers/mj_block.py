@@ -11,6 +11,43 @@ class MjBlockWrapper(gym.Wrapper):
     def __init__(self, env):
         gym.Wrapper.__init__(self, env)
 
+        # A mujoco.utils.pool.GradientPool if finite differences are computed in worker processes
+        self.gradient_pool = None
+
+        # Simulator backend, see mujoco.utils.backend
+        self.backend = None
+
+        # Solver settings for rollouts and finite differences, see mujoco.utils.solver.SolverProfiles
+        self.solver_profiles = None
+
+        # Resolved wrapper chain for hot loops, see mujoco.utils.kernel.SteppingKernel
+        self.kernel = None
+
+        # Jacobian sparsity pattern for the "sparse" gradient engine, see mujoco.utils.backward.JacobianSparsity
+        self.sparsity = None
+
+        # Jacobians reused between finite-difference refreshes, see mujoco.utils.backward.BroydenJacobian
+        self.broyden = None
+
+        # Jacobians estimated from random directions, see mujoco.utils.backward.SketchedJacobian
+        self.sketch = None
+
+        # Only every k-th snapshot is kept if set, see mujoco.utils.checkpoint.SnapshotCheckpoints
+        self.snapshot_checkpoints = None
+
+        # Jacobians are fitted to the transitions of the batch if set, see mujoco.utils.regression.TransitionRegression
+        self.regression = None
+
+        # Dynamics jacobians from a trained network if set, see mujoco.utils.learned.LearnedJacobian
+        self.learned_dynamics = None
+
+    def close(self):
+        # Worker processes aren't daemons that would go away with the agent, so the pool is shut down explicitly
+        if self.gradient_pool is not None:
+            self.gradient_pool.close()
+            self.gradient_pool = None
+        return self.env.close()
+
     def gradient_factory(self, mode):
         """
         :param mode: 'dynamics' or 'reward'
@@ -40,12 +77,12 @@ class MjBlockWrapper(gym.Wrapper):
         def decorator(gradients_fn):
             def wrapper(*args, **kwargs):
                 #if mode == "forward":
-                gradients_fn(*args, **kwargs)
+                gradients = gradients_fn(*args, **kwargs)
                 #else:
                 #    dfds, dfda = gradients_fn(*args, **kwargs)
                 #    # no further reshaping is needed for the case of hopper, also it's mode-agnostic
                 #    gradients = np.concatenate([dfds, dfda], axis=1)
-                return
+                return gradients
 
             return wrapper
 
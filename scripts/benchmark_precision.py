@@ -0,0 +1,85 @@
+"""
+Per-step tensor allocations, peak memory of numpy arrays and other Python objects, and time of forward and backward
+through the policy and the fused block for each MODEL.PRECISION.
+Run with: python -m scripts.benchmark_precision [--env InvertedPendulumEnv] [--steps 100]
+"""
+import argparse
+import time
+import tracemalloc
+
+import torch
+from torch.autograd import profiler
+from model.config import get_cfg_defaults
+from mujoco import build_agent
+from model import build_model
+
+
+def run_steps(model, agent, steps):
+    """Roll out steps with the model and backpropagate the summed reward"""
+    state = torch.tensor(agent.reset(), dtype=model.dtype)
+    rewards = []
+    for step_idx in range(steps):
+        state, reward = model(state)
+        rewards.append(reward)
+        if agent.is_done:
+            break
+    model.policy_net.zero_grad()
+    torch.cat(rewards).sum().backward()
+    return len(rewards)
+
+
+def benchmark(env, precision, steps):
+    cfg = get_cfg_defaults()
+    cfg.MUJOCO.ENV = env
+    cfg.MODEL.PRECISION = precision
+    cfg.MODEL.POLICY.ARCH = "VariationalOptimization"
+    cfg.MODEL.POLICY.MAX_HORIZON_STEPS = steps
+    cfg.MODEL.BATCH_SIZE = 1
+
+    # Frames are recorded only when asked for, so no viewer (or display) is needed
+    cfg.LOG.TESTING.RECORD_VIDEO = True
+    cfg.freeze()
+
+    agent = build_agent(cfg)
+    try:
+        model = build_model(cfg, agent)
+        model.train()
+
+        # Warm up so one-time allocations (buffers, caches) aren't counted
+        run_steps(model, agent, steps)
+
+        # Torch tensor allocations
+        with profiler.profile(profile_memory=True) as prof:
+            nsteps = run_steps(model, agent, steps)
+        tensor_allocations = sum(1 for event in prof.function_events if event.cpu_memory_usage > 0)
+
+        # Numpy arrays and other Python objects (tensor storage isn't traced)
+        tracemalloc.start()
+        run_steps(model, agent, steps)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Time without any profiling
+        start = time.perf_counter()
+        run_steps(model, agent, steps)
+        seconds = time.perf_counter() - start
+    finally:
+        agent.close()
+
+    return tensor_allocations / nsteps, peak_bytes / 1e3, 1e3 * seconds / nsteps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark allocations and time for each precision mode")
+    parser.add_argument("--env", default="InvertedPendulumEnv")
+    parser.add_argument("--steps", type=int, default=100)
+    args = parser.parse_args()
+
+    print("{:<8} {:>16} {:>16} {:>10}".format("mode", "tensors / step", "peak numpy KB", "ms / step"))
+    for precision in ["mixed", "single", "double"]:
+        tensors, peak_kb, ms = benchmark(args.env, precision, args.steps)
+        print("{:<8} {:>16.1f} {:>16.1f} {:>10.2f}".format(precision, tensors, peak_kb, ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import unittest
+
+import numpy as np
+import torch
+from model import build_model
+from model.blocks.mujoco import reset_running_sums
+from tests.test_engines import build_test_agent
+
+
+def build_test_model(*options):
+    """Agent and model of a small env, see build_test_agent"""
+    agent = build_test_agent("MODEL.POLICY.ARCH", "VariationalOptimization", *options)
+    model = build_model(agent.cfg, agent)
+    model.train()
+    return agent, model
+
+
+def random_actions(batch_size, nsteps, nu, seed=0):
+    """Actions [B, T, A] that require gradients"""
+    actions = np.random.RandomState(seed).uniform(-1, 1, (batch_size, nsteps, nu))
+    return torch.tensor(actions, dtype=torch.float64, requires_grad=True)
+
+
+def fused_rollout(agent, model, actions):
+    """
+    Roll out each episode with the fused block, and backpropagate the sum of its rewards; running sums are reset once
+    for the batch like the trainer does
+    :return: rewards [B, T], and gradients of the actions [B, T, A]
+    """
+    rewards = torch.zeros(actions.shape[:2], dtype=torch.float64)
+    reset_running_sums(agent)
+    for episode_idx in range(actions.shape[0]):
+        state = torch.tensor(agent.reset(), dtype=model.dtype)
+        episode_rewards = []
+        for step_idx in range(actions.shape[1]):
+            state, reward = model.mj_block(state, actions[episode_idx, step_idx].to(model.dtype))
+            episode_rewards.append(reward)
+        torch.cat(episode_rewards).sum().backward()
+        rewards[episode_idx] = torch.cat(episode_rewards).detach().double()
+    return rewards, actions.grad.clone()
+
+
+def windowed_rollout(agent, model, actions, window):
+    """
+    Roll out one episode with the fused block like the trainer does with MODEL.TRUNCATED_BPTT: losses of each window
+    are backpropagated when it ends, and the state it ended in is detached
+    :param actions: actions [1, T, A] that require gradients
+    :return: rewards [T], and gradients of the actions [T, A]
+    """
+    state = torch.tensor(agent.reset(), dtype=model.dtype)
+    rewards, window_loss = [], []
+    for step_idx in range(actions.shape[1]):
+        state, reward = model.mj_block(state, actions[0, step_idx].to(model.dtype))
+        rewards.append(reward.detach().double())
+        window_loss.append(-reward.reshape(-1))
+        if (step_idx + 1) % window == 0:
+            model.policy_net.truncated_backward(torch.cat(window_loss))
+            window_loss = []
+            state = state.detach()
+    if window_loss:
+        model.policy_net.truncated_backward(torch.cat(window_loss))
+    return torch.cat(rewards), actions.grad[0].clone()
+
+
+class TestBlocks(unittest.TestCase):
+
+    def assert_batch_block_matches_fused(self, grad_weights):
+        agent, model = build_test_model("MODEL.BATCH_BLOCK", True, "MODEL.POLICY.GRAD_WEIGHTS", grad_weights)
+        self.addCleanup(agent.close)
+        self.addCleanup(model.close)
+        actions = random_actions(agent.cfg.MODEL.BATCH_SIZE, 5, agent.model.nu)
+        rewards, grads = fused_rollout(agent, model, actions)
+        actions.grad = None
+
+        # All episodes stepped together
+        states = torch.from_numpy(model.vector_agent.reset())
+        active = torch.ones(agent.cfg.MODEL.BATCH_SIZE, dtype=torch.bool)
+        reset_running_sums(agent)
+        batch_rewards = []
+        for step_idx in range(actions.shape[1]):
+            states, step_rewards = model.batch_block(states, actions[:, step_idx], active)
+            batch_rewards.append(step_rewards)
+        torch.stack(batch_rewards, dim=1).sum().backward()
+
+        np.testing.assert_allclose(torch.stack(batch_rewards, dim=1).detach().numpy(), rewards.numpy())
+        np.testing.assert_allclose(actions.grad.numpy(), grads.numpy(), rtol=1e-6, atol=1e-9)
+
+    def test_batch_block(self):
+        self.assert_batch_block_matches_fused("average")
+
+    def test_batch_block_prioritise(self):
+        # Running sums are kept for each episode
+        self.assert_batch_block_matches_fused("prioritise")
+
+    def test_batch_block_finished_episodes(self):
+        agent, model = build_test_model("MODEL.BATCH_BLOCK", True)
+        self.addCleanup(agent.close)
+        self.addCleanup(model.close)
+        actions = random_actions(agent.cfg.MODEL.BATCH_SIZE, 5, agent.model.nu)
+
+        # Second episode finishes after two steps
+        states = torch.from_numpy(model.vector_agent.reset())
+        active = torch.ones(agent.cfg.MODEL.BATCH_SIZE, dtype=torch.bool)
+        batch_rewards = []
+        for step_idx in range(actions.shape[1]):
+            if step_idx == 2:
+                active[1] = False
+                finished_state = states[1].detach().clone()
+            states, step_rewards = model.batch_block(states, actions[:, step_idx], active.clone())
+            batch_rewards.append(step_rewards)
+        torch.stack(batch_rewards, dim=1).sum().backward()
+
+        # Finished episode isn't simulated, and gets no rewards or gradients; the running one isn't affected
+        self.assertTrue(torch.equal(states[1].detach(), finished_state))
+        self.assertTrue((torch.stack(batch_rewards, dim=1)[1, 2:] == 0).all())
+        self.assertTrue(torch.isfinite(actions.grad).all())
+        self.assertTrue((actions.grad[1, 2:] == 0).all())
+        self.assertTrue((actions.grad[1, :2] != 0).any())
+        _, grads = fused_rollout(agent, model, random_actions(1, 5, agent.model.nu))
+        np.testing.assert_allclose(actions.grad[0].numpy(), grads[0].numpy(), rtol=1e-6, atol=1e-9)
+
+    def test_snapshot_checkpoints(self):
+        for precision in ["double", "single"]:
+            agent, model = build_test_model("MODEL.PRECISION", precision)
+            self.addCleanup(agent.close)
+            actions = random_actions(agent.cfg.MODEL.BATCH_SIZE, 7, agent.model.nu)
+            rewards, grads = fused_rollout(agent, model, actions)
+
+            # Re-simulated snapshots match the ones the rollout took (backward checks the forward pass), also when
+            # states are rounded to single precision between steps
+            agent, model = build_test_model("MODEL.PRECISION", precision, "MUJOCO.SNAPSHOT_CHECKPOINT_PERIOD", 3)
+            self.addCleanup(agent.close)
+            actions.grad = None
+            checkpoint_rewards, checkpoint_grads = fused_rollout(agent, model, actions)
+            self.assertGreater(agent.snapshot_checkpoints.resimulated, 0)
+            np.testing.assert_array_equal(checkpoint_rewards.numpy(), rewards.numpy())
+            np.testing.assert_array_equal(checkpoint_grads.numpy(), grads.numpy())
+
+    def test_jacobian_cache(self):
+        agent, model = build_test_model()
+        self.addCleanup(agent.close)
+        fd = agent.solver_profiles.profiles["fd"]
+        actions = random_actions(1, 5, agent.model.nu)
+        state = torch.tensor(agent.reset(), dtype=model.dtype)
+        rewards = []
+        for step_idx in range(actions.shape[1]):
+            state, reward = model.mj_block(state, actions[0, step_idx].to(model.dtype))
+            rewards.append(reward)
+        loss = torch.cat(rewards).sum()
+
+        # Finite differences run in the first backward pass only; the second one through the same graph reuses them
+        loss.backward(retain_graph=True)
+        grads = actions.grad.clone()
+        fd_steps = fd.steps
+        self.assertGreater(fd_steps, 0)
+        loss.backward()
+        self.assertEqual(fd.steps, fd_steps)
+        np.testing.assert_allclose(actions.grad.numpy(), 2 * grads.numpy(), rtol=1e-12)
+
+        # A new rollout builds new nodes, so its jacobians are calculated again
+        actions.grad = None
+        _, new_grads = fused_rollout(agent, model, actions)
+        self.assertGreater(fd.steps, fd_steps)
+        np.testing.assert_allclose(new_grads.numpy(), grads.numpy(), rtol=1e-12)
+
+    def test_truncated_backward(self):
+        agent, model = build_test_model()
+        self.addCleanup(agent.close)
+        horizon, window = 6, 2
+        actions = random_actions(1, horizon, agent.model.nu)
+        rewards, grads = fused_rollout(agent, model, actions)
+
+        # Windows that cover the whole episode backpropagate the objective (rewards averaged over the batch) in full
+        for long_window in [horizon, horizon + 3]:
+            actions.grad = None
+            window_rewards, window_grads = windowed_rollout(agent, model, actions, long_window)
+            np.testing.assert_array_equal(window_rewards.numpy(), rewards[0].numpy())
+            np.testing.assert_allclose(-model.policy_net.batch_size * window_grads.numpy(), grads[0].numpy(),
+                                       rtol=1e-10, atol=1e-12)
+
+        # Shorter windows: actions only get gradients from the rewards of their own window
+        actions.grad = None
+        _, window_grads = windowed_rollout(agent, model, actions, window)
+        state = torch.tensor(agent.reset(), dtype=model.dtype)
+        step_rewards = []
+        for step_idx in range(horizon):
+            state, reward = model.mj_block(state, actions[0, step_idx].to(model.dtype))
+            step_rewards.append(reward)
+        expected = np.empty((horizon, agent.model.nu))
+        for start in range(0, horizon, window):
+            steps = slice(start, start + window)
+            window_reward = torch.cat(step_rewards[steps]).sum()
+            expected[steps] = torch.autograd.grad(window_reward, actions, retain_graph=True)[0][0, steps].numpy()
+        np.testing.assert_allclose(-model.policy_net.batch_size * window_grads.numpy(), expected,
+                                   rtol=1e-10, atol=1e-12)
+
+        # which differs from the full gradient wherever later windows' rewards depend on the action
+        self.assertFalse(np.allclose(window_grads[:window].numpy(), grads[0, :window].numpy() /
+                                     -model.policy_net.batch_size))
+
+
+if __name__ == '__main__':
+    unittest.main()
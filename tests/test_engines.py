@@ -0,0 +1,202 @@
+import os
+import unittest
+
+import numpy as np
+import torch
+import mujoco_py as mj
+from model.config import get_cfg_defaults
+from mujoco import build_agent
+from mujoco.utils.backward import calculate_columns, skip_engine_applicable
+from mujoco.utils.wrappers.etc import DataSnapshot
+
+
+def build_test_agent(*options):
+    """
+    Agent of a small env (the inverted pendulum) without a viewer
+    :param options: config keys and values like cfg.merge_from_list takes them, e.g. "MUJOCO.POOL_SIZE", 2
+    """
+    cfg = get_cfg_defaults()
+    cfg.MUJOCO.ENV = "InvertedPendulumEnv"
+    cfg.LOG.TESTING.RECORD_VIDEO = True
+    cfg.MODEL.POLICY.MAX_HORIZON_STEPS = 10
+    cfg.MODEL.BATCH_SIZE = 2
+    cfg.merge_from_list(list(options))
+    return build_agent(cfg)
+
+
+def use_euler(agent):
+    """Integrate with Euler (the pendulum's RK4 steps can't be differentiated substep by substep)"""
+    for opt in agent.backend.solver_options():
+        opt.integrator = mj.const.INT_EULER
+
+
+def rollout(agent, nsteps, seed=0):
+    """
+    Step the agent from reset with random actions that only depend on the seed
+    :return: snapshot of the last step, and the next state and reward it ended in
+    """
+    rng = np.random.RandomState(seed)
+    mj_forward = agent.forward_factory("dynamics")
+    agent.reset()
+    for _ in range(nsteps):
+        agent.data.ctrl[:] = rng.uniform(-1, 1, agent.model.nu)
+        data_snapshot = agent.get_snapshot()
+        next_state = mj_forward()
+    return data_snapshot, next_state, agent.reward
+
+
+def jacobian(agent, data_snapshot, next_state, reward):
+    """Jacobians of the configured engine as one matrix [[dsds, dsda], [drds, drda]]"""
+    return stacked(*agent.gradient_factory("dynamics")(data_snapshot, next_state, reward, test=True))
+
+
+def stacked(dynamics_gradients, reward_gradients):
+    """Dynamics and reward gradients as one matrix [[dsds, dsda], [drds, drda]]"""
+    return np.block([[dynamics_gradients["state"], dynamics_gradients["action"]],
+                     [np.reshape(reward_gradients["state"], (1, -1)), np.reshape(reward_gradients["action"], (1, -1))]])
+
+
+def reference_jacobian(nsteps=5, euler=False, *options):
+    """Jacobian of the "step" engine at the last step of a rollout, see rollout"""
+    agent = build_test_agent(*options)
+    if euler:
+        use_euler(agent)
+    try:
+        return jacobian(agent, *rollout(agent, nsteps))
+    finally:
+        agent.close()
+
+
+class TestEngines(unittest.TestCase):
+
+    def test_skip_engine(self):
+        agent = build_test_agent("MODEL.GRADIENTS.ENGINE", "skip")
+        self.addCleanup(agent.close)
+
+        # RK4 steps can't be chained substep by substep, so the env is stepped for every perturbation
+        self.assertFalse(skip_engine_applicable(agent))
+
+        # Euler substeps evaluated with mj_forwardSkip and chained give the jacobians of stepping the whole env
+        use_euler(agent)
+        self.assertTrue(skip_engine_applicable(agent))
+        for nsteps in [1, 5]:
+            np.testing.assert_allclose(jacobian(agent, *rollout(agent, nsteps)),
+                                       reference_jacobian(nsteps, euler=True), rtol=1e-3, atol=1e-5)
+
+
+class TestBackend(unittest.TestCase):
+
+    def test_native_backend(self):
+        assets = sorted(os.listdir(get_cfg_defaults().MUJOCO.ASSETS_PATH))
+        agent = build_test_agent("MUJOCO.BACKEND", "mujoco", "MODEL.GRADIENTS.ENGINE", "skip")
+        self.addCleanup(agent.close)
+
+        # Nothing is written next to the assets
+        self.assertEqual(sorted(os.listdir(get_cfg_defaults().MUJOCO.ASSETS_PATH)), assets)
+
+        # Same trajectory as mujoco-py simulates
+        reference = build_test_agent()
+        self.addCleanup(reference.close)
+        for nsteps in [1, 5]:
+            np.testing.assert_allclose(rollout(agent, nsteps)[1], rollout(reference, nsteps)[1], rtol=1e-6, atol=1e-9)
+
+        # RK4 steps are differentiated by stepping the whole env, Euler steps with mjd_transitionFD substep by substep
+        self.assertFalse(agent.backend.transition_derivatives_available())
+        np.testing.assert_allclose(jacobian(agent, *rollout(agent, 5)), reference_jacobian(), rtol=1e-3, atol=1e-5)
+        use_euler(agent)
+        self.assertTrue(agent.backend.transition_derivatives_available())
+        np.testing.assert_allclose(jacobian(agent, *rollout(agent, 5)), reference_jacobian(euler=True),
+                                   rtol=1e-3, atol=1e-5)
+
+    def test_solver_profiles(self):
+        for backend in ["mujoco_py", "mujoco"]:
+            agent = build_test_agent("MUJOCO.BACKEND", backend, "MUJOCO.FD_SOLVER.ITERATIONS", 7,
+                                     "MUJOCO.FD_SOLVER.WARMSTART", False)
+            self.addCleanup(agent.close)
+            opts = agent.backend.solver_options()
+            bits = agent.backend.warmstart_disable_bits()
+            iterations = [opt.iterations for opt in opts]
+
+            # Other flags are left alone
+            for opt in opts:
+                opt.disableflags = 0
+
+            # Finite-difference profile disables warmstart in every model, with the bit of its own bindings
+            with agent.solver_profiles.use("fd"):
+                for opt, bit in zip(opts, bits):
+                    self.assertEqual(opt.iterations, 7)
+                    self.assertEqual(opt.disableflags, bit)
+
+            # and the rollout profile puts everything back
+            for opt, model_iterations in zip(opts, iterations):
+                self.assertEqual(opt.iterations, model_iterations)
+                self.assertEqual(opt.disableflags, 0)
+
+
+class DeterministicPolicy(torch.nn.Module):
+    """Closed-loop policy without noise, so its forward and batch_mean give the same actions"""
+
+    def __init__(self, state_size, action_size, batched):
+        super(DeterministicPolicy, self).__init__()
+        self.linear = torch.nn.Linear(state_size, action_size).double()
+        self.has_batch_mean = batched
+
+    def forward(self, state):
+        return torch.tanh(self.linear(state))
+
+    def batch_mean(self, states):
+        return self.forward(states)
+
+
+class TestClosedLoop(unittest.TestCase):
+
+    def test_batched_controls(self):
+        agent = build_test_agent("MODEL.POLICY.NETWORK", True, "MODEL.PRECISION", "double")
+        self.addCleanup(agent.close)
+        m = agent.model
+        torch.manual_seed(0)
+        policy = DeterministicPolicy(m.nq + m.nv, m.nu, batched=False)
+        agent.unwrapped.policy_net = policy
+
+        # Roll out with the policy's own controls
+        mj_forward = agent.forward_factory("dynamics")
+        agent.reset()
+        for _ in range(5):
+            state = torch.from_numpy(np.concatenate((agent.data.qpos, agent.data.qvel)))
+            agent.data.ctrl[:] = policy(state).detach().numpy()
+            data_snapshot = agent.get_snapshot()
+            next_state = mj_forward()
+        args = (data_snapshot, range(m.nu + m.nv + m.nq), next_state[:m.nq], next_state[m.nq:], agent.reward)
+
+        # Policy evaluated for each perturbed state, and once for all of them with the change of its mean added to the
+        # snapshot's control
+        dsdcol, drdcol = calculate_columns(agent, *args)
+        policy.has_batch_mean = True
+        batched_dsdcol, batched_drdcol = calculate_columns(agent, *args)
+        np.testing.assert_allclose(batched_dsdcol, dsdcol, rtol=1e-6, atol=1e-6)
+        np.testing.assert_allclose(batched_drdcol, drdcol, rtol=1e-6, atol=1e-6)
+
+
+class TestGradientPool(unittest.TestCase):
+
+    def test_submit_wrapped_buffer(self):
+        agent = build_test_agent("MUJOCO.POOL_SIZE", 1, "MUJOCO.SNAPSHOT_BUFFER_SIZE", 2)
+        self.addCleanup(agent.close)
+        data_snapshot, next_state, reward = rollout(agent, 5)
+        row = data_snapshot.row.copy()
+
+        # Queue speculative jacobians behind each other, and wrap the ring buffer while they're pending
+        results = [agent.gradient_pool.submit(data_snapshot, next_state, reward, test=True) for _ in range(5)]
+        agent.reset()
+        for _ in range(2):
+            agent.get_snapshot()
+        self.assertFalse(np.array_equal(data_snapshot.row, row))
+
+        # Workers get the snapshot as it was when the jacobians were submitted (they check the forward pass too)
+        expected = jacobian(agent, DataSnapshot(row, data_snapshot.layout), next_state, reward)
+        for result in results:
+            np.testing.assert_allclose(stacked(*result.get()), expected, rtol=1e-12, atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
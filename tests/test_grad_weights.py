@@ -0,0 +1,66 @@
+import types
+import unittest
+
+import numpy as np
+import torch
+from model.config import get_cfg_defaults
+from model.blocks.mujoco import weighted_jacobian, weight_jacobian_stack
+
+
+class TestGradWeights(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg = get_cfg_defaults()
+        self.cfg.MODEL.POLICY.MAX_HORIZON_STEPS = 10
+        self.state_size, self.action_size = 3, 2
+
+        # Jacobians of a window of steps 4..8
+        rng = np.random.RandomState(0)
+        self.step_idx = np.arange(4, 9)
+        n = len(self.step_idx)
+        self.dsds = rng.randn(n, self.state_size, self.state_size)
+        self.dsda = rng.randn(n, self.state_size, self.action_size)
+        self.drds = rng.randn(n, self.state_size)
+        self.drda = rng.randn(n, self.action_size)
+
+    def reference(self, agent, episode_idx):
+        """Weight the jacobians one step at a time, in the order backward visits them (last step first)"""
+        jacobians = [None] * len(self.step_idx)
+        for idx in reversed(range(len(self.step_idx))):
+            jacobian = torch.empty(self.state_size + 1, self.state_size + self.action_size, dtype=torch.float64)
+            jacobians[idx] = weighted_jacobian(
+                agent, episode_idx, self.step_idx[idx], {"state": self.dsds[idx], "action": self.dsda[idx]},
+                {"state": self.drds[idx], "action": self.drda[idx]}, jacobian).numpy()
+        return np.stack(jacobians)
+
+    def assert_stack_matches_reference(self, grad_weights, running_sum):
+        # Only the running sum of the episode's own index is accumulated
+        self.cfg.MODEL.POLICY.GRAD_WEIGHTS = grad_weights
+        episode_idx = 1
+        running_sums = np.array([5.0, running_sum, 7.0])
+        reference_agent = types.SimpleNamespace(cfg=self.cfg, running_sum=running_sums.copy())
+        reference = self.reference(reference_agent, episode_idx)
+
+        agent = types.SimpleNamespace(cfg=self.cfg, running_sum=running_sums.copy())
+        dsda, drds, drda = self.dsda.copy(), self.drds.copy(), self.drda.copy()
+        weight_jacobian_stack(agent, episode_idx, self.step_idx, dsda, drds, drda)
+
+        s = self.state_size
+        np.testing.assert_allclose(dsda, reference[:, :s, s:])
+        np.testing.assert_allclose(drds, reference[:, s, :s])
+        np.testing.assert_allclose(drda, reference[:, s, s:])
+        np.testing.assert_allclose(agent.running_sum, reference_agent.running_sum)
+        self.assertEqual(agent.running_sum[0], 5.0)
+        self.assertEqual(agent.running_sum[2], 7.0)
+
+    def test_prioritise(self):
+        # Running sum starts from zero in a new batch, and carries over from later windows otherwise
+        self.assert_stack_matches_reference("prioritise", 0)
+        self.assert_stack_matches_reference("prioritise", 3)
+
+    def test_average(self):
+        self.assert_stack_matches_reference("average", 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+
+import numpy as np
+import torch
+from model.blocks.policy.dynamics import DynamicsModel
+from model.engine.imagined_trainer import TransitionBuffer, real_episode, imagined_loss
+from tests.test_blocks import build_test_model
+
+
+class TestImaginedTrainer(unittest.TestCase):
+
+    def build_model(self, *options):
+        """Closed-loop VariationalOptimization, see build_test_agent"""
+        agent, model = build_test_model("MODEL.POLICY.NETWORK", True, *options)
+        self.addCleanup(agent.close)
+        return agent, model
+
+    def test_real_episode(self):
+        agent, model = self.build_model()
+        policy = model.policy_net
+        policy.log_prob.fill_(0)
+        clamped_action = policy.clamped_action.copy()
+        log_prob = policy.log_prob.clone()
+
+        torch.manual_seed(0)
+        states, actions, next_states, rewards = real_episode(agent.cfg, model, agent)
+        self.assertEqual(states.shape[0], actions.shape[0])
+        self.assertEqual(states.shape, next_states.shape)
+        self.assertEqual(rewards.shape, states.shape[:1])
+
+        # Collecting data doesn't record actions or log probabilities into the policy, nor change its mode
+        np.testing.assert_array_equal(policy.clamped_action, clamped_action)
+        self.assertTrue(torch.equal(policy.log_prob, log_prob))
+        self.assertTrue(model.training and policy.training)
+
+        # Actions are the policy's mean plus exploration noise of its sd
+        with torch.no_grad():
+            mean = policy.batch_mean(states.to(model.policy_dtype)).to(model.dtype)
+        torch.manual_seed(0)
+        noise = torch.stack([torch.randn_like(mean[0]) for _ in range(actions.shape[0])])
+        sd = policy.clamp_sd(policy.sd[:, :actions.shape[0]]).detach().t().to(model.dtype)
+        np.testing.assert_allclose(actions.numpy(), (mean + sd * noise).numpy(), rtol=1e-6)
+
+    def test_buffer_wraparound(self):
+        buffer = TransitionBuffer(5, 2, 1, torch.float64)
+        transitions = torch.arange(7, dtype=torch.float64)
+
+        def add(idx):
+            buffer.add(transitions[idx].unsqueeze(1).repeat(1, 2), transitions[idx].unsqueeze(1),
+                       transitions[idx].unsqueeze(1).repeat(1, 2) + 1)
+
+        add(slice(0, 3))
+        self.assertEqual(len(buffer), 3)
+
+        # Adding past the end overwrites the oldest transitions
+        add(slice(3, 7))
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(buffer.count, 7)
+        np.testing.assert_array_equal(buffer.actions[:, 0].numpy(), [5, 6, 2, 3, 4])
+
+        # Samples are whole transitions, and only retained ones
+        states, actions, next_states = buffer.sample(100)
+        np.testing.assert_array_equal(states[:, 0].numpy(), actions[:, 0].numpy())
+        np.testing.assert_array_equal(next_states.numpy(), states.numpy() + 1)
+        self.assertTrue(set(actions[:, 0].tolist()) <= {2., 3., 4., 5., 6.})
+
+    def test_imagined_loss(self):
+        agent, model = self.build_model("MODEL.IMAGINED.ROLLOUTS", 4, "MODEL.IMAGINED.HORIZON", 3)
+        cfg, policy = agent.cfg, model.policy_net
+        dynamics_model = DynamicsModel(agent)
+        buffer = TransitionBuffer(10, agent.observation_space.shape[0], agent.action_space.shape[0], model.dtype)
+        torch.manual_seed(0)
+        buffer.add(*real_episode(cfg, model, agent)[:3])
+
+        torch.manual_seed(1)
+        loss = imagined_loss(cfg, model, dynamics_model, agent, buffer)
+
+        # Same as rolling out the sampled start states one by one
+        torch.manual_seed(1)
+        expected = []
+        for state in buffer.sample(cfg.MODEL.IMAGINED.ROLLOUTS)[0]:
+            state, reward_sum = state.unsqueeze(0), 0
+            for step_idx in range(cfg.MODEL.IMAGINED.HORIZON):
+                action = policy.batch_mean(state.to(model.policy_dtype)).to(model.dtype)
+                next_state = dynamics_model(state.float(), action.float()).to(model.dtype)
+                reward = agent.unwrapped.batch_reward(state, action, next_state)
+                reward_sum += cfg.MODEL.POLICY.GAMMA ** step_idx * reward
+                state = next_state
+            expected.append(-reward_sum)
+        self.assertAlmostEqual(loss.item(), torch.cat(expected).mean().item(), places=5)
+
+        # Gradients flow through the dynamics model into every parameter of the policy's mean, but not its sd
+        loss.backward()
+        for name, parameter in policy.mean.named_parameters():
+            self.assertIsNotNone(parameter.grad, name)
+            self.assertTrue(torch.isfinite(parameter.grad).all() and (parameter.grad != 0).any(), name)
+        self.assertIsNone(policy.sd.grad)
+        self.assertTrue(all(parameter.grad is not None for parameter in dynamics_model.parameters()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+from model.config import get_cfg_defaults
+from mujoco.utils import backward
+from mujoco.utils.regression import TransitionRegression
+from utils.index import Index
+
+
+class SmoothTransition(object):
+    """
+    Transition [qpos, qvel, ctrl] -> [next state, reward] = tanh(M [qpos, qvel, ctrl]) of a model with nq = nv = 2 and
+    nu = 1, and a gradient engine that returns its exact jacobians
+    """
+
+    def __init__(self, seed=0):
+        self.model = types.SimpleNamespace(nq=2, nv=2, nu=1)
+        self.matrix = np.random.RandomState(seed).randn(5, 5)
+        self.engine_calls = 0
+
+    def __call__(self, x):
+        y = np.tanh(np.matmul(self.matrix, x))
+        return y[:4], y[4]
+
+    def jacobian(self, x):
+        return (1 - np.tanh(np.matmul(self.matrix, x)) ** 2)[:, None] * self.matrix
+
+    def snapshot(self, x):
+        return types.SimpleNamespace(qpos=x[:2], qvel=x[2:4], ctrl=x[4:])
+
+    def engine(self, agent, data_snapshot, next_state, reward, test=False):
+        self.engine_calls += 1
+        jacobian = self.jacobian(np.concatenate((data_snapshot.qpos, data_snapshot.qvel, data_snapshot.ctrl)))
+        return {"state": jacobian[:4, :4], "action": jacobian[:4, 4:]}, \
+               {"state": jacobian[4:, :4], "action": jacobian[4:, 4:]}
+
+
+class LinearSimulation(object):
+    """
+    Kernel (see mujoco.utils.kernel.SteppingKernel) of a linear transition [next state, reward] = A [qpos, qvel, ctrl]
+    + b of a model with nq = nv = 2 and nu = 1, so finite differences give A in any direction
+    """
+
+    def __init__(self, seed=0):
+        rng = np.random.RandomState(seed)
+        self.model = types.SimpleNamespace(nq=2, nv=2, nu=1)
+        self.data = types.SimpleNamespace(qpos=np.zeros(2), qvel=np.zeros(2), ctrl=np.zeros(1))
+        self.matrix = rng.randn(5, 5)
+        self.offset = rng.randn(5)
+
+    def snapshot(self):
+        return types.SimpleNamespace(qpos=self.data.qpos.copy(), qvel=self.data.qvel.copy(),
+                                     ctrl=self.data.ctrl.copy())
+
+    def restore(self, data_snapshot):
+        self.data.qpos[:] = data_snapshot.qpos
+        self.data.qvel[:] = data_snapshot.qvel
+        self.data.ctrl[:] = data_snapshot.ctrl
+
+    def step_raw(self, ctrl):
+        y = np.matmul(self.matrix, np.concatenate((self.data.qpos, self.data.qvel, ctrl))) + self.offset
+        self.data.qpos[:] = y[:2]
+        self.data.qvel[:] = y[2:4]
+        return y[:4], y[4], False, None
+
+
+class TestBroyden(unittest.TestCase):
+
+    def setUp(self):
+        self.transition = SmoothTransition()
+        self.cfg = get_cfg_defaults()
+        self.cfg.MODEL.GRADIENTS.BROYDEN_REFRESH = 100
+        self.agent = types.SimpleNamespace(model=self.transition.model, cfg=self.cfg, broyden=None)
+        patcher = mock.patch.object(backward, "base_gradient_engine", return_value=self.transition.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def step(self, x):
+        next_state, reward = self.transition(x)
+        dynamics_gradients, reward_gradients = backward.calculate_gradients_broyden(
+            self.agent, self.transition.snapshot(x), next_state, reward)
+        return np.block([[dynamics_gradients["state"], dynamics_gradients["action"]],
+                         [reward_gradients["state"], reward_gradients["action"]]])
+
+    def test_update(self):
+        x0 = np.random.RandomState(1).randn(5) * 0.1
+        dx = np.random.RandomState(2).randn(5) * 0.01
+        jacobian0 = self.step(x0)
+        np.testing.assert_allclose(jacobian0, self.transition.jacobian(x0))
+
+        jacobian1 = self.step(x0 + dx)
+        self.assertEqual(self.transition.engine_calls, 1)
+        self.assertEqual(self.agent.broyden.updates, 1)
+
+        # Updated jacobian reproduces the observed transition (secant condition) ...
+        dy = np.concatenate(self.transition(x0 + dx), axis=None) - np.concatenate(self.transition(x0), axis=None)
+        np.testing.assert_allclose(np.matmul(jacobian1, dx), dy, atol=1e-12)
+
+        # ... and doesn't change in directions orthogonal to the step
+        orthogonal = np.linalg.svd(dx[None, :])[2][1:].T
+        np.testing.assert_allclose(np.matmul(jacobian1, orthogonal), np.matmul(jacobian0, orthogonal), atol=1e-12)
+
+    def test_refresh_period(self):
+        self.cfg.MODEL.GRADIENTS.BROYDEN_REFRESH = 3
+        x = np.zeros(5)
+        for step_idx in range(8):
+            self.step(x + 0.001 * step_idx)
+
+        # Refreshed at the first step, and after every three updates
+        self.assertEqual(self.transition.engine_calls, 2)
+        self.assertEqual(self.agent.broyden.refreshes, 2)
+        self.assertEqual(self.agent.broyden.updates, 6)
+
+    def test_refresh_on_large_step(self):
+        x = np.zeros(5)
+        self.step(x)
+        self.step(x + 0.001)
+        self.assertEqual(self.transition.engine_calls, 1)
+
+        self.step(x + self.cfg.MODEL.GRADIENTS.BROYDEN_MAX_STEP)
+        self.assertEqual(self.transition.engine_calls, 2)
+
+    def test_refresh_on_large_error(self):
+        x = np.zeros(5)
+        self.step(x)
+        self.step(x + 0.01)
+        self.assertEqual(self.transition.engine_calls, 1)
+
+        # Curvature of tanh makes the previous jacobian mispredict any step a little
+        self.cfg.MODEL.GRADIENTS.BROYDEN_MAX_ERROR = 1e-9
+        self.step(x + 0.02)
+        self.assertEqual(self.transition.engine_calls, 2)
+
+
+class TestSketch(unittest.TestCase):
+
+    def setUp(self):
+        self.kernel = LinearSimulation()
+        self.cfg = get_cfg_defaults()
+        self.agent = types.SimpleNamespace(kernel=self.kernel, model=self.kernel.model, cfg=self.cfg)
+
+        # Forward pass from a random state
+        rng = np.random.RandomState(1)
+        self.kernel.restore(types.SimpleNamespace(qpos=rng.randn(2), qvel=rng.randn(2), ctrl=rng.randn(1)))
+        self.data_snapshot = self.kernel.snapshot()
+        self.next_state, self.reward, _, _ = self.kernel.step_raw(self.data_snapshot.ctrl.copy())
+        self.previous = np.random.RandomState(2).randn(5, 5)
+
+    def sketch(self, ndirections, seed=3):
+        self.cfg.MODEL.GRADIENTS.SKETCH_DIRECTIONS = ndirections
+        np.random.seed(seed)
+        return backward.sketch_jacobian(self.agent, self.data_snapshot, self.next_state, self.reward, self.previous)
+
+    def test_all_directions(self):
+        # As many directions as columns measure the whole jacobian
+        np.testing.assert_allclose(self.sketch(5), self.kernel.matrix, atol=1e-6)
+
+    def test_span(self):
+        corrected = self.sketch(2, seed=3)
+
+        # Same directions as the sketch drew
+        np.random.seed(3)
+        directions, _ = np.linalg.qr(np.random.randn(5, 2))
+        orthogonal = np.linalg.svd(directions.T)[2][2:].T
+
+        # Exact in the span of the directions, previous estimate everywhere else
+        np.testing.assert_allclose(np.matmul(corrected, directions), np.matmul(self.kernel.matrix, directions),
+                                   atol=1e-6)
+        np.testing.assert_allclose(np.matmul(corrected, orthogonal), np.matmul(self.previous, orthogonal), atol=1e-12)
+        np.testing.assert_allclose(corrected, self.previous + np.matmul(
+            np.matmul(self.kernel.matrix - self.previous, directions), directions.T), atol=1e-6)
+
+
+class TestRegression(unittest.TestCase):
+
+    def setUp(self):
+        self.kernel = LinearSimulation()
+        self.cfg = get_cfg_defaults()
+        self.cfg.MODEL.BATCH_SIZE = 10
+        self.cfg.MODEL.POLICY.MAX_HORIZON_STEPS = 3
+        self.episode_idx = Index(0)
+        agent = types.SimpleNamespace(model=self.kernel.model, get_episode_idx=lambda: self.episode_idx)
+        self.regression = TransitionRegression(self.cfg, agent)
+
+    def record_batch(self, step_idx, states, actions, noise=0.0):
+        """Record a step of every episode; episode indices are one-based like IndexWrapper's"""
+        rng = np.random.RandomState(step_idx)
+        for episode_idx, (state, action) in enumerate(zip(states, actions)):
+            self.episode_idx.set(episode_idx + 1)
+            self.kernel.restore(types.SimpleNamespace(qpos=state[:2], qvel=state[2:], ctrl=action))
+            next_state, reward, _, _ = self.kernel.step_raw(action.copy())
+            self.regression.record(step_idx, state, action, next_state + noise * rng.randn(4),
+                                   reward + noise * rng.randn())
+
+    def test_linear_system(self):
+        rng = np.random.RandomState(0)
+        self.record_batch(0, rng.randn(10, 4), rng.randn(10, 1))
+        np.testing.assert_allclose(self.regression.jacobian(0), self.kernel.matrix, atol=1e-10)
+
+        # Fit of a later batch is regularised towards this one, which is exact already
+        self.record_batch(0, rng.randn(10, 4), rng.randn(10, 1))
+        np.testing.assert_allclose(self.regression.jacobian(0), self.kernel.matrix, atol=1e-10)
+
+    def test_fallbacks(self):
+        rng = np.random.RandomState(0)
+
+        # Episodes start from the same state, so without a prior the batch can't determine the jacobian
+        self.record_batch(0, np.ones((10, 4)), rng.randn(10, 1))
+        self.assertIsNone(self.regression.jacobian(0))
+
+        # Transitions a linear model doesn't explain
+        self.record_batch(1, rng.randn(10, 4), rng.randn(10, 1), noise=10.0)
+        self.assertIsNone(self.regression.jacobian(1))
+        self.assertGreater(self.regression.residuals[-1], self.cfg.MODEL.GRADIENTS.REGRESSION_MAX_RESIDUAL)
+
+        # Finite-difference jacobian becomes the prior, so the batch's fit starts from it
+        self.regression.fallback(0, self.kernel.matrix)
+        self.record_batch(0, np.ones((10, 4)), rng.randn(10, 1))
+        np.testing.assert_allclose(self.regression.jacobian(0), self.kernel.matrix, atol=1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()
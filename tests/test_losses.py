@@ -0,0 +1,85 @@
+import unittest
+
+import numpy as np
+import torch
+from model.blocks.policy.strategies import discounted_returns, BatchLossTerms
+
+
+def reference_returns(rewards, gamma):
+    """Discounted returns of one episode, summed step by step"""
+    return [sum(gamma ** (k - t) * rewards[k] for k in range(t, len(rewards))) for t in range(len(rewards))]
+
+
+class TestLosses(unittest.TestCase):
+
+    def test_discounted_returns(self):
+        rewards = torch.randn(4, 10, dtype=torch.float64)
+        for gamma in [0.0, 0.5, 0.99, 1.0]:
+            returns = discounted_returns(rewards, gamma)
+            for episode_idx in range(rewards.shape[0]):
+                np.testing.assert_allclose(returns[episode_idx].numpy(),
+                                           reference_returns(rewards[episode_idx].tolist(), gamma), rtol=1e-10)
+
+    def test_discounted_returns_long_horizon(self):
+        # gamma^t underflows to zero long before the end of the episode
+        returns = discounted_returns(torch.ones(2, 2000, dtype=torch.float64), 0.5)
+        self.assertTrue(torch.isfinite(returns).all())
+        np.testing.assert_allclose(returns[:, 0].numpy(), 2.0)
+        np.testing.assert_allclose(returns[:, -1].numpy(), 1.0)
+
+        # Without discounting returns are the rewards themselves, even though 0^t is zero from the second step on
+        rewards = torch.randn(2, 2000, dtype=torch.float64)
+        returns = discounted_returns(rewards, 0.0)
+        self.assertTrue(torch.isfinite(returns).all())
+        np.testing.assert_array_equal(returns.numpy(), rewards.numpy())
+
+    def test_discounted_returns_scan(self):
+        # A dense [T, T] matrix of discounts would take 800 MB at this horizon
+        rewards = torch.randn(3, 10000, dtype=torch.float64)
+        returns = discounted_returns(rewards, 0.99)
+        for episode_idx in range(rewards.shape[0]):
+            expected, running = [], 0.0
+            for reward in reversed(rewards[episode_idx].tolist()):
+                running = reward + 0.99 * running
+                expected.append(running)
+            np.testing.assert_allclose(returns[episode_idx].numpy(), expected[::-1], rtol=1e-10)
+
+    def test_batch_loss_terms(self):
+        batch_size, horizon, gamma, eps = 5, 8, 0.9, 1e-7
+        batch_loss = torch.randn(batch_size, horizon, dtype=torch.float64)
+
+        # Episodes 1 and 3 terminated early; their steps after that are left as garbage
+        lengths = [8, 3, 8, 5, 8]
+        mask = torch.zeros(batch_size, horizon, dtype=torch.bool)
+        for episode_idx, length in enumerate(lengths):
+            mask[episode_idx, :length] = True
+        batch_loss[~mask] = 1e6
+
+        terms = BatchLossTerms(batch_loss, mask, gamma, eps)
+
+        # Losses and returns of each episode only include its simulated steps
+        returns = np.zeros((batch_size, horizon))
+        for episode_idx, length in enumerate(lengths):
+            losses = batch_loss[episode_idx, :length].tolist()
+            self.assertAlmostEqual(terms.episode_loss[episode_idx].item(), sum(losses))
+            returns[episode_idx, :length] = reference_returns([-loss for loss in losses], gamma)
+        np.testing.assert_allclose(terms.returns.numpy(), returns, rtol=1e-10)
+
+        # Baseline of each step is calculated from the episodes that were still running
+        for step_idx in range(horizon):
+            valid = [episode_idx for episode_idx, length in enumerate(lengths) if step_idx < length]
+            step_returns = returns[valid, step_idx]
+            sd = np.std(step_returns, ddof=1) if len(valid) > 1 else 0.0
+            advantages = np.zeros(batch_size)
+            advantages[valid] = (step_returns - step_returns.mean()) / (sd + eps)
+            np.testing.assert_allclose(terms.advantages[:, step_idx].numpy(), advantages, rtol=1e-8, atol=1e-12)
+
+        # Steps marked with NaNs instead of a mask give the same terms
+        nan_terms = BatchLossTerms(batch_loss.masked_fill(~mask, np.nan), None, gamma, eps)
+        self.assertTrue(torch.equal(nan_terms.mask, mask))
+        np.testing.assert_allclose(nan_terms.returns.numpy(), terms.returns.numpy())
+        np.testing.assert_allclose(nan_terms.advantages.numpy(), terms.advantages.numpy())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+import torch
+from tests.test_blocks import build_test_model
+
+
+class TestVariationalOptimization(unittest.TestCase):
+
+    def build_policy(self, *options):
+        """Open-loop VariationalOptimization that samples actions (batch of two, see build_test_agent)"""
+        agent, model = build_test_model("MODEL.POLICY.INITIAL_SD", 0.5, "MODEL.POLICY.METHOD", "R", *options)
+        self.addCleanup(agent.close)
+        return agent, model.policy_net
+
+    def batch_actions(self, agent, policy, seed=0):
+        """Actions [B, T, A] of every episode and step of a batch, stepped episode by episode like the trainer does"""
+        torch.manual_seed(seed)
+        state = torch.zeros(policy.state_dim, dtype=torch.float64)
+        actions = []
+        for episode_idx in range(policy.batch_size):
+            agent.set_episode_idx(episode_idx + 1)
+            for step_idx in range(policy.horizon):
+                agent.set_step_idx(step_idx)
+                actions.append(policy(state))
+        return torch.stack(actions).reshape(policy.batch_size, policy.horizon, -1)
+
+    def test_presampled_actions(self):
+        agent, policy = self.build_policy()
+        self.assertTrue(policy.vectorized)
+        actions = self.batch_actions(agent, policy)
+
+        # Noise is drawn once for the whole batch, and every action is reparameterized with it
+        mean, sd, noise = policy.mean.detach(), policy.sd.detach(), policy.noise
+        expected = (mean.unsqueeze(2) + sd.unsqueeze(2) * noise).permute(2, 1, 0)
+        np.testing.assert_allclose(actions.detach().numpy(), expected.numpy(), rtol=1e-12)
+
+        # Gradients reach the mean and sd through the actions
+        actions.sum().backward()
+        np.testing.assert_allclose(policy.mean.grad.numpy(), policy.batch_size)
+        np.testing.assert_allclose(policy.sd.grad.numpy(), noise.sum(dim=2).numpy(), rtol=1e-12)
+
+        # Truncated backpropagation reparameterizes step by step, from the same noise
+        truncated_agent, truncated_policy = self.build_policy("MODEL.TRUNCATED_BPTT", 3)
+        truncated_policy.load_state_dict(policy.state_dict())
+        truncated_actions = self.batch_actions(truncated_agent, truncated_policy)
+        np.testing.assert_allclose(truncated_actions.detach().numpy(), actions.detach().numpy(), rtol=1e-12)
+
+        # and so does a batch of all episodes at each step
+        torch.manual_seed(0)
+        states = torch.zeros(policy.batch_size, policy.state_dim, dtype=torch.float64)
+        for step_idx in range(policy.horizon):
+            agent.set_step_idx(step_idx)
+            np.testing.assert_allclose(policy.batch_forward(states).detach().numpy(),
+                                       actions[:, step_idx].detach().numpy(), rtol=1e-12)
+
+    def test_batch_log_prob(self):
+        agent, policy = self.build_policy()
+        actions = self.batch_actions(agent, policy).detach()
+        policy.batch_log_prob()
+
+        # Same log probabilities as evaluating each action's distribution on its own
+        for episode_idx in range(policy.batch_size):
+            for step_idx in range(policy.horizon):
+                dist = torch.distributions.Normal(policy.mean[:, step_idx], policy.sd[:, step_idx])
+                self.assertAlmostEqual(policy.log_prob[episode_idx, step_idx].item(),
+                                       dist.log_prob(actions[episode_idx, step_idx]).sum().item())
+        np.testing.assert_allclose(policy.clamped_action, actions.permute(2, 1, 0).numpy(), rtol=1e-12)
+
+        # Log probabilities are differentiable wrt mean and sd for the REINFORCE loss
+        policy.log_prob.sum().backward()
+        self.assertTrue(torch.isfinite(policy.mean.grad).all() and (policy.sd.grad != 0).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import math
+import unittest
+
+import numpy as np
+import torch
+from model.config import get_cfg_defaults
+from mujoco import envs
+
+
+# Rewards of one transition as step() calculated them from the simulation before batch_reward
+def half_cheetah(env, state, action, next_state):
+    return - 0.01 * np.square(action).sum() + (next_state[0] - state[0]) / env.dt
+
+
+def hopper(env, state, action, next_state):
+    posafter, height, ang = next_state[0:3]
+    reward = (posafter - state[0]) / env.dt
+    ang_abs = abs(ang) % (2*math.pi)
+    if ang_abs > math.pi:
+        ang_abs = 2*math.pi - ang_abs
+    reward += env.sigmoid(height/1.25, 0, 1) + env.sigmoid((math.pi - ang_abs)/math.pi, 0, 1)
+    return reward - 1e-3 * np.square(action).sum()
+
+
+def inverted_double_pendulum(env, state, action, next_state):
+    # Position of the tip site in the next state
+    nq = env.model.nq
+    env.set_state(next_state[:nq], next_state[nq:])
+    x, _, y = env.sim.data.site_xpos[0]
+    v1, v2 = env.sim.data.qvel[1:3]
+    return - 0.01 * x ** 2 - (y - 2) ** 2 - 1e-3 * v1 ** 2 - 5e-3 * v2 ** 2
+
+
+def inverted_pendulum(env, state, action, next_state):
+    x = y = 0.6 * np.cos(next_state[1])
+    return - 0.01 * x ** 2 - (y - 1) ** 2 - 0.001 * np.square(action).sum()
+
+
+def swimmer(env, state, action, next_state):
+    return (next_state[0] - state[0]) / env.dt - 0.0001 * np.square(action).sum()
+
+
+def walker2d(env, state, action, next_state):
+    posafter, height, ang = next_state[0:3]
+    reward = (posafter - state[0]) / env.dt
+    reward += min(max(height/0.8, 0), 1)*0.5 + max(((math.pi - abs(ang))/math.pi), 1)*0.5
+    return reward - 1e-3 * np.square(action).sum()
+
+
+class TestRewards(unittest.TestCase):
+
+    def rollout(self, env, nsteps, seed=0):
+        """Step the env from reset with random actions; returns states, actions, next states, rewards, and infos"""
+        rng = np.random.RandomState(seed)
+        env.reset()
+        transitions = []
+        for _ in range(nsteps):
+            state = env._get_obs()
+            action = rng.uniform(-1, 1, env.model.nu)
+            next_state, reward, _, info = env.step(action)
+            transitions.append((state, action, next_state, reward, info))
+        states, actions, next_states, rewards, infos = zip(*transitions)
+        return np.stack(states), np.stack(actions), np.stack(next_states), np.array(rewards, dtype=float), infos
+
+    def test_batch_reward(self):
+        cfg = get_cfg_defaults()
+        references = {"HalfCheetahEnv": half_cheetah, "HopperEnv": hopper,
+                      "InvertedDoublePendulumEnv": inverted_double_pendulum, "InvertedPendulumEnv": inverted_pendulum,
+                      "SwimmerEnv": swimmer, "Walker2dEnv": walker2d}
+        terms = {"HalfCheetahEnv": {"reward_run", "reward_ctrl"}, "SwimmerEnv": {"reward_fwd", "reward_ctrl"}}
+        for name, reference in references.items():
+            with self.subTest(env=name):
+                env = getattr(envs, name)(cfg)
+                self.addCleanup(env.close)
+                states, actions, next_states, rewards, infos = self.rollout(env, 5)
+
+                # Step rewards are the rewards calculated from the simulation
+                for step_idx in range(len(rewards)):
+                    self.assertAlmostEqual(rewards[step_idx], reference(env, states[step_idx], actions[step_idx],
+                                                                         next_states[step_idx]), places=8)
+
+                # Batches of numpy arrays and torch tensors get the same rewards, and tensor_reward for one transition
+                np.testing.assert_allclose(env.batch_reward(states, actions, next_states), rewards, rtol=1e-12)
+                tensors = [torch.from_numpy(x) for x in (states, actions, next_states)]
+                np.testing.assert_allclose(env.batch_reward(*tensors).numpy(), rewards, rtol=1e-12)
+                np.testing.assert_allclose(env.tensor_reward(*[x[-1] for x in tensors]).numpy(), rewards[-1:],
+                                           rtol=1e-12)
+
+                # Terms of the reward are reported in info
+                for info, reward in zip(infos, rewards):
+                    self.assertEqual(set(info), terms.get(name, set()))
+                    if info:
+                        self.assertAlmostEqual(sum(info.values()), reward)
+
+
+if __name__ == '__main__':
+    unittest.main()
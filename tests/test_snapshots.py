@@ -0,0 +1,88 @@
+import pickle
+import unittest
+
+import numpy as np
+import mujoco_py as mj
+from mujoco.utils.wrappers.etc import SnapshotLayout, SnapshotBuffer
+from utils.index import Index
+
+
+# A slide joint with a motor, and a hinge joint with an actuator that has an activation
+XML = """
+<mujoco>
+    <worldbody>
+        <body>
+            <joint name="slide" type="slide" axis="1 0 0"/>
+            <geom type="box" size=".1 .1 .1"/>
+            <body pos="0 0 -.3">
+                <joint name="hinge" type="hinge" axis="0 1 0"/>
+                <geom type="capsule" fromto="0 0 0 0 0 -.3" size=".05"/>
+            </body>
+        </body>
+    </worldbody>
+    <actuator>
+        <motor joint="slide"/>
+        <general joint="hinge" dyntype="filter" dynprm="0.1"/>
+    </actuator>
+</mujoco>
+"""
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = mj.MjSim(mj.load_model_from_xml(XML))
+        self.data = self.sim.data
+        self.layout = SnapshotLayout(self.data)
+
+    def randomise(self, seed):
+        rng = np.random.RandomState(seed)
+        self.data.time = rng.rand()
+        for field in SnapshotLayout.fields[1:]:
+            value = getattr(self.data, field)
+            if value is not None:
+                value[:] = rng.randn(*value.shape)
+
+    def assert_data_equal(self, expected):
+        self.assertEqual(self.data.time, expected["time"])
+        for field in SnapshotLayout.fields[1:]:
+            np.testing.assert_array_equal(getattr(self.data, field), expected[field])
+
+    def test_round_trip(self):
+        self.randomise(0)
+        expected = {field: np.copy(getattr(self.data, field)) for field in SnapshotLayout.fields}
+        row = np.empty(self.layout.size)
+        self.layout.pack(self.data, Index(7), row)
+
+        # Every field is restored as it was, along with the step index
+        self.randomise(1)
+        step_idx = self.layout.unpack(row, self.data)
+        self.assertEqual(step_idx.value, 7)
+        self.assert_data_equal(expected)
+
+    def test_buffer(self):
+        buffer = SnapshotBuffer(self.data, 3)
+        self.randomise(0)
+        snapshot = buffer.pack(self.data, Index(1))
+        qpos = self.data.qpos.copy()
+
+        # Snapshots are views into the buffer, and pickled with only their own row
+        np.testing.assert_array_equal(snapshot.qpos, qpos)
+        self.assertEqual(snapshot.step_idx.value, 1)
+        unpickled = pickle.loads(pickle.dumps(snapshot))
+        self.assertEqual(unpickled.row.shape, (self.layout.size,))
+        np.testing.assert_array_equal(unpickled.qpos, qpos)
+
+        # Copies don't take a row of the buffer, so the first snapshot is overwritten only by the fourth pack
+        self.randomise(1)
+        buffer.pack_copy(self.data, Index(2))
+        buffer.pack(self.data, Index(2))
+        buffer.pack(self.data, Index(3))
+        np.testing.assert_array_equal(snapshot.qpos, qpos)
+        buffer.pack(self.data, Index(4))
+        np.testing.assert_array_equal(snapshot.qpos, self.data.qpos)
+        self.assertEqual(snapshot.step_idx.value, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+import numpy as np
+import mujoco_py as mj
+from mujoco.utils.backward import kinematic_components, tree_sparsity, color_columns
+
+
+def pendulums_xml(npendulums, coupling=""):
+    """Double pendulums side by side, each one a kinematic tree that only collides with itself"""
+    bodies = ""
+    actuators = ""
+    for k in range(npendulums):
+        geom = '<geom type="capsule" fromto="0 0 0 0 0 -.5" size=".05" contype="{0}" conaffinity="{0}"/>'.format(2**k)
+        bodies += '<body pos="{0} 0 1"><joint name="hip{0}" type="hinge" axis="0 1 0"/>{1}' \
+                  '<body pos="0 0 -.5"><joint name="knee{0}" type="hinge" axis="0 1 0"/>{1}</body></body>' \
+                  .format(k, geom)
+        actuators += '<motor joint="hip{0}"/><motor joint="knee{0}"/>'.format(k)
+    return '<mujoco><worldbody>{}</worldbody><actuator>{}</actuator>{}</mujoco>'.format(bodies, actuators, coupling)
+
+
+class TestSparsity(unittest.TestCase):
+
+    def assert_valid_coloring(self, pattern, colors):
+        # Every column gets exactly one color
+        self.assertEqual(sorted(column for color in colors for column in color), list(range(pattern.shape[1])))
+
+        # Columns of a color never affect the same state
+        for color in colors:
+            self.assertTrue((pattern[:, color].sum(axis=1) <= 1).all())
+
+    def test_color_columns(self):
+        rng = np.random.RandomState(0)
+        for density in [0.0, 0.1, 0.3, 1.0]:
+            pattern = rng.rand(20, 30) < density
+            colors = color_columns(pattern)
+            self.assert_valid_coloring(pattern, colors)
+
+        # Block diagonal pattern needs as many colors as the largest block has columns
+        pattern = np.kron(np.identity(3, dtype=bool), np.ones((4, 2), dtype=bool))
+        colors = color_columns(pattern)
+        self.assert_valid_coloring(pattern, colors)
+        self.assertEqual(len(colors), 2)
+
+    def test_multiple_trees(self):
+        m = mj.load_model_from_xml(pendulums_xml(3))
+
+        # Every pendulum is its own component
+        components = kinematic_components(m)[1:]
+        self.assertEqual(len(set(components)), 3)
+        self.assertEqual(len(set(components[0::2])), 3)
+        self.assertTrue((components[0::2] == components[1::2]).all())
+
+        # Columns of different pendulums can share colors, so one pendulum's worth of columns is enough
+        pattern = tree_sparsity(m)
+        colors = color_columns(pattern)
+        self.assert_valid_coloring(pattern, colors)
+        self.assertEqual(len(colors), pattern.shape[1] // 3)
+
+    def test_coupled_trees(self):
+        # Hips of the first two pendulums are coupled with an equality constraint
+        m = mj.load_model_from_xml(pendulums_xml(3, '<equality><joint joint1="hip0" joint2="hip1"/></equality>'))
+
+        components = kinematic_components(m)[1:]
+        self.assertEqual(len(set(components)), 2)
+        self.assertEqual(len(set(components[:4])), 1)
+        self.assertNotEqual(components[0], components[4])
+
+        # Columns of the coupled pendulums affect each other's states
+        pattern = tree_sparsity(m)
+        self.assertTrue(pattern[m.nq + 2, m.nu])
+        self.assertFalse(pattern[m.nq + 4, m.nu])
+        colors = color_columns(pattern)
+        self.assert_valid_coloring(pattern, colors)
+        self.assertEqual(len(colors), 2 * pattern.shape[1] // 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,20 @@
+import torch
+
+# Torch dtypes of the policy net and of everything else (autograd blocks, jacobians, adjoints) for each
+# MODEL.PRECISION; "mixed" is the original setup where only the policy net runs in single precision
+dtypes = {"mixed": (torch.float32, torch.float64),
+          "single": (torch.float32, torch.float32),
+          "double": (torch.float64, torch.float64)}
+
+
+def policy_dtype(cfg):
+    return dtypes[cfg.MODEL.PRECISION][0]
+
+
+def block_dtype(cfg):
+    return dtypes[cfg.MODEL.PRECISION][1]
+
+
+def numpy_dtype(dtype):
+    """Numpy dtype matching a torch dtype"""
+    return torch.empty(0, dtype=dtype).numpy().dtype